@@ -0,0 +1,199 @@
+'''
+Performance benchmarks for the INSPIRE harvesters.
+
+They run on synthetic corpora (see ckanext.inspire.benchmarks.corpus) and
+are run with::
+
+    paster inspire benchmark [{count}] [--size=BYTES] [--output=FILE] --config=<config file>
+
+The harvest and csw benchmarks gather from local servers (see
+ckanext.inspire.benchmarks.http_server and csw_server), whose latency and
+failure rate can be set.
+
+The results are written as JSON, along with the ckan.inspire options in the
+config, so runs can be compared between releases or configurations. The
+harvest benchmark writes packages and harvest objects, so it should be run
+against a scratch database.
+'''
+import time
+import shutil
+import logging
+import platform
+import tempfile
+from datetime import datetime
+
+from lxml import etree
+from pylons import config
+
+from ckanext.inspire.benchmarks.corpus import generate_documents, write_waf, \
+                                             RESOURCE_TYPES
+
+log = logging.getLogger(__name__)
+
+BENCHMARKS = ['read_values', 'validator', 'get_gemini_string_and_guid', 'harvest',
+              'csw']
+
+# Port of the local server the harvest benchmark gathers from
+PORT = 8998
+# Port of the local CSW server
+CSW_PORT = 8997
+
+def _result(name, durations, **extra):
+    '''Summary of the durations (in seconds) of each operation'''
+    total = sum(durations)
+    durations = sorted(durations)
+    count = len(durations)
+    result = {
+        'name': name,
+        'count': count,
+        'seconds': round(total, 4),
+        'per_second': round(count / total, 2) if total else None,
+        'mean_ms': round(1000 * total / count, 3) if count else None,
+        'median_ms': round(1000 * durations[count / 2], 3) if count else None,
+        'p95_ms': round(1000 * durations[int(count * 0.95)], 3) if count else None,
+    }
+    result.update(extra)
+    return result
+
+def _timed(name, items, function, **extra):
+    '''Runs `function` on each item, timing each call'''
+    durations = []
+    for item in items:
+        start = time.time()
+        function(item)
+        durations.append(time.time() - start)
+    return _result(name, durations, **extra)
+
+def _documents(count, size):
+    return (document for name, document in generate_documents(count, size=size))
+
+def benchmark_read_values(count, size=None, **kwargs):
+    from ckanext.inspire.model import GeminiDocument
+    return _timed('read_values', _documents(count, size),
+                  lambda document: GeminiDocument(document).read_values())
+
+def benchmark_validator(count, size=None, **kwargs):
+    from ckanext.csw.validation import Validator
+    from ckanext.inspire.harvesters import get_validator_profiles
+
+    profiles = get_validator_profiles()
+    validator = Validator(profiles=profiles)
+    # Only the validation is timed, not the parsing
+    trees = (etree.fromstring(document) for document in _documents(count, size))
+    return _timed('validator', trees, validator.is_valid,
+                  profiles=profiles)
+
+def benchmark_get_gemini_string_and_guid(count, size=None, **kwargs):
+    from ckanext.inspire.harvesters import GeminiDocHarvester, HarvestContext
+
+    harvester = GeminiDocHarvester()
+    harvest_context = HarvestContext()
+    return _timed('get_gemini_string_and_guid', _documents(count, size),
+                  lambda document: harvester.get_gemini_string_and_guid(harvest_context, document))
+
+def benchmark_harvest(count, size=None, **kwargs):
+    '''Gathers a WAF with the corpus from a local server and imports all
+    its objects. Returns the results of both stages.'''
+    from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject
+    from ckanext.inspire.harvesters import GeminiWafHarvester
+    from ckanext.inspire.benchmarks.http_server import serve
+
+    directory = tempfile.mkdtemp(prefix='inspire-benchmark-')
+    server = None
+    try:
+        # Unique GUIDs and titles, so they are new packages on every run
+        prefix = 'benchmark-%s' % datetime.now().strftime('%Y%m%d%H%M%S')
+        # Resource locators point to a missing page of the local server
+        base_url = 'http://127.0.0.1:%i/' % PORT
+        write_waf(directory, count, size=size, prefix=prefix,
+                  resource_url=base_url + 'missing')
+        server = serve(PORT, directory)
+
+        source = HarvestSource(url=unicode(base_url + 'index.html'),
+                               type=u'gemini-waf')
+        source.save()
+        job = HarvestJob(source=source)
+        job.save()
+
+        harvester = GeminiWafHarvester()
+        start = time.time()
+        object_ids = harvester.gather_stage(job) or []
+        gather = _result('gather', [time.time() - start],
+                         objects=len(object_ids))
+
+        objects = (HarvestObject.get(object_id) for object_id in object_ids)
+        harvest_import = _timed('import', objects, harvester.import_stage)
+
+        job.status = u'Finished'
+        job.save()
+        return [gather, harvest_import]
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(directory)
+
+def benchmark_csw(count, size=None, latency=0, failure_rate=0, **kwargs):
+    '''Gathers and fetches the corpus from a local CSW server, whose requests
+    take `latency` seconds and fail with a probability of `failure_rate`.
+    Returns the results of both stages.'''
+    from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject
+    from ckanext.inspire.harvesters import GeminiCswHarvester
+    from ckanext.inspire.benchmarks.csw_server import serve_csw
+
+    prefix = 'benchmark-%s' % datetime.now().strftime('%Y%m%d%H%M%S')
+    server = serve_csw(CSW_PORT, documents=[document for name, document in
+                       generate_documents(count, size=size, prefix=prefix)],
+                       latency=latency, failure_rate=failure_rate, seed=count)
+    try:
+        source = HarvestSource(url=u'http://127.0.0.1:%i/csw' % CSW_PORT,
+                               type=u'csw')
+        source.save()
+        job = HarvestJob(source=source)
+        job.save()
+
+        harvester = GeminiCswHarvester()
+        start = time.time()
+        object_ids = harvester.gather_stage(job) or []
+        gather = _result('csw_gather', [time.time() - start],
+                         objects=len(object_ids), requests=server.requests)
+
+        requests = server.requests
+        objects = (HarvestObject.get(object_id) for object_id in object_ids)
+        fetch = _timed('csw_fetch', objects, harvester.fetch_stage)
+        fetch['requests'] = server.requests - requests
+
+        job.status = u'Finished'
+        job.save()
+        return [gather, fetch]
+    finally:
+        server.shutdown()
+
+def run(count=1000, size=None, benchmarks=BENCHMARKS, latency=0, failure_rate=0):
+    '''Runs the benchmarks on a corpus of `count` documents of `size` bytes
+    (the size of the templates, around 30KB, by default). `latency` (in
+    seconds) and `failure_rate` apply to the requests to the local servers.
+    Returns a dict with the results, ready to be dumped as JSON.'''
+    results = []
+    for name in benchmarks:
+        log.info('Running benchmark %s on %i documents' % (name, count))
+        result = globals()['benchmark_' + name](count, size, latency=latency,
+                                                failure_rate=failure_rate)
+        results.extend(result if isinstance(result, list) else [result])
+
+    return {
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'corpus': {
+            'count': count,
+            'size': size,
+            'resource_types': RESOURCE_TYPES,
+        },
+        'network': {
+            'latency': latency,
+            'failure_rate': failure_rate,
+        },
+        'config': dict((key, value) for key, value in config.items()
+                       if key.startswith('ckan.inspire.')),
+        'results': results,
+    }
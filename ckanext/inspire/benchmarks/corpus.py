@@ -0,0 +1,99 @@
+'''
+Synthetic GEMINI 2 corpora for the benchmarks.
+
+The documents are copies of valid dataset, series and service records (the
+ones in the templates directory, also used in the validation tests), each
+with its own identifier, title and metadata date, and optionally padded to a
+given size.
+'''
+import os
+import copy
+from datetime import datetime, timedelta
+
+from lxml import etree
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+RESOURCE_TYPES = ['dataset', 'series', 'service']
+
+namespaces = {
+    'gmd': 'http://www.isotc211.org/2005/gmd',
+    'gco': 'http://www.isotc211.org/2005/gco',
+}
+
+_templates = {}
+
+def _get_template(resource_type):
+    if not resource_type in _templates:
+        parser = etree.XMLParser(remove_blank_text=True)
+        _templates[resource_type] = etree.parse(
+            os.path.join(TEMPLATES_DIR, '%s.xml' % resource_type), parser).getroot()
+    return _templates[resource_type]
+
+def _set_text(tree, xpath, text):
+    for element in tree.xpath(xpath, namespaces=namespaces):
+        element.text = text
+
+def generate_document(index, resource_type='dataset', size=None,
+                      metadata_date=None, resource_url=None, prefix='benchmark'):
+    '''Returns a GEMINI document (as a string) of the given resource type.
+
+    `index` (and `prefix`) make its identifier and title unique. If `size` (in bytes) is
+    bigger than the template, the abstract is padded to reach it. If
+    `resource_url` is given, the resource locators point to it, so the
+    import stage doesn't contact any external server.
+    '''
+    tree = copy.deepcopy(_get_template(resource_type))
+    metadata_date = metadata_date or datetime(2012, 1, 1) + timedelta(minutes=index)
+
+    _set_text(tree, '/gmd:MD_Metadata/gmd:fileIdentifier/gco:CharacterString',
+              '%s-%s-%06i' % (prefix, resource_type, index))
+    _set_text(tree, '/gmd:MD_Metadata/gmd:dateStamp/gco:Date',
+              metadata_date.strftime('%Y-%m-%d'))
+    _set_text(tree, '/gmd:MD_Metadata/gmd:dateStamp/gco:DateTime',
+              metadata_date.strftime('%Y-%m-%dT%H:%M:%S'))
+    _set_text(tree, '//gmd:identificationInfo/*/gmd:citation/gmd:CI_Citation/gmd:title/gco:CharacterString',
+              '%s %s %06i' % (prefix.capitalize(), resource_type, index))
+    if resource_url:
+        _set_text(tree, '//gmd:transferOptions//gmd:linkage/gmd:URL', resource_url)
+
+    document = etree.tostring(tree, pretty_print=True)
+    if size and len(document) < size:
+        abstract = tree.xpath('//gmd:identificationInfo/*/gmd:abstract/gco:CharacterString',
+                              namespaces=namespaces)[0]
+        padding = size - len(document)
+        abstract.text = (abstract.text or '') + \
+            (' Lorem ipsum dolor sit amet.' * (padding / 28 + 1))[:padding]
+        document = etree.tostring(tree, pretty_print=True)
+    return document
+
+def generate_documents(count, resource_types=RESOURCE_TYPES, size=None,
+                       resource_url=None, prefix='benchmark'):
+    '''Yields (file name, document) tuples for `count` documents, cycling
+    through the resource types'''
+    for index in xrange(count):
+        resource_type = resource_types[index % len(resource_types)]
+        document = generate_document(index, resource_type, size=size,
+                                     resource_url=resource_url, prefix=prefix)
+        yield '%s-%s-%06i.xml' % (prefix, resource_type, index), document
+
+def write_waf(directory, count, resource_types=RESOURCE_TYPES, size=None,
+              resource_url=None, prefix='benchmark'):
+    '''Writes a corpus to a directory, along with an index.html page linking
+    to all the documents, like a Web Accessible Folder. Returns the names of
+    the files written.'''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    names = []
+    for name, document in generate_documents(count, resource_types, size,
+                                             resource_url, prefix):
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(document)
+        names.append(name)
+
+    with open(os.path.join(directory, 'index.html'), 'w') as f:
+        f.write('<html><head><title>Index of benchmark WAF</title></head><body>\n')
+        for name in names:
+            f.write('<a href="%s">%s</a>\n' % (name, name))
+        f.write('</body></html>\n')
+    return names
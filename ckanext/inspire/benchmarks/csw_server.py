@@ -0,0 +1,286 @@
+'''
+A local stand-in for a CSW 2.0.2 server, serving a corpus of GEMINI documents.
+
+It supports what the CSW harvester uses: GetCapabilities, GetRecords (KVP or
+XML, with paging, hit counts, brief/summary/full element sets and a filter on
+the modified date) and GetRecordById. Requests can be delayed and made to fail
+at random, so gathering and fetching can be tested and benchmarked offline::
+
+    server = serve_csw(documents=documents, latency=0.05, failure_rate=0.01)
+    ...
+    server.shutdown()
+'''
+import os
+import re
+import glob
+import time
+import random
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from datetime import datetime
+
+from lxml import etree
+
+PORT = 8997
+
+namespaces = {
+    'csw': 'http://www.opengis.net/cat/csw/2.0.2',
+    'gmd': 'http://www.isotc211.org/2005/gmd',
+    'gco': 'http://www.isotc211.org/2005/gco',
+    'ows': 'http://www.opengis.net/ows',
+    'ogc': 'http://www.opengis.net/ogc',
+}
+
+CSW = '{%s}' % namespaces['csw']
+OWS = '{%s}' % namespaces['ows']
+OGC = '{%s}' % namespaces['ogc']
+
+# Children of MD_Metadata in the brief and summary ISO records
+BRIEF_ELEMENTS = ['fileIdentifier', 'hierarchyLevel', 'dateStamp', 'identificationInfo']
+SUMMARY_ELEMENTS = BRIEF_ELEMENTS + ['language', 'contact', 'metadataStandardName',
+                                     'referenceSystemInfo', 'distributionInfo']
+
+class CswError(Exception):
+
+    def __init__(self, code, message, locator=None):
+        super(CswError, self).__init__(message)
+        self.code = code
+        self.locator = locator
+
+class CswEmulator(object):
+    '''Answers CSW requests from a list of GEMINI documents'''
+
+    def __init__(self, documents, url='http://127.0.0.1:%i/csw' % PORT):
+        self.url = url
+        self.records = []
+        for document in documents:
+            tree = etree.fromstring(document)
+            if tree.tag != '{%s}MD_Metadata' % namespaces['gmd']:
+                tree = tree.find('.//{%s}MD_Metadata' % namespaces['gmd'])
+            identifier = tree.xpath('gmd:fileIdentifier/gco:CharacterString/text()',
+                                    namespaces=namespaces)[0].strip()
+            modified = (tree.xpath('gmd:dateStamp/*/text()', namespaces=namespaces)
+                        or [''])[0].strip()
+            self.records.append((identifier, modified, tree))
+        # Stable order for paging
+        self.records.sort(key=lambda record: record[0])
+        self.by_identifier = dict((record[0], record) for record in self.records)
+
+    @classmethod
+    def from_directory(cls, directory, **kwargs):
+        documents = []
+        for path in sorted(glob.glob(os.path.join(directory, '*.xml'))):
+            with open(path) as f:
+                documents.append(f.read())
+        return cls(documents, **kwargs)
+
+    def handle_kvp(self, params):
+        '''Handles a GET request. `params` is a dict of the (lower case)
+        parameters and their values.'''
+        request = params.get('request', '')
+        if request.lower() == 'getcapabilities':
+            return self.get_capabilities()
+        elif request.lower() == 'getrecords':
+            modified = None
+            match = re.search(r"modified\s*>=?\s*'([^']+)'", params.get('constraint', ''), re.I)
+            if match:
+                modified = match.group(1)
+            return self.get_records(
+                start_position=int(params.get('startposition') or 1),
+                max_records=int(params.get('maxrecords') or 10),
+                result_type=params.get('resulttype', 'results'),
+                element_set=params.get('elementsetname', 'summary'),
+                output_schema=params.get('outputschema', namespaces['csw']),
+                modified=modified)
+        elif request.lower() == 'getrecordbyid':
+            return self.get_record_by_id(
+                [id.strip() for id in params.get('id', '').split(',') if id.strip()],
+                element_set=params.get('elementsetname', 'full'))
+        raise CswError('OperationNotSupported', 'Request %s not supported' % request, 'request')
+
+    def handle_xml(self, body):
+        '''Handles a POST request with an XML body'''
+        try:
+            request = etree.fromstring(body)
+        except etree.XMLSyntaxError, e:
+            raise CswError('NoApplicableCode', 'Could not parse the request: %s' % e)
+
+        if request.tag == CSW + 'GetCapabilities':
+            return self.get_capabilities()
+        elif request.tag == CSW + 'GetRecords':
+            modified = None
+            for operator in ('PropertyIsGreaterThanOrEqualTo', 'PropertyIsGreaterThan'):
+                for comparison in request.iter(OGC + operator):
+                    name = comparison.findtext(OGC + 'PropertyName') or ''
+                    if 'modified' in name.lower():
+                        modified = (comparison.findtext(OGC + 'Literal') or '').strip()
+            return self.get_records(
+                start_position=int(request.get('startPosition') or 1),
+                max_records=int(request.get('maxRecords') or 10),
+                result_type=request.get('resultType', 'results'),
+                element_set=request.findtext('.//' + CSW + 'ElementSetName') or 'summary',
+                output_schema=request.get('outputSchema', namespaces['csw']),
+                modified=modified)
+        elif request.tag == CSW + 'GetRecordById':
+            return self.get_record_by_id(
+                [id.text.strip() for id in request.findall(CSW + 'Id')],
+                element_set=request.findtext(CSW + 'ElementSetName') or 'full')
+        raise CswError('OperationNotSupported', 'Request %s not supported' % request.tag, 'request')
+
+    def get_capabilities(self):
+        capabilities = etree.Element(CSW + 'Capabilities', nsmap=namespaces, version='2.0.2')
+        identification = etree.SubElement(capabilities, OWS + 'ServiceIdentification')
+        etree.SubElement(identification, OWS + 'Title').text = 'Local CSW emulator'
+        etree.SubElement(identification, OWS + 'ServiceType').text = 'CSW'
+        etree.SubElement(identification, OWS + 'ServiceTypeVersion').text = '2.0.2'
+        provider = etree.SubElement(capabilities, OWS + 'ServiceProvider')
+        etree.SubElement(provider, OWS + 'ProviderName').text = 'ckanext-inspire tests'
+        operations = etree.SubElement(capabilities, OWS + 'OperationsMetadata')
+        for name in ('GetCapabilities', 'GetRecords', 'GetRecordById'):
+            operation = etree.SubElement(operations, OWS + 'Operation', name=name)
+            http = etree.SubElement(etree.SubElement(operation, OWS + 'DCP'), OWS + 'HTTP')
+            for method in ('Get', 'Post'):
+                etree.SubElement(http, OWS + method).set(
+                    '{http://www.w3.org/1999/xlink}href', self.url)
+        return capabilities
+
+    def get_records(self, start_position=1, max_records=10, result_type='results',
+                    element_set='summary', output_schema=None, modified=None):
+        records = self.records
+        if modified:
+            records = [record for record in records if record[1] >= modified]
+
+        matched = len(records)
+        start_position = max(start_position, 1)
+        if result_type == 'hits':
+            page = []
+        else:
+            page = records[start_position - 1:start_position - 1 + max_records]
+        next_record = start_position + len(page)
+        if not page or next_record > matched:
+            next_record = 0
+
+        response = etree.Element(CSW + 'GetRecordsResponse', nsmap=namespaces, version='2.0.2')
+        etree.SubElement(response, CSW + 'SearchStatus',
+                         timestamp=datetime.now().isoformat())
+        results = etree.SubElement(response, CSW + 'SearchResults',
+                                   numberOfRecordsMatched=str(matched),
+                                   numberOfRecordsReturned=str(len(page)),
+                                   nextRecord=str(next_record),
+                                   elementSet=element_set)
+        for identifier, record_modified, tree in page:
+            results.append(self._element_set(tree, element_set))
+        return response
+
+    def get_record_by_id(self, identifiers, element_set='full'):
+        response = etree.Element(CSW + 'GetRecordByIdResponse', nsmap=namespaces)
+        for identifier in identifiers:
+            if identifier in self.by_identifier:
+                response.append(self._element_set(self.by_identifier[identifier][2], element_set))
+        return response
+
+    def _element_set(self, tree, element_set):
+        if element_set == 'full':
+            return etree.fromstring(etree.tostring(tree))
+        names = BRIEF_ELEMENTS if element_set == 'brief' else SUMMARY_ELEMENTS
+        record = etree.Element(tree.tag, nsmap=tree.nsmap)
+        for child in tree:
+            if etree.QName(child).localname in names:
+                record.append(etree.fromstring(etree.tostring(child)))
+        return record
+
+    def exception_report(self, error):
+        report = etree.Element(OWS + 'ExceptionReport', nsmap=namespaces, version='1.2.0')
+        exception = etree.SubElement(report, OWS + 'Exception', exceptionCode=error.code)
+        if error.locator:
+            exception.set('locator', error.locator)
+        etree.SubElement(exception, OWS + 'ExceptionText').text = str(error)
+        return report
+
+
+class CswRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        query = urlparse.urlparse(self.path).query
+        params = dict((key.lower(), values[0]) for key, values in
+                      urlparse.parse_qs(query).iteritems())
+        self._respond(lambda emulator: emulator.handle_kvp(params))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length') or 0))
+        self._respond(lambda emulator: emulator.handle_xml(body))
+
+    def _respond(self, handle):
+        server = self.server
+        server.count_request()
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.should_fail():
+            self._send(500, '<html><body>Internal Server Error</body></html>', 'text/html')
+            return
+
+        emulator = server.emulator
+        try:
+            status, response = 200, handle(emulator)
+        except CswError, e:
+            status, response = 400, emulator.exception_report(e)
+        self._send(status, etree.tostring(response, xml_declaration=True,
+                                          encoding='utf-8'))
+
+    def _send(self, status, body, content_type='application/xml'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CswHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, emulator, latency=0, failure_rate=0, seed=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CswRequestHandler)
+        self.emulator = emulator
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def should_fail(self):
+        with self._lock:
+            return self.failure_rate and self.random.random() < self.failure_rate
+
+
+def serve_csw(port=PORT, documents=None, directory=None, latency=0,
+              failure_rate=0, seed=None):
+    '''Serves a CSW with the given documents (or the ones in `directory`) at
+    http://127.0.0.1:<port>/csw, in a separate thread.
+
+    Each request is delayed by `latency` seconds and fails with a 500 error
+    with a probability of `failure_rate` (use a `seed` to get the same
+    failures on every run). Returns the server, call shutdown() to stop it.
+    '''
+    url = 'http://127.0.0.1:%i/csw' % port
+    if directory:
+        emulator = CswEmulator.from_directory(directory, url=url)
+    else:
+        emulator = CswEmulator(documents or [], url=url)
+
+    httpd = CswHTTPServer(('', port), emulator, latency, failure_rate, seed)
+    httpd_thread = threading.Thread(target=httpd.serve_forever)
+    httpd_thread.setDaemon(True)
+    httpd_thread.start()
+    return httpd
@@ -0,0 +1,241 @@
+'''
+HTTP server for the tests and benchmarks, serving the test files (or any
+directory) with configurable network conditions::
+
+    server = serve(8996, latency=0.1, bandwidth=100000, error_rate=0.05)
+    ...
+    server.shutdown()
+
+The conditions (see TestServer) apply to every request and can be changed
+while the server is running. Besides the files, it serves:
+
+* /waf/{count}/index.html: a WAF index page linking to `count` generated
+  GEMINI documents, which are served at /waf/{count}/{name}.xml
+* /wms/{name}: a WMS 1.1.1 GetCapabilities stand-in with one layer, so the
+  URL is detected as a WMS
+'''
+import os
+import re
+import logging
+import time
+import struct
+import random
+import socket
+import threading
+from StringIO import StringIO
+
+import SimpleHTTPServer
+import SocketServer
+from threading import Thread
+
+
+log = logging.getLogger(__name__)
+
+PORT = 8999
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'tests')
+
+WMS_CAPABILITIES = '''<?xml version="1.0" encoding="UTF-8"?>
+<WMT_MS_Capabilities version="1.1.1">
+  <Service>
+    <Name>OGC:WMS</Name>
+    <Title>Test WMS %(name)s</Title>
+    <OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="%(url)s"/>
+  </Service>
+  <Capability>
+    <Request>
+      <GetCapabilities>
+        <Format>application/vnd.ogc.wms_xml</Format>
+        <DCPType><HTTP><Get><OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="%(url)s?"/></Get></HTTP></DCPType>
+      </GetCapabilities>
+      <GetMap>
+        <Format>image/png</Format>
+        <DCPType><HTTP><Get><OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="%(url)s?"/></Get></HTTP></DCPType>
+      </GetMap>
+    </Request>
+    <Exception><Format>application/vnd.ogc.se_xml</Format></Exception>
+    <Layer>
+      <Title>Test WMS %(name)s</Title>
+      <SRS>EPSG:4326</SRS>
+      <LatLonBoundingBox minx="-8.0" miny="49.0" maxx="2.0" maxy="61.0"/>
+      <Layer queryable="0">
+        <Name>%(name)s</Name>
+        <Title>Test layer %(name)s</Title>
+        <SRS>EPSG:4326</SRS>
+        <LatLonBoundingBox minx="-8.0" miny="49.0" maxx="2.0" maxy="61.0"/>
+      </Layer>
+    </Layer>
+  </Capability>
+</WMT_MS_Capabilities>
+'''
+
+def waf_index(count, prefix='benchmark'):
+    '''Returns a WAF index page linking to `count` generated documents'''
+    from ckanext.inspire.benchmarks.corpus import RESOURCE_TYPES
+
+    links = []
+    for index in xrange(count):
+        name = '%s-%s-%06i.xml' % (prefix, RESOURCE_TYPES[index % len(RESOURCE_TYPES)], index)
+        links.append('<a href="%s">%s</a>' % (name, name))
+    return '<html><head><title>Index of generated WAF</title></head><body>\n' \
+           '%s\n</body></html>\n' % '\n'.join(links)
+
+class TestRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    waf_index_path = re.compile(r'^/waf/(\d+)/(index\.html)?$')
+    waf_document_path = re.compile(r'^/waf/(\d+)/(.+)-(dataset|series|service)-(\d+)\.xml$')
+
+    def send_head(self):
+        server = self.server
+        server.request_started()
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.should_happen(server.reset_rate):
+            self._reset()
+            return None
+        if server.should_happen(server.error_rate):
+            self.send_error(503, 'Service Unavailable')
+            return None
+
+        generated = self._generated()
+        if generated is not None:
+            content_type, body = generated
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            return StringIO(body)
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+    def _generated(self):
+        '''Returns the (content type, body) of the generated pages, or None'''
+        path = self.path.split('?', 1)[0]
+        match = self.waf_index_path.match(path)
+        if match:
+            return 'text/html', waf_index(int(match.group(1)))
+        match = self.waf_document_path.match(path)
+        if match:
+            from ckanext.inspire.benchmarks.corpus import generate_document
+            return 'application/xml', generate_document(
+                int(match.group(4)), match.group(3), prefix=match.group(2),
+                resource_url='http://127.0.0.1:%i/missing' % self.server.server_address[1])
+        if path.startswith('/wms/'):
+            name = path[len('/wms/'):].strip('/') or 'layer'
+            url = 'http://127.0.0.1:%i%s' % (self.server.server_address[1], path)
+            return 'application/vnd.ogc.wms_xml', WMS_CAPABILITIES % {'name': name, 'url': url}
+        return None
+
+    def copyfile(self, source, outputfile):
+        server = self.server
+        if server.first_byte_delay:
+            time.sleep(server.first_byte_delay)
+        if not server.bandwidth:
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+
+        # Send the body in chunks of a tenth of the bandwidth, each one
+        # taking as long as it would at that bandwidth
+        chunk_size = max(int(server.bandwidth / 10), 1)
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            time.sleep(len(chunk) / float(server.bandwidth))
+            outputfile.write(chunk)
+            outputfile.flush()
+
+    def translate_path(self, path):
+        # Serve from the server directory rather than the current one
+        path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
+        return os.path.join(self.server.directory, os.path.relpath(path, os.getcwd()))
+
+    def _reset(self):
+        '''Closes the connection with a TCP reset'''
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                   struct.pack('ii', 1, 0))
+        self.connection.close()
+        self.close_connection = 1
+
+    def finish(self):
+        try:
+            SimpleHTTPServer.SimpleHTTPRequestHandler.finish(self)
+        except socket.error:
+            # The connection was reset
+            pass
+        finally:
+            self.server.request_finished()
+
+    def log_message(self, format, *args):
+        pass
+
+class TestServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    '''Threaded server with these network conditions:
+
+    * latency: seconds before each request is handled
+    * first_byte_delay: seconds between the headers and the body
+    * bandwidth: bytes per second the bodies are sent at (unlimited if None)
+    * error_rate: probability of a request failing with a 503 error
+    * reset_rate: probability of a connection being reset
+
+    It also counts the requests and the maximum number of them handled at
+    the same time.
+    '''
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, directory, seed=None, **conditions):
+        SocketServer.TCPServer.__init__(self, address, TestRequestHandler)
+        self.directory = directory
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        self.latency = 0
+        self.first_byte_delay = 0
+        self.bandwidth = None
+        self.error_rate = 0
+        self.reset_rate = 0
+        self.set_conditions(**conditions)
+
+    def set_conditions(self, **conditions):
+        for name, value in conditions.iteritems():
+            if not name in ('latency', 'first_byte_delay', 'bandwidth',
+                            'error_rate', 'reset_rate'):
+                raise TypeError('Unknown network condition %s' % name)
+            setattr(self, name, value)
+
+    def should_happen(self, probability):
+        if not probability:
+            return False
+        with self._lock:
+            return self.random.random() < probability
+
+    def request_started(self):
+        with self._lock:
+            self.requests += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def request_finished(self):
+        with self._lock:
+            self.active = max(self.active - 1, 0)
+
+def serve(port=PORT, directory=None, seed=None, **conditions):
+    '''Serves test files (or the files in `directory`) over HTTP, with the
+    network conditions given (see TestServer). Returns the server, call
+    shutdown() on it to stop it.'''
+
+    # Serve the test files by default
+    directory = os.path.abspath(directory or TESTS_DIR)
+
+    httpd = TestServer(("", port), directory, seed, **conditions)
+
+    log.info('Serving test HTTP server at port %i' % port)
+
+    httpd_thread = Thread(target=httpd.serve_forever)
+    httpd_thread.setDaemon(True)
+    httpd_thread.start()
+    return httpd
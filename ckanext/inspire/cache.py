@@ -0,0 +1,61 @@
+'''
+Small in-process caches shared by the INSPIRE controllers and harvesters
+'''
+from threading import Lock
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    from sqlalchemy.util import OrderedDict
+
+
+class BoundedCache(object):
+    '''A thread-safe, least recently used cache holding at most `size` entries.
+
+    Only meant for values keyed by something immutable (e.g. a harvest object
+    id and a hash of its content), as there is no expiry other than eviction.
+    '''
+
+    def __init__(self, size=500):
+        self.size = max(int(size), 0)
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Re-insert to mark as the most recently used
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if not self.size:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                del self._data[iter(self._data).next()]
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,138 @@
+'''
+Storage codec for the content of harvest objects.
+
+GEMINI documents are verbose and compress very well, so when the
+ckan.inspire.compress_content option is enabled, the harvesters store the
+content zlib compressed (and base64 encoded, as the column is text), with a
+prefix marking it as such. Anything reading the content of a harvest object
+should use decode_content, which returns uncompressed content unchanged, so
+both kinds of objects can live in the same table.
+
+When the ckan.inspire.deduplicate_content option is enabled, documents are
+stored once in the inspire_content_blob table, keyed by their canonical hash,
+and the content of the harvest objects is just a reference to the blob.
+decode_content resolves these references too.
+
+Superseded versions of a record can also be stored as deltas against the
+next version of the same GUID (see delta_content and the delta-versions
+command). decode_content rebuilds them by applying the deltas to that
+version, which might itself be a delta against the next one.
+'''
+import re
+import zlib
+import base64
+import difflib
+
+from pylons import config
+from paste.deploy.converters import asbool
+
+from ckan.lib.helpers import json
+
+PREFIX = u'zlib:'
+BLOB_PREFIX = u'blob:'
+DELTA_PREFIX = u'delta:'
+
+def compression_enabled():
+    return asbool(config.get('ckan.inspire.compress_content', False))
+
+def deduplication_enabled():
+    return asbool(config.get('ckan.inspire.deduplicate_content', False))
+
+def is_reference(content):
+    return content is not None and content.startswith(BLOB_PREFIX)
+
+def reference_content(content_hash):
+    '''Returns the content to store for a harvest object whose document is
+    in the content blob with this hash'''
+    return BLOB_PREFIX + content_hash
+
+def is_delta(content):
+    return content is not None and content.startswith(DELTA_PREFIX)
+
+def is_encoded(content):
+    return content is not None and content.startswith(PREFIX)
+
+def encode_content(content, force=False):
+    '''Returns the content to store for a harvest object, compressed if the
+    compression is enabled (or `force` is True)'''
+    if content is None or is_encoded(content) or is_reference(content) or \
+       is_delta(content) or \
+       not (force or compression_enabled()):
+        return content
+    if isinstance(content, unicode):
+        content = content.encode('utf8')
+    return PREFIX + base64.b64encode(zlib.compress(content, 6)).decode('ascii')
+
+def decode_content(content):
+    '''Returns the content of a harvest object as unicode, uncompressing it,
+    loading it from its content blob or rebuilding it from its delta if
+    needed'''
+    # Deltas are rebuilt from the oldest one, once the first version stored
+    # in full is found
+    deltas = []
+    while is_delta(content):
+        base_id, delta = content[len(DELTA_PREFIX):].split(u':', 1)
+        deltas.append(json.loads(delta))
+        content = _get_harvest_object_content(base_id)
+
+    if is_reference(content):
+        from ckanext.inspire.model.harvest import ContentBlob
+        blob = ContentBlob.get(content[len(BLOB_PREFIX):])
+        if blob is None:
+            raise ValueError('Content blob %s not found' % content[len(BLOB_PREFIX):])
+        content = decode_content(blob.content)
+    elif is_encoded(content):
+        content = zlib.decompress(base64.b64decode(content[len(PREFIX):])).decode('utf8')
+
+    if deltas and isinstance(content, str):
+        content = content.decode('utf8')
+    for delta in reversed(deltas):
+        content = apply_delta(content, delta)
+    return content
+
+def _get_harvest_object_content(harvest_object_id):
+    from ckan.model import Session
+    from ckanext.harvest.model import harvest_object_table
+
+    content = Session.execute(
+        harvest_object_table.select()
+        .with_only_columns([harvest_object_table.c.content])
+        .where(harvest_object_table.c.id==harvest_object_id)).scalar()
+    if content is None:
+        raise ValueError('Base content %s of delta not found' % harvest_object_id)
+    return content
+
+def _tokens(content):
+    # XML documents are often stored in a single line, so they are compared
+    # tag by tag rather than line by line
+    return re.findall(r'[^>]*>|[^>]+', content)
+
+def make_delta(base, content):
+    '''Returns the operations to rebuild `content` from `base`: ranges of
+    tokens to copy from `base` and text to insert'''
+    base_tokens = _tokens(base)
+    tokens = _tokens(content)
+    matcher = difflib.SequenceMatcher(None, base_tokens, tokens, autojunk=False)
+    delta = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append([i1, i2])
+        elif j2 > j1:
+            delta.append(u''.join(tokens[j1:j2]))
+    return delta
+
+def apply_delta(base, delta):
+    base_tokens = _tokens(base)
+    parts = []
+    for op in delta:
+        if isinstance(op, list):
+            parts.extend(base_tokens[op[0]:op[1]])
+        else:
+            parts.append(op)
+    return u''.join(parts)
+
+def delta_content(base_id, base, content):
+    '''Returns the content to store for a harvest object as a delta against
+    the (decoded) content of the harvest object `base_id`'''
+    delta = json.dumps(make_delta(base, content), separators=(',', ':'))
+    return DELTA_PREFIX + base_id + u':' + delta
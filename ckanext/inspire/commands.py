@@ -0,0 +1,336 @@
+import sys
+import time
+import logging
+
+from pylons import config
+
+from ckan.lib.cli import CkanCommand
+
+log = logging.getLogger(__name__)
+
+class InspireCommand(CkanCommand):
+    '''Maintenance tasks for the INSPIRE harvesters
+
+    Usage:
+
+      inspire initdb
+        - Creates the tables and database indexes used by the INSPIRE
+          harvesters
+
+      inspire check-queries
+        - Shows the query plans of the queries run on every import, and
+          exits with an error if any of them does a sequential scan on a
+          big table
+
+      inspire import {job-id} [{batch-size}] [{processes}]
+        - Imports the objects of a harvest job committing once every
+          batch-size objects (100 by default), instead of once per object.
+          If processes is greater than 1, the documents are parsed,
+          validated and mapped in that number of processes.
+
+      inspire gather-shards [--every=MINUTES]
+        - Gathers the shards of the CSW sources harvested in sharded mode
+          (see ckan.inspire.csw.shard_size) waiting to be gathered. With
+          --every it keeps running, looking for new shards every MINUTES
+          minutes.
+
+      inspire timings {job-or-source-id}
+        - Shows the number of times each step of the harvesting (HTTP
+          requests, parsing, validation, package writes...) was run for a
+          job, or all the jobs of a source, and how long it took
+
+      inspire trace {job-id} [--output=FILE]
+        - Writes the spans recorded for a job traced with ckan.inspire.trace
+          in the Chrome trace event format (to be opened with
+          chrome://tracing or Perfetto)
+
+      inspire index-pending [{batch-size}]
+        - Indexes the packages written during bulk imports that have not
+          been indexed yet (e.g. because the import process died)
+
+      inspire compact [--keep=N] [--archive] [--every=MINUTES]
+        - Deletes the harvest objects superseded by newer versions of the
+          same GUID, keeping the current one and the last N versions (5
+          by default, or ckan.inspire.compaction.keep). With --archive
+          only their content is removed. With --every it keeps running,
+          compacting every MINUTES minutes.
+
+      inspire delta-versions
+        - Stores the superseded versions of each record as deltas against
+          the next version, keeping the latest one in full. They are
+          rebuilt when their content is read.
+
+      inspire compress-content [--decompress]
+        - Compresses the content of the harvest objects stored before
+          ckan.inspire.compress_content was enabled. With --decompress,
+          uncompresses all of them (do it before disabling the option).
+
+      inspire benchmark [{count}] [--size=BYTES] [--only=NAMES] [--output=FILE]
+                        [--latency=SECONDS] [--failure-rate=RATE]
+        - Runs the performance benchmarks on a synthetic corpus of count
+          documents (1000 by default), optionally padded to BYTES bytes, and
+          writes the results as JSON. --only takes a comma separated list
+          of benchmarks (read_values, validator, get_gemini_string_and_guid,
+          harvest, csw). The harvest and csw benchmarks write to the
+          database, so run them against a scratch one. --latency and
+          --failure-rate apply to the requests to the local CSW server.
+
+    The commands should be run from the ckanext-inspire directory and expect
+    a development.ini file to be present. Most of the time you will
+    specify the config explicitly though::
+
+        paster inspire index-pending --config=../ckan/development.ini
+
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 4
+    min_args = 1
+
+    def __init__(self, name):
+        super(InspireCommand, self).__init__(name)
+        self.parser.add_option('--keep', dest='keep', type='int', default=None,
+            help='Number of superseded versions of each record to keep')
+        self.parser.add_option('--archive', dest='archive', action='store_true',
+            default=False, help='Remove only the content of superseded objects')
+        self.parser.add_option('--every', dest='every', type='int', default=None,
+            help='Keep running, repeating the command every this number of minutes')
+        self.parser.add_option('--size', dest='size', type='int', default=None,
+            help='Size of the benchmark documents, in bytes')
+        self.parser.add_option('--only', dest='only', default=None,
+            help='Comma separated list of the benchmarks to run')
+        self.parser.add_option('--output', dest='output', default=None,
+            help='File to write the benchmark results or trace to')
+        self.parser.add_option('--latency', dest='latency', type='float', default=0,
+            help='Seconds each request to the benchmark servers takes')
+        self.parser.add_option('--failure-rate', dest='failure_rate', type='float',
+            default=0, help='Ratio of requests to the benchmark servers that fail')
+        self.parser.add_option('--decompress', dest='decompress', action='store_true',
+            default=False, help='Uncompress the content of harvest objects')
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+        if cmd == 'initdb':
+            self.initdb()
+        elif cmd == 'check-queries':
+            self.check_queries()
+        elif cmd == 'import':
+            self.import_job()
+        elif cmd == 'gather-shards':
+            self.gather_shards()
+        elif cmd == 'timings':
+            self.timings()
+        elif cmd == 'trace':
+            self.trace()
+        elif cmd == 'index-pending':
+            self.index_pending()
+        elif cmd == 'compact':
+            self.compact()
+        elif cmd == 'delta-versions':
+            self.delta_versions()
+        elif cmd == 'compress-content':
+            self.compress_content()
+        elif cmd == 'benchmark':
+            self.benchmark()
+        else:
+            print 'Command %s not recognized' % cmd
+            sys.exit(1)
+
+    def _load_config(self):
+        super(InspireCommand, self)._load_config()
+
+        from ckanext.inspire.model.harvest import setup
+        setup()
+
+    def initdb(self):
+        from ckanext.inspire.maintenance import create_indexes
+
+        # Tables are created when loading the config
+        print 'INSPIRE tables created'
+        for name in create_indexes():
+            print 'Created index %s' % name
+
+    def check_queries(self):
+        from ckanext.inspire.maintenance import check_query_plans
+
+        failed = 0
+        for description, plan, ok in check_query_plans():
+            print '%s: %s' % (description, 'OK' if ok else 'SEQUENTIAL SCAN')
+            print plan
+            print
+            if not ok:
+                failed += 1
+        if failed:
+            print '%i queries are not using an index, run "paster inspire initdb"' % failed
+            sys.exit(1)
+
+    def import_job(self):
+        from ckan import plugins
+        from ckan.model import Session
+        from ckanext.harvest.interfaces import IHarvester
+        from ckanext.harvest.model import HarvestJob, HarvestObject
+
+        if len(self.args) < 2:
+            print 'Please provide a job id'
+            sys.exit(1)
+        job = HarvestJob.get(unicode(self.args[1]))
+        if not job:
+            print 'Job %s not found' % self.args[1]
+            sys.exit(1)
+        batch_size = int(self.args[2]) if len(self.args) > 2 else 100
+        processes = int(self.args[3]) if len(self.args) > 3 else 1
+
+        harvester = None
+        for plugin in plugins.PluginImplementations(IHarvester):
+            if plugin.info()['name'] == job.source.type:
+                harvester = plugin
+                break
+        if not hasattr(harvester, 'import_batch'):
+            print 'The harvester for source type %s does not support batch imports' % job.source.type
+            sys.exit(1)
+
+        object_ids = [id for id, in Session.query(HarvestObject.id) \
+                      .filter(HarvestObject.harvest_job_id==job.id) \
+                      .filter(HarvestObject.content!=None)]
+        print 'Importing %i objects from job %s' % (len(object_ids), job.id)
+
+        pool = harvester.get_import_pool(processes) if processes > 1 else None
+        try:
+            imported = 0
+            for i in range(0, len(object_ids), batch_size):
+                objects = Session.query(HarvestObject) \
+                          .filter(HarvestObject.id.in_(object_ids[i:i + batch_size])) \
+                          .all()
+                imported += harvester.import_batch(objects, batch_size, pool=pool)
+                print 'Imported %i objects' % imported
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if harvester._bulk_import():
+            from ckanext.inspire import indexing
+            print 'Indexed %i packages' % indexing.index_pending()
+
+    def gather_shards(self):
+        from ckanext.inspire.harvesters import GeminiCswHarvester
+
+        harvester = GeminiCswHarvester()
+        while True:
+            shard = harvester.claim_gather_shard()
+            if shard is not None:
+                gathered = harvester.gather_shard(shard)
+                print 'Gathered %i identifiers (records %i to %i of job %s)' % \
+                    (gathered, shard.start_position, shard.end_position,
+                     shard.harvest_job_id)
+                continue
+            if not self.options.every:
+                break
+            time.sleep(self.options.every * 60)
+
+    def timings(self):
+        from ckanext.harvest.model import HarvestJob
+        from ckanext.inspire import timing
+
+        if len(self.args) < 2:
+            print 'Please provide a job or source id'
+            sys.exit(1)
+        id = unicode(self.args[1])
+        if HarvestJob.get(id):
+            timings = timing.get_job_timings(id)
+        else:
+            timings = timing.get_source_timings(id)
+        if not timings:
+            print 'No timings recorded for %s' % id
+            sys.exit(1)
+
+        print '%-16s %8s %10s %8s %8s %8s %8s' % \
+            ('step', 'count', 'total', 'mean', 'p50', 'p95', 'max')
+        for step, summary in sorted(timings.iteritems(),
+                                    key=lambda item: -item[1]['total']):
+            print '%-16s %8i %10.2f %8.3f %8.3f %8.3f %8.3f' % \
+                (step, summary['count'], summary['total'], summary['mean'],
+                 summary['p50'], summary['p95'], summary['max'])
+
+    def trace(self):
+        from ckan.lib.helpers import json
+        from ckanext.inspire import timing
+
+        if len(self.args) < 2:
+            print 'Please provide a job id'
+            sys.exit(1)
+        trace = timing.get_job_trace(unicode(self.args[1]))
+        if not trace['traceEvents']:
+            print 'No spans recorded for job %s, is it listed in ckan.inspire.trace?' % self.args[1]
+            sys.exit(1)
+
+        output = json.dumps(trace)
+        if self.options.output:
+            with open(self.options.output, 'w') as f:
+                f.write(output)
+            print 'Trace written to %s' % self.options.output
+        else:
+            print output
+
+    def index_pending(self):
+        from ckanext.inspire import indexing
+
+        batch_size = int(self.args[1]) if len(self.args) > 1 else 1000
+        print 'Packages pending to be indexed: %i' % indexing.pending_count()
+        indexed = indexing.index_pending(batch_size)
+        print 'Indexed %i packages' % indexed
+
+    def compact(self):
+        from ckanext.inspire.maintenance import compact_harvest_objects
+
+        keep = self.options.keep
+        if keep is None:
+            keep = int(config.get('ckan.inspire.compaction.keep', 5))
+
+        while True:
+            removed = compact_harvest_objects(keep, archive=self.options.archive)
+            print '%s %i superseded harvest objects' % \
+                ('Archived' if self.options.archive else 'Deleted', removed)
+            if not self.options.every:
+                break
+            time.sleep(self.options.every * 60)
+
+    def delta_versions(self):
+        from ckanext.inspire.maintenance import delta_encode_versions
+
+        stored = delta_encode_versions()
+        print 'Stored %i superseded harvest objects as deltas' % stored
+
+    def compress_content(self):
+        from ckanext.inspire.maintenance import compress_contents
+
+        changed = compress_contents(decompress=self.options.decompress)
+        print '%s the content of %i harvest objects' % \
+            ('Uncompressed' if self.options.decompress else 'Compressed', changed)
+
+    def benchmark(self):
+        from ckan.lib.helpers import json
+        from ckanext.inspire import benchmarks
+
+        count = int(self.args[1]) if len(self.args) > 1 else 1000
+        names = benchmarks.BENCHMARKS
+        if self.options.only:
+            names = [name.strip() for name in self.options.only.split(',')]
+            for name in names:
+                if not name in benchmarks.BENCHMARKS:
+                    print 'Unknown benchmark %s' % name
+                    sys.exit(1)
+
+        results = benchmarks.run(count, self.options.size, names,
+                                 latency=self.options.latency,
+                                 failure_rate=self.options.failure_rate)
+        output = json.dumps(results, indent=2)
+        if self.options.output:
+            with open(self.options.output, 'w') as f:
+                f.write(output)
+            print 'Results written to %s' % self.options.output
+        else:
+            print output
@@ -1,18 +1,32 @@
 try: from cStringIO import StringIO
 except ImportError: from StringIO import StringIO
-from pylons import response
+import hashlib
+from pylons import response, config
+from pylons.controllers.util import etag_cache
 from pkg_resources import resource_stream, resource_filename
 from lxml import etree
 from ckan.model.meta import Session
 from ckan.model import Package,PackageExtra
 from ckan.lib.base import abort
+from ckan.lib.helpers import json
 
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObject, HarvestJob, HarvestSource
+from ckanext.inspire.model import GeminiDocument
+from ckanext.inspire.cache import BoundedCache
+from ckanext.inspire.codec import decode_content
+from ckanext.inspire import stats as harvest_stats
+from ckanext.inspire import timing
 
 from ckan.controllers.api import ApiController as BaseApiController
 
 log = __import__("logging").getLogger(__name__)
 
+# Values extracted from the content of harvest objects. The content is
+# rewritten by the compact (--archive), compress-content and delta-versions
+# commands, which run in other processes, so entries are keyed on the object
+# id and a hash of its stored content rather than just the id.
+values_cache = BoundedCache(config.get('ckan.inspire.values_cache_size', 500))
+
 class ApiController(BaseApiController):
 
     def _get_harvest_object(self,id):
@@ -26,9 +40,10 @@ class ApiController(BaseApiController):
 
         if obj is None:
             abort(404)
+        content = decode_content(obj.content)
         response.content_type = "application/xml"
-        response.headers["Content-Length"] = len(obj.content)
-        return obj.content
+        response.headers["Content-Length"] = len(content)
+        return content
 
     def display_html(self,id):
         obj = self._get_harvest_object(id)
@@ -41,7 +56,82 @@ class ApiController(BaseApiController):
                              "xml/gemini2-html-stylesheet.xsl") as style:
             style_xml = etree.parse(style)
             transformer = etree.XSLT(style_xml)
-        xml = etree.parse(StringIO(obj.content.encode("utf-8")))
+        xml = etree.parse(StringIO(decode_content(obj.content).encode("utf-8")))
         html = transformer(xml)
         return etree.tostring(html, pretty_print=True)
 
+    def display_values(self,id):
+        '''Returns the values extracted from the GEMINI document of a harvest
+        object (ie the output of GeminiDocument.read_values) as JSON'''
+        obj = self._get_harvest_object(id)
+
+        if obj is None or obj.content is None:
+            abort(404)
+
+        key = (id, hashlib.sha1(obj.content.encode('utf-8')).hexdigest())
+        cached = values_cache.get(key)
+        if cached is None:
+            values = GeminiDocument(decode_content(obj.content)).read_values()
+            values_json = json.dumps(values)
+            cached = (hashlib.sha1(values_json).hexdigest(), values_json)
+            values_cache.set(key, cached)
+
+        etag, values_json = cached
+        # Returns a 304 straight away if the client already has this version
+        etag_cache(etag)
+
+        response.content_type = "application/json; charset=utf-8"
+        response.headers["Content-Length"] = len(values_json)
+        return values_json
+
+    def _json_response(self, data):
+        body = json.dumps(data)
+        response.content_type = "application/json; charset=utf-8"
+        response.headers["Content-Length"] = len(body)
+        return body
+
+    def _get_active_sources(self):
+        return Session.query(HarvestSource) \
+                      .filter(HarvestSource.active==True) \
+                      .all()
+
+    def job_stats(self,id):
+        '''Returns the performance statistics of a harvest job as JSON'''
+        job = HarvestJob.get(id)
+        if job is None:
+            abort(404)
+        return self._json_response(harvest_stats.get_job_stats(job))
+
+    def job_trace(self,id):
+        '''Returns the spans recorded for a traced harvest job in the Chrome
+        trace event format'''
+        job = HarvestJob.get(id)
+        if job is None:
+            abort(404)
+        return self._json_response(timing.get_job_trace(job.id))
+
+    def source_stats(self,id):
+        '''Returns the performance statistics of all the jobs of a harvest
+        source, and of its last jobs, as JSON'''
+        source = HarvestSource.get(id)
+        if source is None:
+            abort(404)
+        return self._json_response(harvest_stats.get_source_stats(source))
+
+    def stats(self):
+        '''Returns the statistics of the active sources (with their last
+        job) and of the caches of this process as JSON'''
+        return self._json_response({
+            'sources': [harvest_stats.get_source_stats(source, last_jobs=1)
+                        for source in self._get_active_sources()],
+            'caches': harvest_stats.get_cache_stats({'values': values_cache}),
+        })
+
+    def metrics(self):
+        '''Returns the statistics of the last job of each active source in
+        the Prometheus text format'''
+        body = harvest_stats.prometheus_metrics(self._get_active_sources(),
+                                                caches={"values": values_cache}).encode("utf-8")
+        response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+        response.headers["Content-Length"] = len(body)
+        return body
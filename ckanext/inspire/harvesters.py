@@ -11,17 +11,24 @@ TODO: Harvesters for generic INSPIRE CSW servers
 from lxml import etree
 import urllib2
 from urlparse import urlparse
-from datetime import datetime
+from datetime import datetime, timedelta
 from string import Template
 from numbers import Number
 import sys
 import uuid
 import os
+import time
+import socket
+import hashlib
 import logging
+import multiprocessing
+import threading
 
 from pylons import config
-from sqlalchemy.sql import update,and_, bindparam
-from sqlalchemy.exc import InvalidRequestError
+from paste.deploy.converters import asbool
+from sqlalchemy.sql import update,and_,or_, bindparam, func
+from sqlalchemy.exc import InvalidRequestError, IntegrityError
+from sqlalchemy.orm import defer
 
 from ckan import model
 from ckan.model import Session, repo, \
@@ -29,6 +36,7 @@ from ckan.model import Session, repo, \
                         setup_default_user_roles
 from ckan.lib.munge import munge_title_to_name
 from ckan.plugins.core import SingletonPlugin, implements
+from ckan.plugins import IConfigurable
 from ckan.lib.helpers import json
 
 from ckan import logic
@@ -36,10 +44,18 @@ from ckan.logic import get_action, ValidationError
 from ckan.lib.navl.validators import not_empty, ignore_missing
 
 from ckanext.harvest.interfaces import IHarvester
-from ckanext.harvest.model import HarvestObject, HarvestGatherError, \
-                                    HarvestObjectError
+from ckanext.harvest.model import HarvestJob, HarvestObject, \
+                                    HarvestGatherError, HarvestObjectError
 
 from ckanext.inspire.model import GeminiDocument
+from ckanext.inspire import indexing, parsing
+from ckanext.inspire.timing import timed, stage, increment
+from ckanext.inspire.codec import encode_content, decode_content, \
+                                  deduplication_enabled, reference_content
+from ckanext.inspire.model.harvest import HarvestObjectInfo, ContentBlob, \
+                                         GatherCheckpoint, GatherShard, \
+                                         gather_shard_table, \
+                                         setup as inspire_model_setup
 
 from owslib import wms
 
@@ -67,35 +83,169 @@ def text_traceback():
 # exceptions, rather them being caught.
 debug_exception_mode = bool(os.getenv('DEBUG'))
 
+def get_validator_profiles():
+    return [
+        x.strip() for x in
+        config.get(
+            'ckan.inspire.validator.profiles',
+            'iso19139,gemini2',
+        ).split(',')
+    ]
+
+def parse_gemini_string(gemini_string, validator):
+    '''Parses, validates and maps a GEMINI document.
+
+    This is the CPU bound part of the import stage. It doesn't touch the
+    database, so it can be run in a separate process. Returns a dict with
+    the validation results (`valid`, `messages`), the re-serialized document
+    (`content`) and, unless the mapping failed (in which case there is an
+    `error` key), the document `values` and `content_hash`.
+    '''
+    with timed('xml_parse'):
+        xml = parsing.parse(gemini_string)
+
+    with timed('validation'):
+        valid, messages = validator.is_valid(xml)
+
+    unicode_gemini_string = etree.tostring(xml, encoding=unicode, pretty_print=True)
+
+    parsed = {
+        'valid': valid,
+        'messages': messages,
+        'content': unicode_gemini_string,
+    }
+    try:
+        with timed('mapping'):
+            gemini_document = GeminiDocument(unicode_gemini_string)
+            parsed['values'] = gemini_document.read_values()
+            parsed['content_hash'] = gemini_document.get_canonical_hash()
+    except Exception, e:
+        log.error('Exception reading the document values: %s' % text_traceback())
+        parsed['error'] = str(e)
+    return parsed
+
+# Validator of each process of the import pool
+_worker_validator = None
+
+def _init_import_worker(profiles):
+    global _worker_validator
+    _worker_validator = Validator(profiles=profiles)
+
+def _parse_in_worker(gemini_string):
+    try:
+        return parse_gemini_string(gemini_string, _worker_validator)
+    except Exception, e:
+        # Exceptions are not always picklable
+        return {'error': str(e)}
+
+class GuidLocked(Exception):
+    '''Raised when importing an object in a batch whose GUID is locked by
+    another importer (see GeminiHarvester._lock_guid)'''
+
+class HarvestContext(object):
+    '''State of a single gather, fetch or import call.
+
+    Harvesters are singleton plugins, so anything specific to the job or
+    object being processed is kept here and passed around rather than
+    stored on the harvester. This allows several threads to use the same
+    harvester at once.
+    '''
+
+    def __init__(self, harvest_job=None, harvest_object=None, import_batch=None):
+        self.harvest_job = harvest_job
+        self.harvest_object = harvest_object
+        # Set when the object is imported as part of import_batch
+        self.import_batch = import_batch
+        # (message, stage) of the errors saved for the object in a batch,
+        # which are lost if its savepoint is rolled back
+        self.object_errors = []
+
+class GatheredIds(object):
+    '''Ids of the harvest objects created by a gather stage.
+
+    Gather stages normally return all the ids at the end, so fetching and
+    importing can't start until the whole source has been gathered. In
+    streaming mode (when ckan.inspire.gather.chunk_size is set), the ids are
+    sent to the fetch queue in chunks of that size as they are added.
+
+    The gather stage returns the ids not sent yet (`pending`) as usual. At
+    least one is always kept back, so a job whose ids were all streamed
+    doesn't look empty to ckanext-harvest.
+
+    Each id can be added with the `progress` of the gather stage at that
+    point, which is passed to `on_queue` once the id has been sent, so the
+    gather can checkpoint it.
+    '''
+
+    def __init__(self, chunk_size=None, on_queue=None):
+        if chunk_size is None:
+            chunk_size = int(config.get('ckan.inspire.gather.chunk_size', 0))
+        self.chunk_size = chunk_size
+        self.on_queue = on_queue
+        self.pending = []
+        self._pending_progress = []
+        self.count = 0
+
+    def append(self, object_id, progress=None):
+        self.pending.append(object_id)
+        self._pending_progress.append(progress)
+        self.count += 1
+        if self.chunk_size and len(self.pending) > self.chunk_size:
+            self._queue(self.pending[:self.chunk_size])
+            progress = self._pending_progress[self.chunk_size - 1]
+            self.pending = self.pending[self.chunk_size:]
+            self._pending_progress = self._pending_progress[self.chunk_size:]
+            if self.on_queue is not None:
+                self.on_queue(progress)
+
+    def _queue(self, object_ids):
+        from ckanext.harvest.queue import get_fetch_publisher
+        publisher = get_fetch_publisher()
+        try:
+            for object_id in object_ids:
+                publisher.send({'harvest_object_id': object_id})
+        finally:
+            publisher.close()
+        log.debug('Sent %i harvest objects to the fetch queue' % len(object_ids))
+
+    def __len__(self):
+        return self.count
+
+# Validators are expensive to create and not safe to share between threads,
+# so each thread gets its own
+_thread_validators = threading.local()
+
 class SpatialHarvester(object):
     # Q: Why does this not inherit from HarvesterBase in ckanext-harvest?
 
     def _is_wms(self,url):
         try:
-            capabilities_url = wms.WMSCapabilitiesReader().capabilities_url(url)
-            res = urllib2.urlopen(capabilities_url,None,10)
-            xml = res.read()
+            with timed('wms_check', url=url):
+                capabilities_url = wms.WMSCapabilitiesReader().capabilities_url(url)
+                res = urllib2.urlopen(capabilities_url,None,10)
+                xml = parsing.spool_response(res, capabilities_url).read()
 
-            s = wms.WebMapService(url,xml=xml)
-            return isinstance(s.contents, dict) and s.contents != {}
+                s = wms.WebMapService(url,xml=xml)
+                return isinstance(s.contents, dict) and s.contents != {}
         except Exception, e:
+            increment('wms_check_errors')
             log.error('WMS check for %s failed with exception: %s' % (url, str(e)))
         return False
 
     def _get_validator(self):
-        if not hasattr(self, '_validator'):
-            profiles = [
-                x.strip() for x in
-                config.get(
-                    'ckan.inspire.validator.profiles',
-                    'iso19139,gemini2',
-                ).split(',')
-            ]
-            self._validator = Validator(profiles=profiles)
-        return self._validator
+        # A validator can also be set explicitly, e.g. in the tests
+        if getattr(self, '_validator', None) is not None:
+            return self._validator
+        validator = getattr(_thread_validators, 'validator', None)
+        if validator is None:
+            validator = Validator(profiles=get_validator_profiles())
+            _thread_validators.validator = validator
+        return validator
 
     def _save_gather_error(self,message,job):
-        err = HarvestGatherError(message=message,job=job)
+        # Setting the job id rather than the job, the errors would otherwise
+        # be kept in memory in job.gather_errors until the gather is over
+        err = HarvestGatherError(message=message,harvest_job_id=getattr(job, 'id', None))
         try:
             err.save()
         except InvalidRequestError:
@@ -104,8 +254,14 @@ class SpatialHarvester(object):
         finally:
             log.error(message)
 
-    def _save_object_error(self,message,obj,stage=u'Fetch'):
+    def _save_object_error(self,message,obj,stage=u'Fetch',harvest_context=None):
         err = HarvestObjectError(message=message,object=obj,stage=stage)
+        if harvest_context is not None and harvest_context.import_batch is not None:
+            # Saved when the whole batch is committed
+            Session.add(err)
+            harvest_context.object_errors.append((message, stage))
+            log.error(message)
+            return
         try:
             err.save()
         except InvalidRequestError,e:
@@ -115,9 +271,24 @@ class SpatialHarvester(object):
             log.error(message)
 
     def _get_content(self, url):
+        content_file = self._open_content(url)
+        try:
+            return content_file.read()
+        finally:
+            content_file.close()
+
+    def _open_content(self, url):
+        '''Fetches a document into a temporary file, which is returned open
+        (see parsing.spool_response). Raises parsing.DocumentTooLarge
+        if it is bigger than ckan.inspire.max_document_size.'''
         url = url.replace(' ','%20')
-        http_response = urllib2.urlopen(url)
-        return http_response.read()
+        with timed('http', url=url):
+            http_response = urllib2.urlopen(url)
+            content_file = parsing.spool_response(http_response, url)
+        content_file.seek(0, os.SEEK_END)
+        increment('bytes_fetched', content_file.tell())
+        content_file.seek(0)
+        return content_file
 
 class GeminiHarvester(SpatialHarvester):
     '''Base class for spatial harvesting GEMINI2 documents for the UK Location
@@ -128,10 +299,199 @@ class GeminiHarvester(SpatialHarvester):
 
     force_import = False
 
+    # Index the packages in batches rather than as they are written. Can also
+    # be enabled with the ckan.inspire.bulk_import config option.
+    bulk_import = False
+
     extent_template = Template('''
     {"type":"Polygon","coordinates":[[[$minx, $miny],[$minx, $maxy], [$maxx, $maxy], [$maxx, $miny], [$minx, $miny]]]}
     ''')
 
+    def configure(self, config):
+        inspire_model_setup()
+
+    def get_import_pool(self, processes=None):
+        '''Returns a pool of processes to parse, validate and map documents
+        for import_batch. Each process keeps its own validator.'''
+        return multiprocessing.Pool(processes, _init_import_worker,
+                                    (get_validator_profiles(),))
+
+    def import_batch(self, harvest_objects, batch_size=100, pool=None):
+        '''Imports several harvest objects, committing once every `batch_size`
+        objects rather than once (or more) per object.
+
+        Each object is imported inside a savepoint, so an object that fails
+        is rolled back on its own and gets its error saved, without
+        affecting the rest of the batch. If the failure rolled back the whole
+        transaction instead (CKAN's package actions roll back the session on
+        validation errors), the objects imported before it in the batch are
+        imported again. The objects that become the current ones are flagged
+        in a single update per batch.
+
+        Objects whose GUID is locked by another importer are not waited for,
+        as the other importer may be waiting for a GUID of this batch. They
+        (and any later version of their GUIDs) are imported once all the
+        batches are committed, one at a time.
+
+        If a `pool` (see get_import_pool) is provided, the documents are
+        parsed, validated and mapped in its processes, while the package
+        writes are still done here, in the original order.
+
+        Returns the number of objects imported successfully.
+        '''
+        harvest_objects = list(harvest_objects)
+        if pool is not None:
+            parsed_documents = pool.imap(_parse_in_worker,
+                [decode_content(obj.content) for obj in harvest_objects if obj.content is not None],
+                chunksize=10)
+        else:
+            parsed_documents = None
+
+        imported = 0
+        batch = {'guids': set(), 'current': {}, 'imported': [],
+                 'deferred': [], 'deferred_guids': set()}
+        for harvest_object in harvest_objects:
+            # Different versions of the same record in a batch would not
+            # see each other as current, so they go in separate batches
+            if harvest_object.guid in batch['guids'] or \
+               len(batch['guids']) >= batch_size:
+                imported += self._commit_import_batch(batch)
+            batch['guids'].add(harvest_object.guid)
+
+            parsed = None
+            if parsed_documents is not None and harvest_object.content is not None:
+                parsed = parsed_documents.next()
+
+            if harvest_object.guid in batch['deferred_guids']:
+                # Keep the versions of a GUID in order
+                batch['deferred'].append((harvest_object, parsed))
+                continue
+            self._import_into_batch(batch, harvest_object, parsed)
+        imported += self._commit_import_batch(batch)
+
+        if batch['deferred']:
+            log.info('Importing %i objects whose GUID was locked' % len(batch['deferred']))
+        for harvest_object, parsed in batch['deferred']:
+            # No other lock is held now, so waiting for the GUID is safe
+            if self._import_object(HarvestContext(harvest_object=harvest_object),
+                                   parsed=parsed):
+                imported += 1
+        return imported
+
+    def _import_into_batch(self, batch, harvest_object, parsed=None):
+        '''Imports an object within a batch, importing again the ones before
+        it if it rolled back the whole transaction'''
+        harvest_context = HarvestContext(harvest_object=harvest_object,
+                                         import_batch=batch)
+        if self._import_object(harvest_context, parsed=parsed):
+            batch['imported'].append((harvest_object, parsed))
+        elif batch.pop('locked', False):
+            batch['deferred'].append((harvest_object, parsed))
+            batch['deferred_guids'].add(harvest_object.guid)
+        elif batch.pop('rolled_back', False):
+            replayed = batch['imported']
+            log.info('Import batch rolled back, importing its %i objects again' % len(replayed))
+            batch['current'] = {}
+            batch['imported'] = []
+            for replayed_object, replayed_parsed in replayed:
+                self._import_into_batch(batch, replayed_object, replayed_parsed)
+
+    def _commit_import_batch(self, batch):
+        '''Commits a batch, returns the number of objects imported in it'''
+        if batch['current']:
+            from ckanext.harvest.model import harvest_object_table
+            object_ids = [obj.id for obj in batch['current'].values()]
+            u = update(harvest_object_table) \
+                    .where(harvest_object_table.c.package_id.in_(batch['current'].keys())) \
+                    .where(~harvest_object_table.c.id.in_(object_ids)) \
+                    .values(current=False)
+            Session.execute(u)
+
+            for package_id, harvest_object in batch['current'].iteritems():
+                if not harvest_object.package_id:
+                    harvest_object.package_id = package_id
+                harvest_object.current = True
+                Session.add(harvest_object)
+        with timed('commit'):
+            Session.commit()
+        log.debug('Committed import batch of %i objects' % len(batch['guids']))
+
+        imported = len(batch['imported'])
+        batch['guids'] = set()
+        batch['current'] = {}
+        batch['imported'] = []
+
+        if self._bulk_import():
+            self._index_pending_if_needed()
+        return imported
+
+    def _get_gather_checkpoint(self, harvest_job):
+        '''Returns the checkpoint left by an earlier gather of the source of
+        the job that did not finish, or a new one'''
+        checkpoint = GatherCheckpoint.get(harvest_job.source.id)
+        if checkpoint is None:
+            checkpoint = GatherCheckpoint(harvest_source_id=harvest_job.source.id,
+                                          position=0)
+        else:
+            log.info('Resuming the gathering of source %s where job %s stopped' % \
+                     (harvest_job.source.id, checkpoint.harvest_job_id))
+        checkpoint.harvest_job_id = harvest_job.id
+        return checkpoint
+
+    def _save_gather_checkpoint(self, checkpoint, position=None, processed_urls=None,
+                                failures=0):
+        if position is not None:
+            checkpoint.position = position
+        if processed_urls is not None:
+            checkpoint.set_processed_urls(processed_urls)
+        checkpoint.failures = failures
+        checkpoint.save()
+
+    def _save_failed_gather_checkpoint(self, checkpoint, position):
+        '''Saves the position a gather failed at, so the next one continues
+        from there. If gathers failed at that same position several times in
+        a row (ckan.inspire.gather.max_resume_failures, 3 by default), e.g.
+        because of a broken record or a limit of the server, the checkpoint
+        is cleared instead, so the next gather starts from the beginning and
+        the records before it are listed again.'''
+        failures = 1
+        if position == checkpoint.position:
+            failures += checkpoint.failures or 0
+        if failures >= int(config.get('ckan.inspire.gather.max_resume_failures', 3)):
+            log.error('Gathering of source %s failed %i times at position %i, it will start from the beginning on the next run' % \
+                      (checkpoint.harvest_source_id, failures, position))
+            self._clear_gather_checkpoint(checkpoint)
+        else:
+            self._save_gather_checkpoint(checkpoint, position=position,
+                                         failures=failures)
+
+    def _clear_gather_checkpoint(self, checkpoint):
+        Session.query(GatherCheckpoint) \
+               .filter(GatherCheckpoint.harvest_source_id==checkpoint.harvest_source_id) \
+               .delete()
+        Session.commit()
+
+    def _get_gather_deadline(self):
+        '''Returns when the gather stage should stop, if it has a time budget
+        (ckan.inspire.gather.time_budget, in seconds). It then continues on
+        the next run.'''
+        budget = int(config.get('ckan.inspire.gather.time_budget', 0))
+        if budget:
+            return datetime.now() + timedelta(seconds=budget)
+        return None
+
+    def _index_pending_if_needed(self):
+        indexing.index_pending_if_needed(
+            int(config.get('ckan.inspire.bulk_import.batch_size', 1000)),
+            int(config.get('ckan.inspire.bulk_import.interval', 300)))
+
+    def _save_harvest_object(self, harvest_context, harvest_object):
+        if harvest_context.import_batch is not None:
+            Session.add(harvest_object)
+            Session.flush()
+        else:
+            harvest_object.save()
+
     def import_stage(self, harvest_object):
         log = logging.getLogger(__name__ + '.import')
         log.debug('Import stage for harvest object: %r', harvest_object)
@@ -140,64 +500,133 @@ class GeminiHarvester(SpatialHarvester):
             log.error('No harvest object received')
             return False
 
-        # Save a reference
-        self.obj = harvest_object
+        return self._import_object(HarvestContext(harvest_object=harvest_object))
+
+    @stage('import')
+    def _import_object(self, harvest_context, parsed=None):
+        log = logging.getLogger(__name__ + '.import')
+        harvest_object = harvest_context.harvest_object
+        batch = harvest_context.import_batch
 
         if harvest_object.content is None:
-            self._save_object_error('Empty content for object %s' % harvest_object.id,harvest_object,'Import')
+            self._save_object_error('Empty content for object %s' % harvest_object.id,harvest_object,'Import',harvest_context)
             return False
+
+        savepoint = None
+        if batch is not None:
+            session = Session()
+            outer_transaction = session.transaction
+            savepoint = Session.begin_nested()
         try:
-            self.import_gemini_object(harvest_object.content)
+            self.import_gemini_object(harvest_context, decode_content(harvest_object.content), parsed=parsed)
+            if savepoint is not None:
+                savepoint.commit()
+            else:
+                # Releases the GUID lock if the object was skipped
+                with timed('commit'):
+                    Session.commit()
+                if self._bulk_import():
+                    self._index_pending_if_needed()
             return True
+        except GuidLocked, e:
+            # Only raised in batches, see _import_into_batch
+            log.info('GUID %s is locked by another importer, deferring object %s' % \
+                     (e, harvest_object.id))
+            savepoint.rollback()
+            for package_id, obj in batch['current'].items():
+                if obj is harvest_object:
+                    del batch['current'][package_id]
+            batch['locked'] = True
+            return False
         except Exception, e:
             log.error('Exception during import: %s' % text_traceback())
+            if savepoint is not None:
+                if savepoint.is_active:
+                    savepoint.rollback()
+                if session.transaction is not outer_transaction:
+                    # The whole transaction was rolled back, not only the
+                    # savepoint, see _import_into_batch
+                    batch['rolled_back'] = True
+                for package_id, obj in batch['current'].items():
+                    if obj is harvest_object:
+                        del batch['current'][package_id]
+                # The errors saved before the failure (e.g. the validation
+                # ones) were rolled back too
+                for message, stage in harvest_context.object_errors:
+                    Session.add(HarvestObjectError(message=message,
+                                                   object=harvest_object,
+                                                   stage=stage))
+            else:
+                # Don't leave a half written package behind (and release
+                # the GUID lock)
+                Session.rollback()
             if not str(e).strip():
-                self._save_object_error('Error importing Gemini document.', harvest_object, 'Import')
+                self._save_object_error('Error importing Gemini document.', harvest_object, 'Import', harvest_context)
             else:
-                self._save_object_error('Error importing Gemini document: %s' % str(e), harvest_object, 'Import')
+                self._save_object_error('Error importing Gemini document: %s' % str(e), harvest_object, 'Import', harvest_context)
 
             if debug_exception_mode:
                 raise
 
-    def import_gemini_object(self, gemini_string):
+    def import_gemini_object(self, harvest_context, gemini_string, parsed=None):
+        '''Imports a GEMINI document. `parsed` is the output of
+        parse_gemini_string for it, if it has already been run.'''
         log = logging.getLogger(__name__ + '.import')
-        xml = etree.fromstring(gemini_string)
-
-        valid, messages = self._get_validator().is_valid(xml)
-        if not valid:
-            log.error('Errors found for object with GUID %s:' % self.obj.guid)
+        harvest_object = harvest_context.harvest_object
+        if parsed is None:
+            parsed = parse_gemini_string(gemini_string, self._get_validator())
+        elif not 'content' in parsed:
+            # Could not be parsed in the import pool
+            raise Exception(parsed['error'])
+
+        if not parsed['valid']:
+            messages = parsed['messages']
+            log.error('Errors found for object with GUID %s:' % harvest_object.guid)
             out = messages[0] + ':\n' + '\n'.join(messages[1:])
-            self._save_object_error(out,self.obj,'Import')
+            self._save_object_error(out,harvest_object,'Import',harvest_context)
 
-        unicode_gemini_string = etree.tostring(xml, encoding=unicode, pretty_print=True)
+        if 'error' in parsed:
+            raise Exception(parsed['error'])
 
-        package = self.write_package_from_gemini_string(unicode_gemini_string)
+        package = self.write_package_from_gemini_string(harvest_context, parsed['content'],
+            gemini_values=parsed['values'], content_hash=parsed['content_hash'])
 
 
-    def write_package_from_gemini_string(self, content):
+    def write_package_from_gemini_string(self, harvest_context, content,
+                                         gemini_values=None, content_hash=None):
         '''Create or update a Package based on some content that has
         come from a URL.
+
+        The values and canonical hash of the document are computed from the
+        content unless provided.
         '''
         log = logging.getLogger(__name__ + '.import')
+        harvest_object = harvest_context.harvest_object
         package = None
-        gemini_document = GeminiDocument(content)
-        gemini_values = gemini_document.read_values()
+        if gemini_values is None or content_hash is None:
+            with timed('mapping'):
+                gemini_document = GeminiDocument(content)
+                gemini_values = gemini_document.read_values()
+                content_hash = gemini_document.get_canonical_hash()
         gemini_guid = gemini_values['guid']
 
         # Save the metadata reference date in the Harvest Object
-        try:
-            metadata_modified_date = datetime.strptime(gemini_values['metadata-date'],'%Y-%m-%d')
-        except ValueError:
-            try:
-                metadata_modified_date = datetime.strptime(gemini_values['metadata-date'],'%Y-%m-%dT%H:%M:%S')
-            except:
-                raise Exception('Could not extract reference date for GUID %s (%s)' \
-                        % (gemini_guid,gemini_values['metadata-date']))
+        metadata_modified_date = self._parse_metadata_date(gemini_values['metadata-date'], gemini_guid)
+
+        harvest_object.metadata_modified_date = metadata_modified_date
+        self._save_content_hash(harvest_object, content_hash)
+        self._save_harvest_object(harvest_context, harvest_object)
 
-        self.obj.metadata_modified_date = metadata_modified_date
-        self.obj.save()
+        # Released once the new current object is committed. A batch may
+        # already hold the locks of other GUIDs, so it does not wait for
+        # this one, to avoid deadlocks with other batches
+        if not self._lock_guid(gemini_guid,
+                               wait=harvest_context.import_batch is None):
+            raise GuidLocked(gemini_guid)
 
+        # We don't need the content of the previous object, just its hash
         last_harvested_object = Session.query(HarvestObject) \
+                            .options(defer('content')) \
                             .filter(HarvestObject.guid==gemini_guid) \
                             .filter(HarvestObject.current==True) \
                             .all()
@@ -214,13 +643,13 @@ class GeminiHarvester(SpatialHarvester):
             # Use metadata modified date instead of content to determine if the package
             # needs to be updated
             if last_harvested_object.metadata_modified_date is None \
-                or last_harvested_object.metadata_modified_date < self.obj.metadata_modified_date \
+                or last_harvested_object.metadata_modified_date < harvest_object.metadata_modified_date \
                 or self.force_import \
-                or (last_harvested_object.metadata_modified_date == self.obj.metadata_modified_date and
+                or (last_harvested_object.metadata_modified_date == harvest_object.metadata_modified_date and
                     last_harvested_object.source.active is False):
 
                 if self.force_import:
-                    log.info('Import forced for object %s with GUID %s' % (self.obj.id,gemini_guid))
+                    log.info('Import forced for object %s with GUID %s' % (harvest_object.id,gemini_guid))
                 else:
                     log.info('Package for object with GUID %s needs to be created or updated' % gemini_guid)
 
@@ -229,7 +658,7 @@ class GeminiHarvester(SpatialHarvester):
                 # If the package has a deleted state, we will only update it and reactivate it if the
                 # new document has a more recent modified date
                 if package.state == u'deleted':
-                    if last_harvested_object.metadata_modified_date < self.obj.metadata_modified_date:
+                    if last_harvested_object.metadata_modified_date < harvest_object.metadata_modified_date:
                         log.info('Package for object with GUID %s will be re-activated' % gemini_guid)
                         reactivate_package = True
                     else:
@@ -237,8 +666,8 @@ class GeminiHarvester(SpatialHarvester):
                          return None
 
             else:
-                if last_harvested_object.content != self.obj.content and \
-                 last_harvested_object.metadata_modified_date == self.obj.metadata_modified_date:
+                if self._get_content_hash(last_harvested_object) != content_hash and \
+                 last_harvested_object.metadata_modified_date == harvest_object.metadata_modified_date:
                     raise Exception('The contents of document with GUID %s changed, but the metadata date has not been updated' % gemini_guid)
                 else:
                     # The content hasn't changed, no need to update the package
@@ -248,9 +677,9 @@ class GeminiHarvester(SpatialHarvester):
             log.info('No package with GEMINI guid %s found, let''s create one' % gemini_guid)
 
         extras = {
-            'published_by': self.obj.source.publisher_id or '',
+            'published_by': harvest_object.source.publisher_id or '',
             'UKLP': 'True',
-            'harvest_object_id': self.obj.id
+            'harvest_object_id': harvest_object.id
         }
 
         # Just add some of the metadata as extras, not the whole lot
@@ -342,8 +771,8 @@ class GeminiHarvester(SpatialHarvester):
             'resources':[]
         }
 
-        if self.obj.source.publisher_id:
-            package_dict['groups'] = [{'id':self.obj.source.publisher_id}]
+        if harvest_object.source.publisher_id:
+            package_dict['groups'] = [{'id':harvest_object.source.publisher_id}]
 
 
         if reactivate_package:
@@ -404,48 +833,226 @@ class GeminiHarvester(SpatialHarvester):
 
         package_dict['extras'] = extras_as_dict
 
+        package_fingerprint = self._get_package_fingerprint(package_dict)
+
+        if package is not None and self._skip_unchanged_packages() and \
+           package_fingerprint == self._get_last_package_fingerprint(last_harvested_object):
+            # The document changed (or the import was forced) but not in a way
+            # that affects the package, so there is no need to update it.
+            # Just point it to this object and flag it as the current one.
+            log.info('Package for GUID %s unchanged, skipping update of package ID %s' % (gemini_guid, package.id))
+            self._update_package_extras(harvest_context, package, {
+                'harvest_object_id': harvest_object.id,
+                'metadata-date': gemini_values['metadata-date'],
+            })
+            self._save_package_fingerprint(harvest_object, package_fingerprint)
+            self._flag_as_current(harvest_context, package.id)
+            return None
+
         if package == None:
             # Create new package from data.
-            package = self._create_package_from_data(package_dict)
+            package = self._create_package_from_data(harvest_context, package_dict)
             log.info('Created new package ID %s with GEMINI guid %s', package['id'], gemini_guid)
         else:
-            package = self._create_package_from_data(package_dict, package = package)
+            package = self._create_package_from_data(harvest_context, package_dict, package = package)
             log.info('Updated existing package ID %s with existing GEMINI guid %s', package['id'], gemini_guid)
 
-        # Flag the other objects of this source as not current anymore
+        self._save_package_fingerprint(harvest_object, package_fingerprint)
+        self._flag_as_current(harvest_context, package['id'])
+
+        assert gemini_guid == [e['value'] for e in package['extras'] if e['key'] == 'guid'][0]
+        assert harvest_object.id == [e['value'] for e in package['extras'] if e['key'] ==  'harvest_object_id'][0]
+
+        return package
+
+    def _flag_as_current(self, harvest_context, package_id):
+        '''Flags the object being imported as the current one for the package,
+        and the other objects of this package as not current anymore'''
+        harvest_object = harvest_context.harvest_object
+        if harvest_context.import_batch is not None:
+            # Done for all the batch at once when committing it
+            harvest_context.import_batch['current'][package_id] = harvest_object
+            return
+
         from ckanext.harvest.model import harvest_object_table
         u = update(harvest_object_table) \
                 .where(harvest_object_table.c.package_id==bindparam('b_package_id')) \
+                .where(harvest_object_table.c.id!=bindparam('b_object_id')) \
                 .values(current=False)
-        Session.execute(u, params={'b_package_id':package['id']})
-        Session.commit()
+        Session.execute(u, params={'b_package_id':package_id,
+                                   'b_object_id':harvest_object.id})
+
+        # Set reference to package in the HarvestObject and flag it as
+        # the current one. This is committed in the same transaction as
+        # the update above, so there is always one current object, and it
+        # releases the GUID lock (see _lock_guid)
+        if not harvest_object.package_id:
+            harvest_object.package_id = package_id
+
+        harvest_object.current = True
+        harvest_object.save()
 
         # Refresh current object from session, otherwise the
         # import paster command fails
         Session.remove()
-        Session.add(self.obj)
-        Session.refresh(self.obj)
+        Session.add(harvest_object)
+        Session.refresh(harvest_object)
 
-        # Set reference to package in the HarvestObject and flag it as
-        # the current one
-        if not self.obj.package_id:
-            self.obj.package_id = package['id']
+    def _parse_metadata_date(self, metadata_date, guid):
+        try:
+            return datetime.strptime(metadata_date,'%Y-%m-%d')
+        except ValueError:
+            try:
+                return datetime.strptime(metadata_date,'%Y-%m-%dT%H:%M:%S')
+            except:
+                raise Exception('Could not extract reference date for GUID %s (%s)' \
+                        % (guid,metadata_date))
+
+    def _skip_unchanged_at_gather(self):
+        return asbool(config.get('ckan.inspire.gather.skip_unchanged', False))
+
+    def _is_unchanged_record(self, guid, metadata_date, content_hash=None):
+        '''Returns True if importing a gathered record would not change
+        anything, ie if the current object for its GUID is at least as
+        recent (and has the same content, if its hash is known). This is
+        the same check done by write_package_from_gemini_string.'''
+        if self.force_import:
+            return False
+        try:
+            metadata_date = self._parse_metadata_date(metadata_date, guid)
+        except Exception:
+            return False
 
-        self.obj.current = True
-        self.obj.save()
+        last_harvested_object = Session.query(HarvestObject) \
+                            .options(defer('content')) \
+                            .filter(HarvestObject.guid==guid) \
+                            .filter(HarvestObject.current==True) \
+                            .first()
+        if last_harvested_object is None or \
+           last_harvested_object.metadata_modified_date is None or \
+           last_harvested_object.metadata_modified_date < metadata_date:
+            return False
+        if last_harvested_object.metadata_modified_date == metadata_date:
+            if last_harvested_object.source.active is False:
+                return False
+            # Let the import stage report documents that changed without
+            # their date being updated
+            if content_hash is not None and \
+               self._get_content_hash(last_harvested_object) != content_hash:
+                return False
+        increment('unchanged_records')
+        return True
 
+    def _lock_guid(self, guid, wait=True):
+        '''Waits for and takes a lock on a GUID until the end of the current
+        transaction. If `wait` is False it does not wait, and returns False
+        if the lock is held by someone else.
 
-        assert gemini_guid == [e['value'] for e in package['extras'] if e['key'] == 'guid'][0]
-        assert self.obj.id == [e['value'] for e in package['extras'] if e['key'] ==  'harvest_object_id'][0]
+        It is taken before looking for the current object of the GUID and
+        held until the new one is flagged as current, so importers running
+        in parallel (in other threads, processes or nodes) can't both think
+        they are creating or updating the package for the GUID and leave
+        none or two current objects.
 
-        return package
+        Uses PostgreSQL advisory locks, other databases are not locked.
+        '''
+        if Session.bind.dialect.name != 'postgresql':
+            return True
+        # Advisory locks are keyed by a 64 bit integer
+        key = int(hashlib.sha1(guid.encode('utf8')).hexdigest()[:15], 16)
+        if not wait:
+            return Session.execute('SELECT pg_try_advisory_xact_lock(:key)',
+                                   {'key': key}).scalar()
+        Session.execute('SELECT pg_advisory_xact_lock(:key)', {'key': key})
+        return True
+
+    def _bulk_import(self):
+        return self.bulk_import or \
+               asbool(config.get('ckan.inspire.bulk_import', False))
+
+    def _skip_unchanged_packages(self):
+        return asbool(config.get('ckan.inspire.skip_unchanged_packages', True))
+
+    # Extras updated in place when the rest of the package does not change
+    # (see _update_package_extras)
+    UNFINGERPRINTED_EXTRAS = ['harvest_object_id', 'metadata-date']
+
+    def _get_package_fingerprint(self, package_dict):
+        '''Returns a hash of the package dict, leaving out the values that
+        change on every import or update of the document even when its
+        contents don't (the harvest object id, the metadata date and the date
+        of the WMS checks)'''
+        package_dict = dict(package_dict)
+        package_dict['extras'] = sorted(
+            [extra for extra in package_dict.get('extras', [])
+             if not extra['key'] in self.UNFINGERPRINTED_EXTRAS],
+            key=lambda extra: extra['key'])
+        package_dict['resources'] = [
+            dict((key, value) for key, value in resource.iteritems()
+                 if key != 'verified_date')
+            for resource in package_dict.get('resources', [])]
+        return hashlib.sha1(json.dumps(package_dict, sort_keys=True)).hexdigest()
+
+    def _update_package_extras(self, harvest_context, package, extras):
+        '''Sets the values of some extras of a package in a new revision,
+        without going through package_update, and has the package indexed
+        again. This is committed along with the current flag of the object.'''
+        rev = model.repo.new_revision()
+        rev.author = u'harvest'
+        rev.message = u'Harvest object %s of package %s' % \
+                      (harvest_context.harvest_object.id, package.name)
+        for key, value in extras.iteritems():
+            package.extras[key] = value
+        self._queue_for_indexing(harvest_context, package.id)
+
+    def _queue_for_indexing(self, harvest_context, package_id):
+        '''In bulk import mode, records a package written by the import to be
+        indexed later. Otherwise the synchronous search plugin indexes it
+        when the change is committed.'''
+        if self._bulk_import():
+            # Recorded in the same transaction as the package
+            indexing.suppress_synchronous_indexing()
+            indexing.add_pending(package_id,
+                                 harvest_context.harvest_object.harvest_job_id)
+
+    def _save_package_fingerprint(self, harvest_object, package_fingerprint):
+        info = HarvestObjectInfo.get_or_create(harvest_object.id)
+        info.package_fingerprint = package_fingerprint
+
+    def _get_last_package_fingerprint(self, last_harvested_object):
+        if not last_harvested_object:
+            return None
+        info = HarvestObjectInfo.get(last_harvested_object.id)
+        return info.package_fingerprint if info is not None else None
+
+    def _save_content_hash(self, harvest_object, content_hash):
+        info = HarvestObjectInfo.get_or_create(harvest_object.id)
+        info.content_hash = content_hash
+
+    def _get_content_hash(self, harvest_object):
+        '''Returns the canonical hash of the content of a harvest object.
+
+        Objects imported before hashes were stored get it computed (and
+        saved) now.
+        '''
+        info = HarvestObjectInfo.get(harvest_object.id)
+        if info is not None and info.content_hash:
+            return info.content_hash
+
+        if harvest_object.content is None:
+            return None
+        content_hash = GeminiDocument(decode_content(harvest_object.content)).get_canonical_hash()
+        self._save_content_hash(harvest_object, content_hash)
+        return content_hash
 
     def gen_new_name(self, title):
         name = munge_title_to_name(title).replace('_', '-')
         while '--' in name:
             name = name.replace('--', '-')
         like_q = u'%s%%' % name
-        pkg_query = Session.query(Package).filter(Package.name.ilike(like_q)).limit(100)
+        # Names are lower case, and unlike ILIKE this can use an index (see
+        # ckanext.inspire.maintenance)
+        pkg_query = Session.query(Package).filter(func.lower(Package.name).like(like_q)).limit(100)
         taken = [pkg.name for pkg in pkg_query]
         if name not in taken:
             return name
@@ -464,7 +1071,7 @@ class GeminiHarvester(SpatialHarvester):
                 return licence
         return None
 
-    def _create_package_from_data(self, package_dict, package = None):
+    def _create_package_from_data(self, harvest_context, package_dict, package = None):
         '''
         {'name': 'council-owned-litter-bins',
          'notes': 'Location of Council owned litter bins within Borough.',
@@ -500,19 +1107,24 @@ class GeminiHarvester(SpatialHarvester):
                    'schema':package_schema,
                    'extras_as_string':True,
                    'api_version': '2'}
+        # Committed along with the current flag (or with the whole batch)
+        context['defer_commit'] = True
         if not package:
             # We need to explicitly provide a package ID, otherwise ckanext-spatial
             # won't be be able to link the extent to the package.
             package_dict['id'] = unicode(uuid.uuid4())
             package_schema['id'] = [unicode]
 
-            action_function = get_action('package_create')
+            action_name = 'package_create'
         else:
-            action_function = get_action('package_update')
+            action_name = 'package_update'
             package_dict['id'] = package.id
 
+        self._queue_for_indexing(harvest_context, package_dict['id'])
+
         try:
-            package_dict = action_function(context, package_dict)
+            with timed('package_write', action=action_name):
+                package_dict = get_action(action_name)(context, package_dict)
         except ValidationError,e:
             raise Exception('Validation Error: %s' % str(e.error_summary))
             if debug_exception_mode:
@@ -520,8 +1132,42 @@ class GeminiHarvester(SpatialHarvester):
 
         return package_dict
 
-    def get_gemini_string_and_guid(self,content,url=None):
-        xml = etree.fromstring(content)
+    def get_gemini_string_and_guid(self,harvest_context,content,url=None):
+        gemini_string, gemini_guid, content_hash, metadata_date = \
+            self._read_gathered_document(harvest_context, content, url)
+        return gemini_string, gemini_guid
+
+    def get_gemini_content_and_guid(self,harvest_context,content,url=None):
+        '''Like get_gemini_string_and_guid, but returns the content to store
+        in the harvest object (see _get_content_to_store).
+
+        If ckan.inspire.gather.skip_unchanged is enabled and the document
+        would not change anything if imported, the content returned is None
+        and no harvest object should be created.
+        '''
+        gemini_string, gemini_guid, content_hash, metadata_date = \
+            self._read_gathered_document(harvest_context, content, url)
+        if not gemini_guid:
+            return None, gemini_guid
+        if metadata_date is not None and \
+           self._is_unchanged_record(gemini_guid, metadata_date, content_hash):
+            log.info('Document with GUID %s unchanged, not gathering it' % gemini_guid)
+            return None, gemini_guid
+        return self._get_content_to_store(gemini_string, gemini_guid, content_hash), gemini_guid
+
+    def _read_gathered_document(self,harvest_context,content,url=None):
+        '''Extracts the GEMINI document from some gathered content, validates
+        it and reads its GUID.
+
+        Returns the document, its GUID, its canonical hash (if content
+        deduplication or ckan.inspire.gather.skip_unchanged are enabled) and
+        its metadata date (if the latter is). Documents already in the
+        content store were validated and mapped when first gathered (from
+        this or another source), so they are not again: the GUID is taken
+        from the store.
+        '''
+        with timed('xml_parse'):
+            xml = parsing.parse(content)
 
         # The validator and GeminiDocument don't like the container
         metadata_tag = '{http://www.isotc211.org/2005/gmd}MD_Metadata'
@@ -531,30 +1177,70 @@ class GeminiHarvester(SpatialHarvester):
             gemini_xml = xml.find(metadata_tag)
 
         if gemini_xml is None:
-            self._save_gather_error('Content is not a valid Gemini document',self.harvest_job)
+            self._save_gather_error('Content is not a valid Gemini document',harvest_context.harvest_job)
 
-        valid, messages = self._get_validator().is_valid(gemini_xml)
+        gemini_string = etree.tostring(gemini_xml)
+        gemini_document = GeminiDocument(gemini_string)
+        skip_unchanged = self._skip_unchanged_at_gather()
+
+        content_hash = None
+        if deduplication_enabled() or skip_unchanged:
+            content_hash = gemini_document.get_canonical_hash()
+        if deduplication_enabled():
+            blob = ContentBlob.get(content_hash)
+            increment('content_store_misses' if blob is None else 'content_store_hits')
+            if blob is not None:
+                log.debug('Document with GUID %s already stored, skipping validation' % blob.guid)
+                metadata_date = None
+                if skip_unchanged:
+                    metadata_date = gemini_document.read_value('metadata-date')
+                return gemini_string, blob.guid, content_hash, metadata_date
+
+        with timed('validation'):
+            valid, messages = self._get_validator().is_valid(gemini_xml)
         if not valid:
             out = messages[0] + ':\n' + '\n'.join(messages[1:])
             if url:
-                self._save_gather_error('Validation error for %s - %s'% (url,out),self.harvest_job)
+                self._save_gather_error('Validation error for %s - %s'% (url,out),harvest_context.harvest_job)
             else:
-                self._save_gather_error('Validation error - %s'%out,self.harvest_job)
+                self._save_gather_error('Validation error - %s'%out,harvest_context.harvest_job)
 
-        gemini_string = etree.tostring(gemini_xml)
-        gemini_document = GeminiDocument(gemini_string)
-        gemini_values = gemini_document.read_values()
+        with timed('mapping'):
+            gemini_values = gemini_document.read_values()
         gemini_guid = gemini_values['guid']
+        metadata_date = gemini_values['metadata-date'] if skip_unchanged else None
 
-        return gemini_string, gemini_guid
+        return gemini_string, gemini_guid, content_hash, metadata_date
+
+    def _get_content_to_store(self, gemini_string, gemini_guid, content_hash=None):
+        '''Returns the content to store in a harvest object for a document.
+
+        If content deduplication is enabled, the document is added to the
+        content store (unless it is there already) and a reference to it is
+        returned. Otherwise it is the document itself, compressed if the
+        compression is enabled.
+        '''
+        if not deduplication_enabled():
+            return encode_content(gemini_string)
+
+        if content_hash is None:
+            content_hash = GeminiDocument(gemini_string).get_canonical_hash()
+        if ContentBlob.get(content_hash) is None:
+            blob = ContentBlob(content_hash=content_hash, guid=gemini_guid,
+                               content=encode_content(gemini_string))
+            try:
+                blob.save()
+            except IntegrityError:
+                # Stored by another gather at the same time
+                Session.rollback()
+        return reference_content(content_hash)
 
 class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
     '''
     A Harvester for CSW servers
     '''
     implements(IHarvester)
-
-    csw=None
+    implements(IConfigurable)
 
     def info(self):
         return {
@@ -563,6 +1249,7 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
             'description': 'A server that implements OGC\'s Catalog Service for the Web (CSW) standard'
             }
 
+    @stage('gather', flush=True)
     def gather_stage(self, harvest_job):
         log = logging.getLogger(__name__ + '.CSW.gather')
         log.debug('GeminiCswHarvester gather_stage for job: %r', harvest_job)
@@ -570,17 +1257,43 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
         url = harvest_job.source.url
 
         try:
-            self._setup_csw_client(url)
+            csw = self._setup_csw_client(url)
         except Exception, e:
             self._save_gather_error('Error contacting the CSW server: %s' % e, harvest_job)
             return None
 
 
+        shard_size = int(config.get('ckan.inspire.csw.shard_size', 0))
+        if shard_size:
+            return self._gather_sharded(harvest_job, shard_size)
+
         log.debug('Starting gathering for %s' % url)
-        used_identifiers = []
-        ids = []
+        checkpoint = self._get_gather_checkpoint(harvest_job)
+        deadline = self._get_gather_deadline()
+        # Position in the result set of the last identifier gathered
+        position = checkpoint.position
+        kwargs = {}
+        if position:
+            kwargs['startposition'] = position + 1
+
+        if self._skip_unchanged_at_gather():
+            records = self._get_csw_identifiers_and_dates(url, **kwargs)
+        else:
+            records = ((identifier, None) for identifier in
+                       csw.getidentifiers(page=10, **kwargs))
+
+        used_identifiers = set()
+        ids = GatheredIds(on_queue=lambda queued_position: \
+            self._save_gather_checkpoint(checkpoint, position=queued_position))
+        unchanged = 0
+        stopped = False
         try:
-            for identifier in self.csw.getidentifiers(page=10):
+            for identifier, metadata_date in records:
+                if deadline is not None and datetime.now() >= deadline:
+                    log.info('Time budget of job %s used up, gathering will continue on the next run' % harvest_job.id)
+                    stopped = True
+                    break
+                position += 1
                 try:
                     log.info('Got identifier %s from the CSW', identifier)
                     if identifier in used_identifiers:
@@ -590,34 +1303,50 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
                         log.error('CSW returned identifier %r, skipping...' % identifier)
                         ## log an error here? happens with the dutch data
                         continue
+                    if metadata_date and self._is_unchanged_record(identifier, metadata_date):
+                        log.info('Record with GUID %s unchanged, not gathering it' % identifier)
+                        unchanged += 1
+                        continue
 
                     # Create a new HarvestObject for this identifier
-                    obj = HarvestObject(guid=identifier, job=harvest_job)
+                    obj = HarvestObject(guid=identifier, harvest_job_id=harvest_job.id)
                     obj.save()
 
-                    ids.append(obj.id)
-                    used_identifiers.append(identifier)
+                    ids.append(obj.id, position)
+                    used_identifiers.add(identifier)
                 except Exception, e:
                     self._save_gather_error('Error for the identifier %s [%r]' % (identifier,e), harvest_job)
                     continue
 
         except Exception, e:
             self._save_gather_error('Error gathering the identifiers from the CSW server [%s]' % str(e), harvest_job)
-            return None
+            # The next run continues from here, so the objects gathered so
+            # far need to be fetched
+            self._save_failed_gather_checkpoint(checkpoint, position)
+            return ids.pending or None
 
-        if len(ids) == 0:
+        if stopped:
+            self._save_gather_checkpoint(checkpoint, position=position)
+        else:
+            self._clear_gather_checkpoint(checkpoint)
+
+        if len(ids) == 0 and unchanged:
+            log.info('All the %i records are unchanged' % unchanged)
+            return []
+        elif len(ids) == 0:
             self._save_gather_error('No records received from the CSW server', harvest_job)
             return None
 
-        return ids
+        return ids.pending
 
+    @stage('fetch')
     def fetch_stage(self,harvest_object):
         log = logging.getLogger(__name__ + '.CSW.fetch')
         log.debug('GeminiCswHarvester fetch_stage for object: %r', harvest_object)
 
         url = harvest_object.source.url
         try:
-            self._setup_csw_client(url)
+            csw = self._setup_csw_client(url)
         except Exception, e:
             self._save_object_error('Error contacting the CSW server: %s' % e,
                                     harvest_object)
@@ -625,8 +1354,10 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
 
         identifier = harvest_object.guid
         try:
-            record = self.csw.getrecordbyid([identifier])
+            with timed('csw'):
+                record = csw.getrecordbyid([identifier])
         except Exception, e:
+            increment('csw_errors')
             self._save_object_error('Error getting the CSW record with GUID %s' % identifier, harvest_object)
             return False
 
@@ -635,20 +1366,201 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
                                     harvest_object)
             return False
 
+        max_size = parsing.get_max_document_size()
+        if max_size and len(record['xml']) > max_size:
+            self._save_object_error('The CSW record with GUID %s has more than the maximum of %i bytes' % \
+                                    (identifier, max_size), harvest_object)
+            return False
+
         try:
             # Save the fetch contents in the HarvestObject
-            harvest_object.content = record['xml']
+            harvest_object.content = self._get_content_to_store(record['xml'], identifier)
             harvest_object.save()
         except Exception,e:
             self._save_object_error('Error saving the harvest object for GUID %s [%r]' % \
                                     (identifier, e), harvest_object)
             return False
 
+        increment('bytes_fetched', len(record['xml']))
         log.debug('XML content saved (len %s)', len(record['xml']))
         return True
 
     def _setup_csw_client(self, url):
-        self.csw = CswService(url)
+        return CswService(url)
+
+    def _get_csw_identifiers_and_dates(self, url, page=10, startposition=0):
+        '''Like CswService.getidentifiers, but yields the identifier and the
+        metadata date of each record (their dateStamp, which is part of the
+        brief ISO records)'''
+        from owslib.csw import CatalogueServiceWeb
+        csw = CatalogueServiceWeb(url)
+        while True:
+            with timed('csw'):
+                csw.getrecords(typenames='gmd:MD_Metadata', esn='brief',
+                               outputschema=namespaces['gmd'],
+                               startposition=startposition, maxrecords=page)
+            if not csw.records:
+                break
+            records = [(identifier, getattr(record, 'datestamp', None))
+                       for identifier, record in csw.records.iteritems()]
+            startposition = int(csw.results.get('nextrecord') or 0)
+            matches = int(csw.results['matches'])
+            # Don't keep the parsed page while the records are gathered
+            csw.records.clear()
+            csw._exml = None
+            for identifier, metadata_date in records:
+                yield identifier, metadata_date and metadata_date.strip()
+            if not startposition or startposition > matches:
+                break
+
+    def _get_csw_hit_count(self, url):
+        '''Returns the number of records the CSW server has'''
+        from owslib.csw import CatalogueServiceWeb
+        csw = CatalogueServiceWeb(url)
+        with timed('csw'):
+            csw.getrecords(typenames='csw:Record', esn='brief', resulttype='hits')
+        return int(csw.results['matches'])
+
+    def _gather_sharded(self, harvest_job, shard_size):
+        '''Gathers a CSW source in shards of `shard_size` records.
+
+        The range of positions of the result set is split in shards, which
+        are gathered here and by the nodes running the gather-shards
+        command. Once all of them are done, the objects created for the same
+        identifier in different shards (e.g. if records were added to the
+        server while gathering) are merged, and all the ids are returned.
+        '''
+        log = logging.getLogger(__name__ + '.CSW.gather')
+        if not Session.query(GatherShard) \
+                      .filter(GatherShard.harvest_job_id==harvest_job.id).count():
+            try:
+                hits = self._get_csw_hit_count(harvest_job.source.url)
+            except Exception, e:
+                self._save_gather_error('Error getting the number of records from the CSW server [%s]' % str(e), harvest_job)
+                return None
+            for start in range(1, hits + 1, shard_size):
+                Session.add(GatherShard(harvest_job_id=harvest_job.id,
+                                        start_position=start,
+                                        end_position=min(start + shard_size - 1, hits)))
+            Session.commit()
+            log.info('Gathering %i records of job %s in shards of %i' % \
+                     (hits, harvest_job.id, shard_size))
+
+        while True:
+            shard = self.claim_gather_shard(harvest_job.id)
+            if shard is not None:
+                self.gather_shard(shard)
+                continue
+            running = Session.query(GatherShard) \
+                             .filter(GatherShard.harvest_job_id==harvest_job.id) \
+                             .filter(GatherShard.status==u'Running') \
+                             .count()
+            if not running:
+                break
+            # Wait for the other workers (or for their shards to time out)
+            Session.commit()
+            time.sleep(int(config.get('ckan.inspire.csw.shard_poll_interval', 5)))
+
+        ids = self._merge_gathered_objects(harvest_job)
+        Session.query(GatherShard) \
+               .filter(GatherShard.harvest_job_id==harvest_job.id) \
+               .delete()
+        Session.commit()
+
+        if len(ids) == 0:
+            self._save_gather_error('No records received from the CSW server', harvest_job)
+            return None
+        return ids
+
+    def claim_gather_shard(self, harvest_job_id=None):
+        '''Claims a shard waiting to be gathered (of the given job, or of any
+        of them), or one whose worker has not finished it in time. Returns
+        None if there are none.'''
+        timeout = int(config.get('ckan.inspire.csw.shard_timeout', 600))
+        worker = u'%s:%i' % (socket.gethostname(), os.getpid())
+        while True:
+            query = Session.query(GatherShard).filter(or_(
+                GatherShard.status==u'New',
+                and_(GatherShard.status==u'Running',
+                     GatherShard.claimed < datetime.now() - timedelta(seconds=timeout))))
+            if harvest_job_id:
+                query = query.filter(GatherShard.harvest_job_id==harvest_job_id)
+            shard = query.order_by(GatherShard.start_position).first()
+            if shard is None:
+                Session.commit()
+                return None
+
+            # Only one of the workers trying to claim it at the same time
+            # gets to update it
+            result = Session.execute(update(gather_shard_table)
+                .where(gather_shard_table.c.id==shard.id)
+                .where(gather_shard_table.c.status==shard.status)
+                .where(gather_shard_table.c.claimed==shard.claimed)
+                .values(status=u'Running', worker=worker, claimed=datetime.now()))
+            Session.commit()
+            if result.rowcount == 1:
+                Session.refresh(shard)
+                return shard
+
+    @stage('gather_shard', flush=True)
+    def gather_shard(self, shard):
+        '''Gathers the identifiers in the range of positions of a shard,
+        creating a harvest object for each of them'''
+        log = logging.getLogger(__name__ + '.CSW.gather')
+        harvest_job = HarvestJob.get(shard.harvest_job_id)
+        log.debug('Gathering records %i to %i of job %s' % \
+                  (shard.start_position, shard.end_position, harvest_job.id))
+
+        used_identifiers = set()
+        position = shard.start_position - 1
+        try:
+            csw = self._setup_csw_client(harvest_job.source.url)
+            for identifier in csw.getidentifiers(page=10,
+                                                 startposition=shard.start_position):
+                position += 1
+                if position > shard.end_position:
+                    break
+                if identifier is None or identifier in used_identifiers:
+                    log.error('CSW identifier %r missing or already used, skipping...' % identifier)
+                    continue
+                try:
+                    obj = HarvestObject(guid=identifier, harvest_job_id=harvest_job.id)
+                    obj.save()
+                    used_identifiers.add(identifier)
+                except Exception, e:
+                    self._save_gather_error('Error for the identifier %s [%r]' % (identifier,e), harvest_job)
+            shard.status = u'Done'
+        except Exception, e:
+            self._save_gather_error('Error gathering records %i to %i from the CSW server [%s]' % \
+                (shard.start_position, shard.end_position, str(e)), harvest_job)
+            shard.status = u'Error'
+        shard.save()
+        return len(used_identifiers)
+
+    def _merge_gathered_objects(self, harvest_job):
+        '''Deletes the objects of the job with the same GUID as an earlier one
+        and returns the ids of the rest'''
+        from ckanext.harvest.model import harvest_object_table
+
+        ids = []
+        duplicates = []
+        guids = set()
+        for object_id, guid in Session.query(HarvestObject.id, HarvestObject.guid) \
+                .filter(HarvestObject.harvest_job_id==harvest_job.id) \
+                .order_by(HarvestObject.gathered):
+            if guid in guids:
+                duplicates.append(object_id)
+            else:
+                guids.add(guid)
+                ids.append(object_id)
+
+        if duplicates:
+            Session.execute(harvest_object_table.delete()
+                .where(harvest_object_table.c.id.in_(duplicates)))
+            Session.commit()
+            log.info('Removed %i duplicated identifiers gathered for job %s' % \
+                     (len(duplicates), harvest_job.id))
+        return ids
 
 
 class GeminiDocHarvester(GeminiHarvester, SingletonPlugin):
@@ -657,6 +1569,7 @@ class GeminiDocHarvester(GeminiHarvester, SingletonPlugin):
     '''
 
     implements(IHarvester)
+    implements(IConfigurable)
 
     def info(self):
         return {
@@ -665,33 +1578,37 @@ class GeminiDocHarvester(GeminiHarvester, SingletonPlugin):
             'description': 'A single GEMINI 2.1 document'
             }
 
+    @stage('gather', flush=True)
     def gather_stage(self,harvest_job):
         log = logging.getLogger(__name__ + '.individual.gather')
         log.debug('GeminiDocHarvester gather_stage for job: %r', harvest_job)
 
-        self.harvest_job = harvest_job
+        harvest_context = HarvestContext(harvest_job=harvest_job)
 
         # Get source URL
         url = harvest_job.source.url
 
         # Get contents
         try:
-            content = self._get_content(url)
+            content = self._open_content(url)
         except Exception,e:
             self._save_gather_error('Unable to get content for URL: %s: %r' % \
                                         (url, e),harvest_job)
             return None
         try:
             # We need to extract the guid to pass it to the next stage
-            gemini_string, gemini_guid = self.get_gemini_string_and_guid(content,url)
+            gemini_content, gemini_guid = self.get_gemini_content_and_guid(harvest_context,content,url)
 
-            if gemini_guid:
+            if gemini_guid and gemini_content is None:
+                # Unchanged since the last import, nothing to do
+                return []
+            elif gemini_guid:
                 # Create a new HarvestObject for this identifier
                 # Generally the content will be set in the fetch stage, but as we alredy
                 # have it, we might as well save a request
                 obj = HarvestObject(guid=gemini_guid,
-                                    job=harvest_job,
-                                    content=gemini_string)
+                                    harvest_job_id=harvest_job.id,
+                                    content=gemini_content)
                 obj.save()
 
                 log.info('Got GUID %s' % gemini_guid)
@@ -704,6 +1621,8 @@ class GeminiDocHarvester(GeminiHarvester, SingletonPlugin):
             if debug_exception_mode:
                 raise
             return None
+        finally:
+            content.close()
 
 
     def fetch_stage(self,harvest_object):
@@ -718,6 +1637,7 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
     '''
 
     implements(IHarvester)
+    implements(IConfigurable)
 
     def info(self):
         return {
@@ -726,11 +1646,12 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
             'description': 'A Web Accessible Folder (WAF) displaying a list of GEMINI 2.1 documents'
             }
 
+    @stage('gather', flush=True)
     def gather_stage(self,harvest_job):
         log = logging.getLogger(__name__ + '.WAF.gather')
         log.debug('GeminiWafHarvester gather_stage for job: %r', harvest_job)
 
-        self.harvest_job = harvest_job
+        harvest_context = HarvestContext(harvest_job=harvest_job)
 
         # Get source URL
         url = harvest_job.source.url
@@ -743,11 +1664,28 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
                                         (url, e),harvest_job)
             return None
 
-        ids = []
+        checkpoint = self._get_gather_checkpoint(harvest_job)
+        deadline = self._get_gather_deadline()
+        # In the order they were gathered, so the ones up to a queued object
+        # can be checkpointed
+        processed_urls = list(checkpoint.get_processed_urls())
+        already_processed = set(processed_urls)
+
+        ids = GatheredIds(on_queue=lambda queued_count: \
+            self._save_gather_checkpoint(checkpoint, processed_urls=processed_urls[:queued_count]))
+        unchanged = 0
+        stopped = False
         try:
             for url in self._extract_urls(content,url):
+                if url in already_processed:
+                    continue
+                if deadline is not None and datetime.now() >= deadline:
+                    log.info('Time budget of job %s used up, gathering will continue on the next run' % harvest_job.id)
+                    stopped = True
+                    break
+                processed_urls.append(url)
                 try:
-                    content = self._get_content(url)
+                    content = self._open_content(url)
                 except Exception, e:
                     msg = 'Couldn\'t harvest WAF link: %s: %s' % (url, e)
                     self._save_gather_error(msg,harvest_job)
@@ -755,32 +1693,45 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
                 else:
                     # We need to extract the guid to pass it to the next stage
                     try:
-                        gemini_string, gemini_guid = self.get_gemini_string_and_guid(content,url)
-                        if gemini_guid:
+                        gemini_content, gemini_guid = self.get_gemini_content_and_guid(harvest_context,content,url)
+                        if gemini_guid and gemini_content is None:
+                            unchanged += 1
+                        elif gemini_guid:
                             log.debug('Got GUID %s' % gemini_guid)
                             # Create a new HarvestObject for this identifier
                             # Generally the content will be set in the fetch stage, but as we alredy
                             # have it, we might as well save a request
                             obj = HarvestObject(guid=gemini_guid,
-                                                job=harvest_job,
-                                                content=gemini_string)
+                                                harvest_job_id=harvest_job.id,
+                                                content=gemini_content)
                             obj.save()
 
-                            ids.append(obj.id)
+                            ids.append(obj.id, len(processed_urls))
 
 
                     except Exception,e:
                         msg = 'Could not get GUID for source %s: %r' % (url,e)
                         self._save_gather_error(msg,harvest_job)
                         continue
+                    finally:
+                        # Only one document is kept in memory at a time
+                        content.close()
+                        content = gemini_content = obj = None
         except Exception,e:
             msg = 'Error extracting URLs from %s' % url
             self._save_gather_error(msg,harvest_job)
             return None
 
+        if stopped:
+            self._save_gather_checkpoint(checkpoint, processed_urls=processed_urls)
+        else:
+            self._clear_gather_checkpoint(checkpoint)
 
         if len(ids) > 0:
-            return ids
+            return ids.pending
+        elif unchanged:
+            log.info('All the %i documents are unchanged' % unchanged)
+            return []
         else:
             self._save_gather_error('Couldn''t find any links to metadata files',
                                      harvest_job)
@@ -796,8 +1747,7 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
         Get the URLs out of a WAF index page
         '''
         try:
-            parser = etree.HTMLParser()
-            tree = etree.fromstring(content, parser=parser)
+            tree = parsing.parse(content, parser=parsing.get_html_parser())
         except Exception, inst:
             msg = 'Couldn''t parse content into a tree: %s: %s' \
                   % (inst, content)
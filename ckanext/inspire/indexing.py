@@ -0,0 +1,164 @@
+'''
+Deferred search indexing for bulk imports.
+
+When importing lots of records (e.g. the first harvest of a big source),
+re-indexing each package synchronously as it is written takes most of the
+import time. In bulk import mode the harvesters record the ids of the
+packages they write in the inspire_pending_index table, the synchronous
+search plugin leaves those packages alone, and they are indexed here in
+batches, committing to the search engine once per batch. Other packages
+are still indexed as they are written.
+
+Ids left behind by an import process that died are indexed on the next
+flush, or by running::
+
+    paster inspire index-pending --config=<config file>
+'''
+import atexit
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func, and_, bindparam
+
+from ckan import plugins
+from ckan.lib import search
+from ckan.model import Session
+from ckan.plugins.interfaces import IDomainObjectModification
+
+from ckanext.inspire.model.harvest import pending_index_table
+
+log = logging.getLogger(__name__)
+
+# Protects the module state below, the import stage can run in several threads
+_lock = threading.RLock()
+
+_synchronous_search_suppressed = False
+# Packages recorded by this process and not indexed yet, which the
+# synchronous search plugin does not index
+_deferred = set()
+# Packages recorded by this process since the last flush
+_added_since_flush = 0
+_last_flush = datetime.now()
+_flushing = False
+
+def _suppressible_notify(notify):
+    def suppressible_notify(entity, operation):
+        if getattr(entity, 'id', None) in _deferred:
+            return
+        return notify(entity, operation)
+    suppressible_notify.wrapped = True
+    return suppressible_notify
+
+def suppress_synchronous_indexing():
+    '''Stops the synchronous search plugin from indexing the packages
+    recorded with add_pending until they are indexed by index_pending'''
+    global _synchronous_search_suppressed
+    with _lock:
+        if _synchronous_search_suppressed:
+            return
+        for plugin in plugins.PluginImplementations(IDomainObjectModification):
+            if isinstance(plugin, search.SynchronousSearchPlugin) and \
+               not getattr(plugin.notify, 'wrapped', False):
+                plugin.notify = _suppressible_notify(plugin.notify)
+        _synchronous_search_suppressed = True
+        atexit.register(_index_pending_at_exit)
+        log.info('Synchronous search indexing deferred for bulk import')
+
+def _index_pending_at_exit():
+    try:
+        index_pending()
+    except Exception, e:
+        log.error('Could not index pending packages on exit, run the '
+                  'index-pending command to index them: %s' % e)
+
+def add_pending(package_id, harvest_job_id=None):
+    '''Records a package to be indexed. The row is added to the current
+    session, so it is saved along with the package itself.
+
+    If the package is already recorded its time is updated, so a flush that
+    read the row before this write does not remove it (see index_pending).
+    '''
+    now = datetime.now()
+    updated = Session.execute(pending_index_table.update()
+        .where(pending_index_table.c.package_id==package_id)
+        .values(created=now, harvest_job_id=harvest_job_id))
+    if not updated.rowcount:
+        Session.execute(pending_index_table.insert().values(
+            package_id=package_id,
+            harvest_job_id=harvest_job_id,
+            created=now))
+
+    global _added_since_flush
+    with _lock:
+        _deferred.add(package_id)
+        _added_since_flush += 1
+
+def index_pending_if_needed(batch_size=1000, interval=300):
+    '''Indexes the recorded packages if this process recorded at least
+    `batch_size` of them, or some and the last flush was more than
+    `interval` seconds ago. Does nothing if another thread is already
+    indexing them.'''
+    global _flushing
+    with _lock:
+        needed = _added_since_flush >= batch_size or (_added_since_flush and
+            datetime.now() - _last_flush >= timedelta(seconds=interval))
+        if not needed or _flushing:
+            return 0
+        _flushing = True
+    # Not holding the lock, so the imports in other threads can go on
+    try:
+        return index_pending(batch_size)
+    finally:
+        with _lock:
+            _flushing = False
+
+def pending_count():
+    return Session.execute(
+        select([func.count(pending_index_table.c.package_id)])).scalar()
+
+def index_pending(batch_size=1000):
+    '''Indexes all the recorded packages, committing to the search engine
+    once per batch. Returns the number of packages indexed.'''
+    global _added_since_flush, _last_flush
+    with _lock:
+        _added_since_flush = 0
+        _last_flush = datetime.now()
+
+    indexed = 0
+    # Rows recorded again after being read are kept for the next batch or
+    # flush, as the package might have been written after being indexed
+    delete = pending_index_table.delete().where(and_(
+        pending_index_table.c.package_id==bindparam('b_package_id'),
+        pending_index_table.c.created<=bindparam('b_created')))
+    while True:
+        query = select([pending_index_table.c.package_id,
+                        pending_index_table.c.created]) \
+                .order_by(pending_index_table.c.created) \
+                .limit(batch_size)
+        rows = Session.execute(query).fetchall()
+        if not rows:
+            break
+        package_ids = [row[0] for row in rows]
+
+        done = []
+        for package_id in package_ids:
+            try:
+                search.rebuild(package_id, defer_commit=True)
+                done.append(package_id)
+            except Exception, e:
+                # Most likely the package write that recorded it failed
+                log.error('Could not index package %s: %s' % (package_id, e))
+        search.commit()
+
+        # Failed ones are removed too, we don't want to retry them forever
+        Session.execute(delete, [{'b_package_id': package_id, 'b_created': created}
+                                 for package_id, created in rows])
+        Session.commit()
+        with _lock:
+            _deferred.difference_update(package_ids)
+
+        indexed += len(done)
+        log.info('Indexed %i packages (%i so far)' % (len(done), indexed))
+
+    return indexed
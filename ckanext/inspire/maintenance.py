@@ -0,0 +1,325 @@
+'''
+Database maintenance tasks for the INSPIRE harvesters, run from the paster
+inspire command (see ckanext.inspire.commands)
+'''
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func, literal
+
+from ckan.model import Session, package_extra_table
+
+from ckanext.inspire.model.harvest import harvest_object_info_table, \
+                                         content_blob_table
+from ckanext.inspire.codec import PREFIX, BLOB_PREFIX, DELTA_PREFIX, \
+                                  encode_content, decode_content, \
+                                  delta_content
+
+log = logging.getLogger(__name__)
+
+# Blobs are committed by the gather stage before the objects referencing
+# them, so recent ones are not deleted even if nothing references them yet
+BLOB_GRACE_PERIOD = timedelta(days=1)
+
+# Indexes supporting the queries run on every import. They are only created
+# on PostgreSQL (the partial and operator class ones are specific to it).
+INDEXES = [
+    # Current object for a GUID (write_package_from_gemini_string)
+    ('idx_inspire_harvest_object_guid_current',
+     'CREATE INDEX idx_inspire_harvest_object_guid_current '
+     'ON harvest_object (guid) WHERE current'),
+    # Flagging the objects of a package as not current (_flag_as_current)
+    ('idx_inspire_harvest_object_package_id',
+     'CREATE INDEX idx_inspire_harvest_object_package_id '
+     'ON harvest_object (package_id)'),
+    # Prefix searches on package names (gen_new_name)
+    ('idx_inspire_package_name_lower_pattern',
+     'CREATE INDEX idx_inspire_package_name_lower_pattern '
+     'ON package (lower(name) text_pattern_ops)'),
+]
+
+# The queries that should use the indexes above, with the tables on which a
+# sequential scan means a missing index
+HOT_QUERIES = [
+    ('current object for a GUID',
+     "SELECT id FROM harvest_object WHERE guid = 'guid' AND current = true",
+     'harvest_object'),
+    ('objects of a package',
+     "UPDATE harvest_object SET current = false "
+     "WHERE package_id = 'package-id' AND id != 'object-id'",
+     'harvest_object'),
+    ('package name prefix',
+     "SELECT name FROM package WHERE lower(name) LIKE 'package-name%' LIMIT 100",
+     'package'),
+]
+
+def _is_postgresql():
+    return Session.bind.dialect.name == 'postgresql'
+
+def create_indexes():
+    '''Creates the indexes that are not there yet. Returns the names of the
+    ones created.
+
+    Creating them on big tables can take a while and locks the table for
+    writes, so it is best done when no harvesting is going on.
+    '''
+    if not _is_postgresql():
+        log.warning('Indexes are only created on PostgreSQL')
+        return []
+
+    created = []
+    for name, ddl in INDEXES:
+        exists = Session.execute(
+            'SELECT 1 FROM pg_indexes WHERE indexname = :name',
+            {'name': name}).first()
+        if not exists:
+            log.info('Creating index %s' % name)
+            Session.execute(ddl)
+            Session.commit()
+            created.append(name)
+    return created
+
+def check_query_plans(min_rows=1000):
+    '''Runs EXPLAIN on the queries in HOT_QUERIES.
+
+    Returns a list of (description, plan, ok) tuples, where ok is False if
+    the plan has a sequential scan on a table with more than `min_rows`
+    rows (on smaller tables the planner will rightly prefer one).
+    '''
+    if not _is_postgresql():
+        log.warning('Query plans can only be checked on PostgreSQL')
+        return []
+
+    results = []
+    for description, query, table in HOT_QUERIES:
+        plan = '\n'.join(row[0] for row in
+                         Session.execute('EXPLAIN ' + query))
+        rows = Session.execute(
+            'SELECT reltuples FROM pg_class WHERE relname = :table',
+            {'table': table}).scalar() or 0
+        ok = rows <= min_rows or not ('Seq Scan on %s' % table) in plan
+        results.append((description, plan, ok))
+    # EXPLAIN of an UPDATE does not run it, but leave no transaction open
+    Session.rollback()
+    return results
+
+def _superseded_objects_query(keep, archive):
+    '''Query for the ids of the objects that are neither current nor one of
+    the `keep` latest versions of their GUID'''
+    from ckanext.harvest.model import harvest_object_table, harvest_job_table
+
+    ho = harvest_object_table
+    versions = select([
+            ho.c.id,
+            func.row_number().over(partition_by=ho.c.guid,
+                                   order_by=ho.c.gathered.desc()).label('version'),
+        ]) \
+        .where(ho.c.current==False) \
+        .where(ho.c.guid!=None) \
+        .alias('versions')
+
+    query = select([versions.c.id]) \
+            .where(versions.c.version > keep) \
+            .where(versions.c.id==ho.c.id) \
+            .where(
+                # Leave alone the objects of jobs that are still running
+                ho.c.harvest_job_id.in_(
+                    select([harvest_job_table.c.id])
+                    .where(harvest_job_table.c.status==u'Finished'))) \
+            .where(
+                # and the ones packages still point to (as the object that
+                # last updated them might not be the current one)
+                ~ho.c.id.in_(
+                    select([package_extra_table.c.value])
+                    .where(package_extra_table.c.key==u'harvest_object_id')
+                    .where(package_extra_table.c.state==u'active')
+                    # NOT IN is never true if there is a NULL in the list
+                    .where(package_extra_table.c.value!=None)))
+    if archive:
+        query = query.where(ho.c.content!=None)
+    return query
+
+def compact_harvest_objects(keep=5, archive=False, batch_size=500):
+    '''Removes the harvest objects superseded by newer versions of the same
+    GUID, keeping the current one and the `keep` latest versions.
+
+    If `archive` is True the objects are kept, without their content,
+    otherwise they are deleted along with their errors. The objects to
+    remove are listed once, and each batch of `batch_size` of them is done
+    in its own transaction, so the tables are not locked for long.
+
+    Content blobs no longer referenced by any object (and older than
+    BLOB_GRACE_PERIOD) are deleted as well.
+
+    Returns the number of objects removed or archived.
+    '''
+    from ckanext.harvest.model import harvest_object_table, \
+                                      harvest_object_error_table
+
+    ho = harvest_object_table
+    # Numbering the versions of all the GUIDs is the expensive part, so it
+    # is done once rather than for every batch
+    superseded_ids = [row[0] for row in
+                      Session.execute(_superseded_objects_query(keep, archive))]
+    Session.commit()
+
+    total = 0
+    for i in range(0, len(superseded_ids), batch_size):
+        object_ids = superseded_ids[i:i + batch_size]
+
+        _rebuild_deltas_against(object_ids)
+        if archive:
+            Session.execute(ho.update()
+                .where(ho.c.id.in_(object_ids))
+                .values(content=None))
+        else:
+            Session.execute(harvest_object_error_table.delete()
+                .where(harvest_object_error_table.c.harvest_object_id.in_(object_ids)))
+            Session.execute(harvest_object_info_table.delete()
+                .where(harvest_object_info_table.c.harvest_object_id.in_(object_ids)))
+            Session.execute(ho.delete()
+                .where(ho.c.id.in_(object_ids)))
+        Session.commit()
+
+        total += len(object_ids)
+        log.info('%s %i superseded harvest objects (%i so far)' % \
+                 ('Archived' if archive else 'Deleted', len(object_ids), total))
+
+    if total:
+        _delete_unreferenced_blobs()
+    return total
+
+def _rebuild_deltas_against(object_ids):
+    '''Stores in full the objects stored as deltas against any of these
+    objects, as their content is about to be removed'''
+    from ckanext.harvest.model import harvest_object_table
+
+    ho = harvest_object_table
+    # The objects of a delta and its base have the same GUID
+    guids = select([ho.c.guid]).where(ho.c.id.in_(object_ids))
+    deltas = Session.execute(select([ho.c.id, ho.c.content])
+        .where(ho.c.guid.in_(guids))
+        .where(~ho.c.id.in_(object_ids))
+        .where(ho.c.content.like(DELTA_PREFIX + u'%'))).fetchall()
+    for object_id, content in deltas:
+        base_id = content[len(DELTA_PREFIX):].split(u':', 1)[0]
+        if base_id in object_ids:
+            Session.execute(ho.update()
+                .where(ho.c.id==object_id)
+                .values(content=encode_content(decode_content(content))))
+
+def _delete_unreferenced_blobs(grace_period=BLOB_GRACE_PERIOD):
+    from ckanext.harvest.model import harvest_object_table
+
+    ho = harvest_object_table
+    blob = content_blob_table
+    result = Session.execute(blob.delete()
+        .where(blob.c.created < datetime.now() - grace_period)
+        .where(~(literal(BLOB_PREFIX) + blob.c.content_hash).in_(
+            select([ho.c.content])
+            .where(ho.c.content.like(BLOB_PREFIX + u'%')))))
+    Session.commit()
+    log.info('Deleted %i unreferenced content blobs' % result.rowcount)
+    return result.rowcount
+
+def delta_encode_versions(batch_size=500):
+    '''Stores the superseded versions of each GUID as deltas against the
+    next version, which is kept in full if it is the latest one. The deltas
+    are only stored if they are smaller than the content they replace.
+    Each batch of `batch_size` objects is done in its own transaction.
+
+    Returns the number of objects stored as deltas.
+    '''
+    from ckanext.harvest.model import harvest_object_table, harvest_job_table
+
+    ho = harvest_object_table
+    versions = select([
+            ho.c.id,
+            ho.c.current,
+            ho.c.content,
+            ho.c.harvest_job_id,
+            func.lead(ho.c.id).over(partition_by=ho.c.guid,
+                                    order_by=ho.c.gathered).label('next_id'),
+        ]) \
+        .where(ho.c.guid!=None) \
+        .where(ho.c.content!=None) \
+        .alias('versions')
+    query = select([versions.c.id, versions.c.next_id]) \
+        .where(versions.c.next_id!=None) \
+        .where(versions.c.current==False) \
+        .where(~versions.c.content.like(DELTA_PREFIX + u'%')) \
+        .where(~versions.c.content.like(BLOB_PREFIX + u'%')) \
+        .where(
+            # Leave alone the objects of jobs that are still running
+            versions.c.harvest_job_id.in_(
+                select([harvest_job_table.c.id])
+                .where(harvest_job_table.c.status==u'Finished')))
+    # Objects whose delta is not smaller are left as they are, so the
+    # candidates are read once rather than until there are none left
+    candidates = Session.execute(query).fetchall()
+
+    total = 0
+    for i in range(0, len(candidates), batch_size):
+        batch = candidates[i:i + batch_size]
+        contents = dict(Session.execute(select([ho.c.id, ho.c.content])
+            .where(ho.c.id.in_([row[0] for row in batch] +
+                               [row[1] for row in batch]))).fetchall())
+        stored = 0
+        for object_id, next_id in batch:
+            content = contents[object_id]
+            delta = delta_content(next_id,
+                                  decode_content(contents[next_id]),
+                                  decode_content(content))
+            if len(delta) < len(content):
+                Session.execute(ho.update()
+                    .where(ho.c.id==object_id)
+                    .values(content=delta))
+                stored += 1
+        Session.commit()
+
+        total += stored
+        log.info('Stored %i superseded harvest objects as deltas (%i so far)' % \
+                 (stored, total))
+    return total
+
+def compress_contents(decompress=False, batch_size=500):
+    '''Compresses the content of the harvest objects (and content blobs)
+    stored before the compression was enabled (or, if `decompress` is True,
+    uncompresses all of them, e.g. to disable it). Each batch of
+    `batch_size` rows is done in its own transaction.
+
+    Returns the number of rows changed.
+    '''
+    from ckanext.harvest.model import harvest_object_table
+
+    total = 0
+    for table, key in ((harvest_object_table, harvest_object_table.c.id),
+                       (content_blob_table, content_blob_table.c.content_hash)):
+        query = select([key, table.c.content]).where(table.c.content!=None)
+        if decompress:
+            query = query.where(table.c.content.like(PREFIX + u'%'))
+        else:
+            query = query.where(~table.c.content.like(PREFIX + u'%')) \
+                         .where(~table.c.content.like(BLOB_PREFIX + u'%')) \
+                         .where(~table.c.content.like(DELTA_PREFIX + u'%'))
+
+        while True:
+            rows = Session.execute(query.limit(batch_size)).fetchall()
+            if not rows:
+                break
+
+            for row_key, content in rows:
+                if decompress:
+                    content = decode_content(content)
+                else:
+                    content = encode_content(content, force=True)
+                Session.execute(table.update()
+                    .where(key==row_key)
+                    .values(content=content))
+            Session.commit()
+
+            total += len(rows)
+            log.info('%s the content of %i rows of %s (%i so far)' % \
+                     ('Uncompressed' if decompress else 'Compressed', len(rows),
+                      table.name, total))
+    return total
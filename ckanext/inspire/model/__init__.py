@@ -1,4 +1,6 @@
 from lxml import etree
+import hashlib
+from ckanext.inspire import parsing
     
 import logging
 log = logging.getLogger(__name__)
@@ -36,14 +38,22 @@ class MappedXmlDocument(MappedXmlObject):
 
     def get_xml_tree(self):
         if self.xml_tree is None:
-            parser = etree.XMLParser(remove_blank_text=True)
             if type(self.xml_str) == unicode:
                 xml_str = self.xml_str.encode('utf8')
             else:
                 xml_str = self.xml_str
-            self.xml_tree = etree.fromstring(xml_str, parser=parser)
+            self.xml_tree = parsing.parse(xml_str,
+                parser=parsing.get_parser(remove_blank_text=True))
         return self.xml_tree
 
+    def get_canonical_hash(self):
+        '''Returns a SHA1 hex digest of the canonical form (C14N) of the
+        document, so two documents that only differ in formatting (ie
+        whitespace between elements, attribute order or the order of
+        namespace declarations) get the same hash.'''
+        tree = self.get_xml_tree()
+        return hashlib.sha1(etree.tostring(tree, method='c14n')).hexdigest()
+
     def infer_values(self, values):
         pass
 
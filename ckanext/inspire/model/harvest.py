@@ -0,0 +1,237 @@
+'''
+Tables holding the information the INSPIRE harvesters keep about harvest
+objects, on top of the ones defined in ckanext-harvest
+'''
+import logging
+from datetime import datetime
+
+from sqlalchemy import types, MetaData, Table, Column, ForeignKey, Index
+from sqlalchemy.orm import mapper
+
+from ckan import model
+from ckan.model.meta import metadata, Session
+from ckan.model.domain_object import DomainObject
+from ckan.model.types import make_uuid
+from ckan.lib.helpers import json
+
+from ckanext.harvest.model import setup as harvest_model_setup
+
+log = logging.getLogger(__name__)
+
+__all__ = [
+    'HarvestObjectInfo', 'harvest_object_info_table',
+    'pending_index_table',
+    'ContentBlob', 'content_blob_table',
+    'GatherCheckpoint', 'gather_checkpoint_table',
+    'GatherShard', 'gather_shard_table',
+    'JobTiming', 'job_timing_table',
+    'trace_event_table',
+    'setup',
+]
+
+
+harvest_object_info_table = Table('inspire_harvest_object_info', metadata,
+    Column('harvest_object_id', types.UnicodeText,
+           ForeignKey('harvest_object.id', ondelete='CASCADE'),
+           primary_key=True),
+    # SHA1 of the canonical (C14N) form of the object content
+    Column('content_hash', types.UnicodeText),
+    # SHA1 of the package dict last written to CKAN for this object's GUID
+    Column('package_fingerprint', types.UnicodeText),
+)
+
+Index('idx_inspire_harvest_object_info_content_hash',
+      harvest_object_info_table.c.content_hash)
+
+
+class HarvestObjectInfo(DomainObject):
+    '''Extra information stored for a HarvestObject (keyed by its id)'''
+
+    @classmethod
+    def get(cls, harvest_object_id):
+        return Session.query(cls) \
+                .filter(cls.harvest_object_id==harvest_object_id) \
+                .first()
+
+    @classmethod
+    def get_or_create(cls, harvest_object_id):
+        info = cls.get(harvest_object_id)
+        if info is None:
+            info = cls(harvest_object_id=harvest_object_id)
+            Session.add(info)
+        return info
+
+mapper(HarvestObjectInfo, harvest_object_info_table)
+
+
+# Packages written during a bulk import that still need to be indexed. It is
+# kept in the database so the ids are not lost if the import process dies.
+pending_index_table = Table('inspire_pending_index', metadata,
+    Column('package_id', types.UnicodeText, primary_key=True),
+    Column('harvest_job_id', types.UnicodeText),
+    Column('created', types.DateTime, default=datetime.now),
+)
+
+
+# Content of the harvested documents, stored once for all the harvest objects
+# (from any source) with the same document. The content of those objects is
+# a reference to the blob (see ckanext.inspire.codec).
+content_blob_table = Table('inspire_content_blob', metadata,
+    # SHA1 of the canonical (C14N) form of the document
+    Column('content_hash', types.UnicodeText, primary_key=True),
+    Column('guid', types.UnicodeText),
+    # Stored compressed if ckan.inspire.compress_content is enabled
+    Column('content', types.UnicodeText),
+    Column('created', types.DateTime, default=datetime.now),
+)
+
+
+class ContentBlob(DomainObject):
+    '''A harvested document, keyed by its canonical hash'''
+
+    @classmethod
+    def get(cls, content_hash):
+        return Session.query(cls) \
+                .filter(cls.content_hash==content_hash) \
+                .first()
+
+mapper(ContentBlob, content_blob_table)
+
+
+# Progress of the last gather of a source that did not finish (because it
+# failed, the process died or it ran out of time), so the next one resumes
+# from there. Removed when a gather finishes.
+gather_checkpoint_table = Table('inspire_gather_checkpoint', metadata,
+    Column('harvest_source_id', types.UnicodeText,
+           ForeignKey('harvest_source.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('harvest_job_id', types.UnicodeText),
+    # Number of records of the CSW result set already gathered
+    Column('position', types.Integer, default=0),
+    # Number of gathers in a row that failed at that position
+    Column('failures', types.Integer, default=0),
+    # JSON list of the WAF URLs already gathered
+    Column('processed_urls', types.UnicodeText),
+    Column('updated', types.DateTime, default=datetime.now,
+           onupdate=datetime.now),
+)
+
+
+class GatherCheckpoint(DomainObject):
+    '''Where the gathering of a source stopped'''
+
+    @classmethod
+    def get(cls, harvest_source_id):
+        return Session.query(cls) \
+                .filter(cls.harvest_source_id==harvest_source_id) \
+                .first()
+
+    def get_processed_urls(self):
+        return set(json.loads(self.processed_urls or '[]'))
+
+    def set_processed_urls(self, urls):
+        self.processed_urls = json.dumps(sorted(urls))
+
+mapper(GatherCheckpoint, gather_checkpoint_table)
+
+
+# Ranges of the result set of a CSW source gathered separately, possibly by
+# different nodes (see GeminiCswHarvester.gather_shard)
+gather_shard_table = Table('inspire_gather_shard', metadata,
+    Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+    Column('harvest_job_id', types.UnicodeText,
+           ForeignKey('harvest_job.id', ondelete='CASCADE')),
+    # First and last positions of the range (inclusive, starting at 1)
+    Column('start_position', types.Integer),
+    Column('end_position', types.Integer),
+    # New, Running, Done or Error
+    Column('status', types.UnicodeText, default=u'New'),
+    Column('worker', types.UnicodeText),
+    Column('claimed', types.DateTime),
+)
+
+Index('idx_inspire_gather_shard_job_status',
+      gather_shard_table.c.harvest_job_id, gather_shard_table.c.status)
+
+
+class GatherShard(DomainObject):
+    '''A range of a CSW result set to gather for a job'''
+
+    @classmethod
+    def get(cls, id):
+        return Session.query(cls).filter(cls.id==id).first()
+
+mapper(GatherShard, gather_shard_table)
+
+
+# Durations of the steps of the harvesting of a job, and its counters (see
+# ckanext.inspire.timing). Each process adds a row per step (or counter)
+# every time it flushes its timings, the rows of a job are added up when read.
+job_timing_table = Table('inspire_job_timing', metadata,
+    Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+    Column('harvest_job_id', types.UnicodeText,
+           ForeignKey('harvest_job.id', ondelete='CASCADE')),
+    Column('step', types.UnicodeText),
+    # Number of runs of the step, or total of the counter
+    Column('count', types.Integer),
+    # Total and maximum durations, in seconds
+    Column('total', types.Float),
+    Column('max', types.Float),
+    # JSON list of the number of durations in each bucket (null for counters)
+    Column('histogram', types.UnicodeText),
+    Column('created', types.DateTime, default=datetime.now),
+)
+
+Index('idx_inspire_job_timing_job', job_timing_table.c.harvest_job_id)
+
+
+class JobTiming(DomainObject):
+    '''Timings of a step of a job recorded by a process'''
+
+    @classmethod
+    def get(cls, id):
+        return Session.query(cls).filter(cls.id==id).first()
+
+mapper(JobTiming, job_timing_table)
+
+
+# Spans recorded for the traced jobs (see ckanext.inspire.timing). Each
+# process adds a row with the spans of a job every time it flushes.
+trace_event_table = Table('inspire_trace_event', metadata,
+    Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+    Column('harvest_job_id', types.UnicodeText,
+           ForeignKey('harvest_job.id', ondelete='CASCADE')),
+    # JSON list of Chrome trace events
+    Column('events', types.UnicodeText),
+    Column('created', types.DateTime, default=datetime.now),
+)
+
+Index('idx_inspire_trace_event_job', trace_event_table.c.harvest_job_id)
+
+
+def setup():
+    '''Creates the tables if they are not there yet. It is safe to call it
+    several times.'''
+    # Our tables reference the ckanext-harvest ones
+    harvest_model_setup()
+
+    if not model.repo.are_tables_created():
+        return
+
+    for table in (harvest_object_info_table, pending_index_table,
+                  content_blob_table, gather_checkpoint_table,
+                  gather_shard_table, job_timing_table, trace_event_table):
+        if not table.exists():
+            table.create()
+            log.debug('INSPIRE table %s created', table.name)
+        else:
+            _add_missing_columns(table)
+
+def _add_missing_columns(table):
+    '''Adds the columns added to a table after it was created'''
+    existing = Table(table.name, MetaData(bind=table.bind), autoload=True)
+    for column in table.columns:
+        if not column.name in existing.columns:
+            table.bind.execute('ALTER TABLE %s ADD COLUMN %s %s' % \
+                (table.name, column.name, column.type.compile(table.bind.dialect)))
+            log.info('Column %s added to INSPIRE table %s', column.name, table.name)
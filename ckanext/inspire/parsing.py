@@ -0,0 +1,102 @@
+'''
+Safe fetching and parsing of harvested documents.
+
+Responses are read into a temporary file that is kept in memory up to
+ckan.inspire.spool_size bytes (1MB by default) and spooled to disk past
+that, and the fetch fails as soon as a response is bigger than
+ckan.inspire.max_document_size bytes (50MB by default, 0 for no limit),
+without reading the rest of it. Documents are parsed from those files.
+
+All the XML is parsed with the same hardened parser configuration: no
+network access, no DTD loading and no entity expansion, so hostile
+documents (e.g. "billion laughs" ones) fail cheaply rather than taking the
+process down.
+'''
+import tempfile
+import threading
+
+from lxml import etree
+from pylons import config
+
+# Size of the chunks responses are read in
+CHUNK_SIZE = 64 * 1024
+
+PARSER_OPTIONS = {
+    'resolve_entities': False,
+    'no_network': True,
+    'load_dtd': False,
+    'dtd_validation': False,
+    'huge_tree': False,
+}
+
+# lxml parsers should not be used by several threads at once
+_parsers = threading.local()
+
+class DocumentTooLarge(Exception):
+    pass
+
+def get_max_document_size():
+    return int(config.get('ckan.inspire.max_document_size', 50 * 1024 * 1024))
+
+def get_parser(remove_blank_text=False):
+    '''Returns the hardened XML parser of this thread'''
+    key = 'parser_remove_blank_text' if remove_blank_text else 'parser'
+    parser = getattr(_parsers, key, None)
+    if parser is None:
+        parser = etree.XMLParser(remove_blank_text=remove_blank_text,
+                                 **PARSER_OPTIONS)
+        setattr(_parsers, key, parser)
+    return parser
+
+def get_html_parser():
+    parser = getattr(_parsers, 'html_parser', None)
+    if parser is None:
+        parser = etree.HTMLParser(no_network=True)
+        _parsers.html_parser = parser
+    return parser
+
+def parse(source, parser=None):
+    '''Parses a document from a string or a file object with the hardened
+    parser (or the given one). Returns the root element.'''
+    parser = parser if parser is not None else get_parser()
+    if hasattr(source, 'read'):
+        source.seek(0)
+        return etree.parse(source, parser).getroot()
+    return etree.fromstring(source, parser)
+
+def spool_response(response, url=None, max_size=None):
+    '''Reads an HTTP response (a file like object) into a temporary file,
+    which is returned open and at its start.
+
+    Raises DocumentTooLarge if the response has more than `max_size` bytes
+    (by default ckan.inspire.max_document_size), as soon as its
+    Content-Length says so or that many bytes have been read.
+    '''
+    if max_size is None:
+        max_size = get_max_document_size()
+    url = url or getattr(response, 'url', 'the response')
+
+    info = getattr(response, 'info', None)
+    length = info().getheader('Content-Length') if info else None
+    if max_size and length and length.isdigit() and int(length) > max_size:
+        raise DocumentTooLarge('%s has %s bytes, more than the maximum of %i' % \
+                               (url, length, max_size))
+
+    spooled = tempfile.SpooledTemporaryFile(
+        max_size=int(config.get('ckan.inspire.spool_size', 1024 * 1024)))
+    size = 0
+    try:
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if max_size and size > max_size:
+                raise DocumentTooLarge('%s has more than the maximum of %i bytes' % \
+                                       (url, max_size))
+            spooled.write(chunk)
+    except:
+        spooled.close()
+        raise
+    spooled.seek(0)
+    return spooled
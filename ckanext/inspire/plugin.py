@@ -10,6 +10,18 @@ class InspireApi(SingletonPlugin):
                           action="display_xml")
         route_map.connect("/api/2/rest/harvestobject/:id/html", controller=controller,
                           action="display_html")
+        route_map.connect("/api/2/rest/harvestobject/:id/values", controller=controller,
+                          action="display_values")
+        route_map.connect("/api/2/rest/harvestjob/:id/stats", controller=controller,
+                          action="job_stats")
+        route_map.connect("/api/2/rest/harvestjob/:id/trace", controller=controller,
+                          action="job_trace")
+        route_map.connect("/api/2/rest/harvestsource/:id/stats", controller=controller,
+                          action="source_stats")
+        route_map.connect("/api/2/inspire/stats", controller=controller,
+                          action="stats")
+        route_map.connect("/api/2/inspire/metrics", controller=controller,
+                          action="metrics")
 
 
         return route_map
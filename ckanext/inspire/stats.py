@@ -0,0 +1,204 @@
+'''
+Harvesting performance statistics per job and source, built from the
+timings and counters recorded by ckanext.inspire.timing and the errors
+saved by the harvesters. They are served as JSON by the INSPIRE API, and
+in the Prometheus text format for monitoring::
+
+    /api/2/rest/harvestjob/{id}/stats
+    /api/2/rest/harvestsource/{id}/stats
+    /api/2/inspire/stats
+    /api/2/inspire/metrics
+'''
+from sqlalchemy import select, func
+
+from ckan.model import Session
+
+from ckanext.inspire import timing
+
+STAGES = ['gather', 'fetch', 'import']
+
+# Steps whose duration distribution is reported on its own
+STEPS = ['http', 'csw', 'xml_parse', 'validation', 'mapping', 'wms_check',
+         'package_write', 'commit']
+
+def _rate(count, seconds):
+    return round(count / seconds, 3) if seconds else None
+
+def _hit_rate(hits, misses):
+    return round(float(hits) / (hits + misses), 4) if hits + misses else None
+
+def _error_counts(job_ids):
+    '''Number of gather errors and object errors (by stage) of some jobs'''
+    from ckanext.harvest.model import harvest_object_table, \
+        harvest_gather_error_table, harvest_object_error_table
+
+    if not job_ids:
+        return {}
+    errors = {}
+    errors['gather'] = Session.execute(
+        select([func.count(harvest_gather_error_table.c.id)])
+        .where(harvest_gather_error_table.c.harvest_job_id.in_(job_ids))).scalar()
+    oe = harvest_object_error_table
+    for stage, count in Session.execute(
+            select([oe.c.stage, func.count(oe.c.id)])
+            .where(oe.c.harvest_object_id.in_(
+                select([harvest_object_table.c.id])
+                .where(harvest_object_table.c.harvest_job_id.in_(job_ids))))
+            .group_by(oe.c.stage)):
+        errors[(stage or u'unknown').lower()] = count
+    return errors
+
+def _object_count(job_ids):
+    from ckanext.harvest.model import harvest_object_table
+
+    if not job_ids:
+        return 0
+    return Session.execute(
+        select([func.count(harvest_object_table.c.id)])
+        .where(harvest_object_table.c.harvest_job_id.in_(job_ids))).scalar()
+
+def _build_stats(timings, counters, objects, errors):
+    stages = {}
+    for stage in STAGES:
+        if not stage in timings:
+            continue
+        seconds = timings[stage]['total']
+        # The gather stage runs once per job, but creates all the objects
+        count = objects if stage == 'gather' else timings[stage]['count']
+        stages[stage] = {
+            'objects': count,
+            'seconds': seconds,
+            'objects_per_second': _rate(count, seconds),
+        }
+
+    hits = counters.get('content_store_hits', 0)
+    misses = counters.get('content_store_misses', 0)
+    return {
+        'objects': objects,
+        'stages': stages,
+        'bytes_fetched': counters.get('bytes_fetched', 0),
+        'unchanged_records': counters.get('unchanged_records', 0),
+        'content_store': {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': _hit_rate(hits, misses),
+        },
+        'steps': dict((step, timings[step]) for step in STEPS if step in timings),
+        'errors': errors,
+        'counters': counters,
+    }
+
+def get_job_stats(harvest_job):
+    '''Returns the statistics of a job as a dict'''
+    stats = _build_stats(timing.get_job_timings(harvest_job.id),
+                         timing.get_job_counters(harvest_job.id),
+                         _object_count([harvest_job.id]),
+                         _error_counts([harvest_job.id]))
+    stats.update({
+        'job_id': harvest_job.id,
+        'source_id': harvest_job.source_id,
+        'status': harvest_job.status,
+        'created': harvest_job.created.isoformat() if harvest_job.created else None,
+    })
+    return stats
+
+def _source_job_ids(harvest_source_id):
+    from ckanext.harvest.model import HarvestJob
+
+    return [id for id, in Session.query(HarvestJob.id)
+            .filter(HarvestJob.source_id==harvest_source_id)
+            .order_by(HarvestJob.created.desc())]
+
+def get_source_stats(harvest_source, last_jobs=10):
+    '''Returns the statistics of all the jobs of a source, along with the
+    ones of the last `last_jobs` jobs, as a dict'''
+    from ckanext.harvest.model import HarvestJob
+
+    job_ids = _source_job_ids(harvest_source.id)
+    stats = _build_stats(timing.get_source_timings(harvest_source.id),
+                         timing.get_source_counters(harvest_source.id),
+                         _object_count(job_ids),
+                         _error_counts(job_ids))
+    stats.update({
+        'source_id': harvest_source.id,
+        'url': harvest_source.url,
+        'type': harvest_source.type,
+        'jobs': len(job_ids),
+        'last_jobs': [get_job_stats(HarvestJob.get(id)) for id in job_ids[:last_jobs]],
+    })
+    return stats
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(**labels):
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in sorted(labels.iteritems()))
+
+def get_cache_stats(caches):
+    '''Returns the hits, misses and hit rate of some BoundedCaches (a dict
+    of name: cache) of this process'''
+    return dict((name, {
+        'size': len(cache),
+        'hits': cache.hits,
+        'misses': cache.misses,
+        'hit_rate': _hit_rate(cache.hits, cache.misses),
+    }) for name, cache in caches.iteritems())
+
+def prometheus_metrics(harvest_sources, caches=None):
+    '''Returns the statistics of the last job of each source (and of the
+    given caches of this process, see get_cache_stats) in the Prometheus
+    text exposition format (version 0.0.4)'''
+    from ckanext.harvest.model import HarvestJob
+
+    metrics = [
+        ('objects', 'Objects gathered by the last job of the source', []),
+        ('stage_objects_per_second', 'Objects processed per second of stage time by the last job of the source', []),
+        ('stage_seconds', 'Time spent in each stage by the last job of the source', []),
+        ('step_seconds', 'Percentiles of the duration of each step in the last job of the source', []),
+        ('bytes_fetched', 'Bytes fetched by the last job of the source', []),
+        ('content_store_hit_ratio', 'Ratio of gathered documents already in the content store in the last job of the source', []),
+        ('errors', 'Errors saved by the last job of the source', []),
+        ('cache_hits', 'Hits of the caches of this process', []),
+        ('cache_misses', 'Misses of the caches of this process', []),
+    ]
+    samples = dict((name, lines) for name, help, lines in metrics)
+
+    for harvest_source in harvest_sources:
+        job_ids = _source_job_ids(harvest_source.id)
+        if not job_ids:
+            continue
+        stats = get_job_stats(HarvestJob.get(job_ids[0]))
+        source = dict(source=harvest_source.id, type=harvest_source.type)
+
+        samples['objects'].append((source, stats['objects']))
+        for stage, stage_stats in sorted(stats['stages'].iteritems()):
+            labels = dict(source, stage=stage)
+            if stage_stats['objects_per_second'] is not None:
+                samples['stage_objects_per_second'].append(
+                    (labels, stage_stats['objects_per_second']))
+            samples['stage_seconds'].append((labels, stage_stats['seconds']))
+        for step, summary in sorted(stats['steps'].iteritems()):
+            for percent in timing.PERCENTILES:
+                samples['step_seconds'].append(
+                    (dict(source, step=step, quantile=str(percent / 100.0)),
+                     summary['p%i' % percent]))
+        samples['bytes_fetched'].append((source, stats['bytes_fetched']))
+        if stats['content_store']['hit_rate'] is not None:
+            samples['content_store_hit_ratio'].append(
+                (source, stats['content_store']['hit_rate']))
+        for stage, count in sorted(stats['errors'].iteritems()):
+            samples['errors'].append((dict(source, stage=stage), count))
+
+    for name, cache_stats in sorted(get_cache_stats(caches or {}).iteritems()):
+        samples['cache_hits'].append((dict(cache=name), cache_stats['hits']))
+        samples['cache_misses'].append((dict(cache=name), cache_stats['misses']))
+
+    lines = []
+    for name, help, metric_samples in metrics:
+        name = 'ckan_inspire_harvest_' + name
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s gauge' % name)
+        for labels, value in metric_samples:
+            lines.append('%s%s %s' % (name, _labels(**labels), value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,38 @@
+from nose.tools import assert_equal
+
+from ckan.lib.helpers import json
+
+from ckanext.inspire.model import GeminiDocument
+from ckanext.inspire.benchmarks import run
+from ckanext.inspire.benchmarks.corpus import generate_document, generate_documents
+
+class TestCorpus:
+
+    def test_generate_document(self):
+        document = generate_document(7, 'service', resource_url='http://127.0.0.1/missing')
+        values = GeminiDocument(document).read_values()
+
+        assert_equal(values['guid'], 'benchmark-service-000007')
+        assert_equal(values['resource-type'], 'service')
+        assert_equal(values['title'], 'Benchmark service 000007')
+        for resource_locator in values['resource-locator']:
+            assert_equal(resource_locator['url'], 'http://127.0.0.1/missing')
+
+    def test_generate_document_size(self):
+        document = generate_document(1, 'dataset', size=100000)
+        assert_equal(len(document), 100000)
+
+    def test_generate_documents(self):
+        names = [name for name, document in generate_documents(6)]
+        assert_equal(len(set(names)), 6)
+
+class TestBenchmarks:
+
+    def test_run(self):
+        results = run(3, benchmarks=['read_values'])
+
+        assert_equal(results['corpus']['count'], 3)
+        assert_equal([result['name'] for result in results['results']],
+                     ['read_values'])
+        assert_equal(results['results'][0]['count'], 3)
+        assert json.dumps(results)
@@ -0,0 +1,33 @@
+from nose.tools import assert_equal
+
+from ckanext.inspire.cache import BoundedCache
+
+class TestBoundedCache:
+
+    def test_get_set(self):
+        cache = BoundedCache(2)
+        cache.set('a', 1)
+
+        assert_equal(cache.get('a'), 1)
+        assert_equal(cache.get('b'), None)
+        assert_equal(cache.get('b', 'default'), 'default')
+        assert_equal((cache.hits, cache.misses), (1, 2))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = BoundedCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Touch 'a' so 'b' becomes the oldest entry
+        cache.get('a')
+        cache.set('c', 3)
+
+        assert_equal(len(cache), 2)
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+
+    def test_zero_size_disables_cache(self):
+        cache = BoundedCache(0)
+        cache.set('a', 1)
+
+        assert_equal(len(cache), 0)
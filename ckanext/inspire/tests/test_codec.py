@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from nose.tools import assert_equal
+
+from ckanext.inspire.codec import (encode_content, decode_content, is_encoded,
+                                   make_delta, apply_delta)
+
+class TestCodec:
+
+    def test_roundtrip(self):
+        content = u'<gmd:MD_Metadata>Caf\xe9</gmd:MD_Metadata>' * 100
+        encoded = encode_content(content, force=True)
+
+        assert is_encoded(encoded)
+        assert len(encoded) < len(content)
+        assert_equal(decode_content(encoded), content)
+
+    def test_disabled_by_default(self):
+        content = u'<gmd:MD_Metadata/>'
+        assert_equal(encode_content(content), content)
+
+    def test_uncompressed_content_is_returned_as_is(self):
+        content = u'<gmd:MD_Metadata/>'
+        assert_equal(decode_content(content), content)
+        assert_equal(decode_content(None), None)
+
+    def test_not_encoded_twice(self):
+        encoded = encode_content(u'<gmd:MD_Metadata/>', force=True)
+        assert_equal(encode_content(encoded, force=True), encoded)
+
+    def test_delta(self):
+        base = u'<a><b>1</b><c>Caf\xe9</c><d>2012-01-01</d></a>'
+        content = u'<a><b>1</b><c>Caf\xe9</c><d>2012-02-01</d><e/></a>'
+
+        delta = make_delta(base, content)
+        assert_equal(apply_delta(base, delta), content)
+        # Only the changed parts are stored
+        assert not u'<c>' in u''.join(op for op in delta if not isinstance(op, list))
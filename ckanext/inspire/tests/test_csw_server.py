@@ -0,0 +1,89 @@
+from nose.tools import assert_equal
+
+from ckan.lib.base import config
+from ckanext.harvest.model import HarvestObject
+
+from ckanext.inspire.harvesters import GeminiCswHarvester
+from ckanext.inspire.benchmarks.corpus import generate_document
+
+from ckanext.inspire.benchmarks.csw_server import CswEmulator, serve_csw, \
+                                                 namespaces
+from test_harvest import HarvestFixtureBase
+
+CSW = '{%s}' % namespaces['csw']
+
+documents = [generate_document(i, 'dataset') for i in range(15)]
+
+class TestCswEmulator:
+
+    def test_get_records_paging(self):
+        emulator = CswEmulator(documents)
+
+        response = emulator.get_records(start_position=11, max_records=10)
+        results = response.find(CSW + 'SearchResults')
+        assert_equal(results.get('numberOfRecordsMatched'), '15')
+        assert_equal(results.get('numberOfRecordsReturned'), '5')
+        assert_equal(results.get('nextRecord'), '0')
+
+        response = emulator.get_records(start_position=1, max_records=10)
+        assert_equal(response.find(CSW + 'SearchResults').get('nextRecord'), '11')
+
+    def test_get_records_hits(self):
+        response = CswEmulator(documents).get_records(result_type='hits')
+        results = response.find(CSW + 'SearchResults')
+        assert_equal(results.get('numberOfRecordsMatched'), '15')
+        assert_equal(len(results), 0)
+
+    def test_get_records_modified(self):
+        # One document per minute from 2012-01-01 00:00
+        response = CswEmulator(documents).handle_kvp({
+            'request': 'GetRecords',
+            'constraint': "modified >= '2012-01-01T00:10:00'"})
+        assert_equal(response.find(CSW + 'SearchResults').get('numberOfRecordsMatched'), '5')
+
+    def test_get_record_by_id(self):
+        response = CswEmulator(documents).get_record_by_id(['benchmark-dataset-000003'])
+        assert_equal(len(response), 1)
+        assert 'benchmark-dataset-000003' in response[0].xpath(
+            'gmd:fileIdentifier/gco:CharacterString/text()', namespaces=namespaces)
+
+class TestCswHarvest(HarvestFixtureBase):
+
+    @classmethod
+    def setup_class(cls):
+        HarvestFixtureBase.setup_class()
+        cls.csw = serve_csw(documents=documents)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.csw.shutdown()
+
+    def _create_csw_job(self):
+        source, job = self._create_source_and_job({
+            'url': u'http://127.0.0.1:8997/csw',
+            'type': u'csw'
+        })
+        return job
+
+    def test_gather_and_fetch(self):
+        job = self._create_csw_job()
+        harvester = GeminiCswHarvester()
+
+        object_ids = harvester.gather_stage(job)
+        assert_equal(len(object_ids), len(documents))
+
+        for object_id in object_ids:
+            obj = HarvestObject.get(object_id)
+            assert harvester.fetch_stage(obj)
+            assert obj.guid in obj.content
+
+    def test_sharded_gather(self):
+        job = self._create_csw_job()
+
+        config['ckan.inspire.csw.shard_size'] = '4'
+        try:
+            object_ids = GeminiCswHarvester().gather_stage(job)
+        finally:
+            del config['ckan.inspire.csw.shard_size']
+
+        assert_equal(len(object_ids), len(documents))
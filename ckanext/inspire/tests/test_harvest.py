@@ -1,22 +1,31 @@
-from datetime import datetime, date
+import time
+from datetime import datetime, date, timedelta
+from threading import Thread
 import lxml
 
 from nose.tools import assert_equal, assert_in
+from nose.plugins.skip import SkipTest
 
 from ckan import plugins
 from ckan.lib.base import config
 from ckan import model
 from ckan.model import Session,Package
 from ckan.logic.schema import default_update_package_schema
-from ckan.logic import get_action
+from ckan.logic import get_action, ValidationError
 import ckanext.inspire
 from ckanext.harvest.model import (setup as harvest_model_setup,
                                     HarvestSource,HarvestJob,HarvestObject)
 from ckanext.csw.validation import Validator
-from ckanext.inspire.harvesters import GeminiCswHarvester, GeminiDocHarvester, GeminiWafHarvester, SpatialHarvester
+from ckanext.inspire.harvesters import GeminiCswHarvester, GeminiDocHarvester, GeminiWafHarvester, SpatialHarvester, \
+                                       GatheredIds
+from ckanext.inspire.model.harvest import (setup as inspire_model_setup,
+                                           HarvestObjectInfo, ContentBlob,
+                                           GatherCheckpoint, GatherShard)
+from ckanext.inspire import indexing, timing, stats
+from ckanext.inspire.codec import is_encoded, is_reference, decode_content
 from ckanext.csw.validation import SchematronValidator
 
-from simple_http_server import serve
+from ckanext.inspire.benchmarks.http_server import serve
 
 class HarvestFixtureBase:
 
@@ -26,6 +35,7 @@ class HarvestFixtureBase:
     def setup_class(cls):
         # Setup harvest tables
         harvest_model_setup()
+        inspire_model_setup()
 
         # Start simple HTTP server
         if not cls.serving:
@@ -175,6 +185,714 @@ class TestHarvest(HarvestFixtureBase):
             assert obj.current == True
             assert obj.package_id in pkg_ids
 
+    def test_harvest_timings(self):
+
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/waf/index.html',
+            'type': u'gemini-waf'
+        }
+        source, job = self._create_source_and_job(source_fixture)
+
+        harvester = GeminiWafHarvester()
+        object_ids = harvester.gather_stage(job)
+        for object_id in object_ids:
+            harvester.import_stage(HarvestObject.get(object_id))
+        timing.flush()
+
+        timings = timing.get_job_timings(job.id)
+        for step in ('gather', 'http', 'xml_parse', 'validation', 'mapping',
+                     'import', 'package_write', 'commit'):
+            assert step in timings, step
+        assert_equal(timings['gather']['count'], 1)
+        # The index page and the two documents
+        assert_equal(timings['http']['count'], 3)
+        assert_equal(timings['import']['count'], 2)
+        assert timings['import']['total'] >= timings['package_write']['total']
+
+        assert_equal(timing.get_source_timings(source.id)['import']['count'], 2)
+
+    def test_harvest_trace(self):
+
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/waf/index.html',
+            'type': u'gemini-waf'
+        }
+        source, job = self._create_source_and_job(source_fixture)
+
+        harvester = GeminiWafHarvester()
+        config['ckan.inspire.trace'] = source.id
+        try:
+            object_ids = harvester.gather_stage(job)
+            for object_id in object_ids:
+                harvester.import_stage(HarvestObject.get(object_id))
+        finally:
+            del config['ckan.inspire.trace']
+        timing.flush()
+
+        trace = timing.get_job_trace(job.id)
+        spans = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+        assert_equal(len([span for span in spans if span['name'] == 'gather']), 1)
+        assert_equal(len([span for span in spans if span['name'] == 'http']), 3)
+        guids = set(HarvestObject.get(object_id).guid for object_id in object_ids)
+        import_spans = [span for span in spans if span['name'] == 'import']
+        assert_equal(set(span['args']['guid'] for span in import_spans), guids)
+        validation_spans = [span for span in spans if span['name'] == 'validation'
+                            and 'guid' in span['args']]
+        assert_equal(len(validation_spans), 2)
+
+        # Other jobs are not traced
+        other_job = self._create_job(source.id)
+        harvester.gather_stage(other_job)
+        timing.flush()
+        assert_equal(timing.get_job_trace(other_job.id)['traceEvents'], [])
+
+    def test_harvest_stats(self):
+
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/waf/index.html',
+            'type': u'gemini-waf'
+        }
+        source, job = self._create_source_and_job(source_fixture)
+
+        harvester = GeminiWafHarvester()
+        object_ids = harvester.gather_stage(job)
+        for object_id in object_ids:
+            harvester.import_stage(HarvestObject.get(object_id))
+        timing.flush()
+
+        job_stats = stats.get_job_stats(job)
+        assert_equal(job_stats['objects'], 2)
+        assert_equal(job_stats['stages']['gather']['objects'], 2)
+        assert_equal(job_stats['stages']['import']['objects'], 2)
+        assert job_stats['stages']['import']['objects_per_second'] > 0
+        assert job_stats['bytes_fetched'] > 0
+        assert 'validation' in job_stats['steps']
+        assert_equal(job_stats['errors'].get('gather'), 0)
+
+        source_stats = stats.get_source_stats(source)
+        assert_equal(source_stats['jobs'], 1)
+        assert_equal(source_stats['last_jobs'][0]['job_id'], job.id)
+
+        metrics = stats.prometheus_metrics([source])
+        assert 'ckan_inspire_harvest_objects{source="%s",type="gemini-waf"} 2' % source.id in metrics
+        assert 'ckan_inspire_harvest_stage_objects_per_second{source="%s",stage="import",type="gemini-waf"}' % source.id in metrics
+        assert '# TYPE ckan_inspire_harvest_step_seconds gauge' in metrics
+
+    def test_harvest_streaming_gather(self):
+
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/waf/index.html',
+            'type': u'gemini-waf'
+        }
+        source, job = self._create_source_and_job(source_fixture)
+
+        queued = []
+        original_queue = GatheredIds.__dict__['_queue']
+        GatheredIds._queue = lambda self, object_ids: queued.extend(object_ids)
+        config['ckan.inspire.gather.chunk_size'] = '1'
+        try:
+            object_ids = GeminiWafHarvester().gather_stage(job)
+        finally:
+            GatheredIds._queue = original_queue
+            del config['ckan.inspire.gather.chunk_size']
+
+        # The first id was sent to the fetch queue while gathering, the last
+        # one is returned
+        assert_equal(len(queued), 1)
+        assert_equal(len(object_ids), 1)
+        assert_equal(Session.query(HarvestObject).count(), 2)
+        assert HarvestObject.get(queued[0]).guid != HarvestObject.get(object_ids[0]).guid
+
+    def test_harvest_gather_time_budget(self):
+
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/waf/index.html',
+            'type': u'gemini-waf'
+        }
+        source, first_job = self._create_source_and_job(source_fixture)
+
+        # The first document uses up all the time budget
+        harvester = GeminiWafHarvester()
+        harvester._get_gather_deadline = lambda: datetime.now() + timedelta(seconds=1)
+        def slow_open_content(url):
+            content = GeminiWafHarvester._open_content(harvester, url)
+            time.sleep(1.1)
+            return content
+        harvester._open_content = slow_open_content
+
+        # The harvester is a singleton, so the other tests would get them
+        try:
+            first_ids = harvester.gather_stage(first_job)
+        finally:
+            del harvester._get_gather_deadline
+            del harvester._open_content
+        assert_equal(len(first_ids), 1)
+
+        checkpoint = GatherCheckpoint.get(source.id)
+        assert checkpoint
+        assert_equal(checkpoint.harvest_job_id, first_job.id)
+        assert_equal(len(checkpoint.get_processed_urls()), 1)
+
+        # The next run gathers the rest
+        second_job = self._create_job(source.id)
+        second_ids = GeminiWafHarvester().gather_stage(second_job)
+        assert_equal(len(second_ids), 1)
+        assert HarvestObject.get(first_ids[0]).guid != HarvestObject.get(second_ids[0]).guid
+
+        Session.remove()
+        assert not GatherCheckpoint.get(source.id)
+
+    def _gather_csw_failing(self, listed, fail_at, runs):
+        '''Gathers a fake CSW source `runs` times. Listing the records fails
+        when it gets to position `fail_at` (if not None). Returns the start
+        positions requested and the ids gathered in each run.'''
+        start_positions = []
+        class FakeCswService(object):
+            def getidentifiers(self, page=10, startposition=1, **kw):
+                start_positions.append(startposition)
+                for position in range(startposition, len(listed) + 1):
+                    if position == fail_at:
+                        raise Exception('Broken page')
+                    yield listed[position - 1]
+
+        harvester = GeminiCswHarvester()
+        harvester._setup_csw_client = lambda url: FakeCswService()
+        source, job = self._create_source_and_job({
+            'url': u'http://127.0.0.1:8999/csw',
+            'type': u'csw'
+        })
+        gathered = []
+        try:
+            for run in range(runs):
+                if run:
+                    job = self._create_job(source.id)
+                gathered.append(harvester.gather_stage(job))
+        finally:
+            # The harvester is a singleton, so the other tests would get it
+            del harvester._setup_csw_client
+        return source, start_positions, gathered
+
+    def test_harvest_csw_gather_resume(self):
+
+        listed = ['record-%02i' % i for i in range(1, 26)]
+        # The first run fails after 12 records
+        source, start_positions, gathered = self._gather_csw_failing(listed, 13, 1)
+        assert_equal(len(gathered[0]), 12)
+        checkpoint = GatherCheckpoint.get(source.id)
+        assert_equal(checkpoint.position, 12)
+        assert_equal(checkpoint.failures, 1)
+
+        # The next one continues from there
+        harvester = GeminiCswHarvester()
+        class FakeCswService(object):
+            def getidentifiers(self, page=10, startposition=1, **kw):
+                start_positions.append(startposition)
+                return iter(listed[startposition - 1:])
+        harvester._setup_csw_client = lambda url: FakeCswService()
+        try:
+            second_ids = harvester.gather_stage(self._create_job(source.id))
+        finally:
+            del harvester._setup_csw_client
+
+        assert_equal(start_positions, [1, 13])
+        assert_equal(sorted(HarvestObject.get(id).guid for id in gathered[0] + second_ids),
+                     listed)
+        Session.remove()
+        assert not GatherCheckpoint.get(source.id)
+
+    def test_harvest_csw_gather_resume_failures(self):
+
+        listed = ['record-%02i' % i for i in range(1, 26)]
+        # The same page always fails, so after failing three times at the
+        # same position the gathering starts again from the beginning
+        source, start_positions, gathered = self._gather_csw_failing(listed, 13, 4)
+        assert_equal(start_positions, [1, 13, 13, 1])
+        assert_equal([len(ids or []) for ids in gathered], [12, 0, 0, 12])
+
+        Session.remove()
+        checkpoint = GatherCheckpoint.get(source.id)
+        assert_equal(checkpoint.position, 12)
+        assert_equal(checkpoint.failures, 1)
+
+    def test_harvest_sharded_csw_gather(self):
+
+        # Records 11 and 12 are listed twice, at the end of the first shard
+        # and the start of the second one, as if records had been added to
+        # the server while gathering
+        identifiers = ['record-%02i' % i for i in range(1, 26)]
+        listed = identifiers[:12] + identifiers[10:]
+        class FakeCswService(object):
+            def getidentifiers(self, page=10, startposition=1, **kw):
+                for identifier in listed[startposition - 1:]:
+                    yield identifier
+
+        harvester = GeminiCswHarvester()
+        harvester._setup_csw_client = lambda url: FakeCswService()
+        harvester._get_csw_hit_count = lambda url: len(listed)
+
+        source, job = self._create_source_and_job({
+            'url': u'http://127.0.0.1:8999/csw',
+            'type': u'csw'
+        })
+
+        config['ckan.inspire.csw.shard_size'] = '12'
+        try:
+            object_ids = harvester.gather_stage(job)
+        finally:
+            del config['ckan.inspire.csw.shard_size']
+            # The harvester is a singleton, so the other tests would get them
+            del harvester._setup_csw_client
+            del harvester._get_csw_hit_count
+
+        assert_equal(len(object_ids), len(identifiers))
+        assert_equal(sorted(HarvestObject.get(id).guid for id in object_ids),
+                     identifiers)
+        assert_equal(Session.query(HarvestObject).count(), len(identifiers))
+        assert_equal(Session.query(GatherShard).count(), 0)
+
+    def test_harvest_gather_skip_unchanged(self):
+
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/single/dataset1.xml',
+            'type': u'gemini-single'
+        }
+        source, first_job = self._create_source_and_job(source_fixture)
+        first_obj = self._run_job_for_single_document(first_job)
+
+        harvester = GeminiDocHarvester()
+        config['ckan.inspire.gather.skip_unchanged'] = 'true'
+        try:
+            # The document has not changed, nothing to fetch or import
+            second_job = self._create_job(source.id)
+            assert_equal(harvester.gather_stage(second_job), [])
+            assert_equal(Session.query(HarvestObject).count(), 1)
+
+            # Unless the import is forced
+            harvester.force_import = True
+            third_job = self._create_job(source.id)
+            assert_equal(len(harvester.gather_stage(third_job)), 1)
+        finally:
+            del config['ckan.inspire.gather.skip_unchanged']
+            harvester.force_import = False
+
+    def test_harvest_compressed_content(self):
+
+        # Create source
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/single/dataset1.xml',
+            'type': u'gemini-single'
+        }
+
+        source, job = self._create_source_and_job(source_fixture)
+
+        config['ckan.inspire.compress_content'] = 'true'
+        try:
+            obj = self._run_job_for_single_document(job)
+        finally:
+            del config['ckan.inspire.compress_content']
+
+        # Content stored compressed, and imported normally
+        assert is_encoded(obj.content)
+        assert obj.current == True
+        assert obj.package
+
+    def test_harvest_deduplicated_content(self):
+
+        validated = []
+        class CountingValidator(object):
+            def __init__(self, validator):
+                self.validator = validator
+            def is_valid(self, xml):
+                validated.append(xml)
+                return self.validator.is_valid(xml)
+
+        original_validator = SpatialHarvester._validator
+        SpatialHarvester._validator = CountingValidator(original_validator)
+        config['ckan.inspire.deduplicate_content'] = 'true'
+        try:
+            harvester = GeminiDocHarvester()
+
+            source1, first_job = self._create_source_and_job({
+                'url': u'http://127.0.0.1:8999/single/source1/same_dataset.xml',
+                'type': u'gemini-single'
+            })
+            first_ids = harvester.gather_stage(first_job)
+            assert_equal(len(validated), 1)
+
+            # The same document from another source is not validated again
+            source2, second_job = self._create_source_and_job({
+                'url': u'http://127.0.0.1:8999/single/source2/same_dataset.xml',
+                'type': u'gemini-single'
+            })
+            second_ids = harvester.gather_stage(second_job)
+            assert_equal(len(validated), 1)
+
+            first_obj = HarvestObject.get(first_ids[0])
+            second_obj = HarvestObject.get(second_ids[0])
+            assert_equal(first_obj.guid, second_obj.guid)
+
+            # Both objects point to the same stored document
+            assert is_reference(first_obj.content)
+            assert_equal(first_obj.content, second_obj.content)
+            assert_equal(Session.query(ContentBlob).count(), 1)
+            assert 'MD_Metadata' in decode_content(second_obj.content)
+
+            # And they are imported as usual
+            harvester.import_stage(first_obj)
+            Session.refresh(first_obj)
+            assert first_obj.current == True
+            assert first_obj.package
+        finally:
+            SpatialHarvester._validator = original_validator
+            del config['ckan.inspire.deduplicate_content']
+
+    def test_harvest_import_threads(self):
+
+        # With an in memory SQLite database each thread gets its own
+        # connection, and so an empty database
+        if Session.bind.dialect.name != 'postgresql':
+            raise SkipTest('Importing from several threads needs PostgreSQL')
+
+        # Create source
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/waf/index.html',
+            'type': u'gemini-waf'
+        }
+
+        source, job = self._create_source_and_job(source_fixture)
+
+        harvester = GeminiWafHarvester()
+
+        object_ids = harvester.gather_stage(job)
+        assert len(object_ids) == 2
+
+        # Import each object from a different thread, using the same
+        # harvester instance, and each thread creating its own validator
+        results = {}
+        validators = {}
+        def import_object(object_id):
+            try:
+                results[object_id] = harvester.import_stage(HarvestObject.get(object_id))
+                validators[object_id] = harvester._get_validator()
+            finally:
+                Session.remove()
+
+        original_validator = SpatialHarvester._validator
+        SpatialHarvester._validator = None
+        try:
+            threads = [Thread(target=import_object, args=(object_id,)) for object_id in object_ids]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            SpatialHarvester._validator = original_validator
+
+        assert_equal(results, dict((object_id, True) for object_id in object_ids))
+        assert_equal(len(set(validators.values())), 2)
+        assert not original_validator in validators.values()
+
+        pkgs = Session.query(Package).all()
+        assert len(pkgs) == 2
+
+        pkg_ids = [pkg.id for pkg in pkgs]
+        for object_id in object_ids:
+            obj = HarvestObject.get(object_id)
+            assert obj.current == True
+            assert obj.package_id in pkg_ids
+
+    def test_harvest_parallel_importers_same_guid(self):
+
+        if Session.bind.dialect.name != 'postgresql':
+            raise SkipTest('GUID locks are only available on PostgreSQL')
+
+        # Create source
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/single/dataset1.xml',
+            'type': u'gemini-single'
+        }
+
+        source, job = self._create_source_and_job(source_fixture)
+
+        harvester = GeminiDocHarvester()
+
+        object_ids = harvester.gather_stage(job)
+        first_obj = HarvestObject.get(object_ids[0])
+
+        # Several copies of the same record, imported at the same time
+        for i in range(7):
+            obj = HarvestObject(guid=first_obj.guid, job=job, content=first_obj.content)
+            obj.save()
+            object_ids.append(obj.id)
+        guid = first_obj.guid
+        Session.remove()
+
+        def import_object(object_id):
+            try:
+                harvester.import_stage(HarvestObject.get(object_id))
+            finally:
+                Session.remove()
+
+        threads = [Thread(target=import_object, args=(object_id,)) for object_id in object_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Only one package was created, and there is only one current object
+        current_objects = Session.query(HarvestObject) \
+                          .filter(HarvestObject.guid==guid) \
+                          .filter(HarvestObject.current==True).all()
+        assert_equal(len(current_objects), 1)
+        assert_equal(Session.query(Package).count(), 1)
+        for object_id in object_ids:
+            assert_equal(len(HarvestObject.get(object_id).errors), 0)
+
+    def test_harvest_import_batch(self):
+
+        # Create source
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/waf/index.html',
+            'type': u'gemini-waf'
+        }
+
+        source, job = self._create_source_and_job(source_fixture)
+
+        harvester = GeminiWafHarvester()
+
+        object_ids = harvester.gather_stage(job)
+        assert len(object_ids) == 2
+
+        objects = [HarvestObject.get(object_id) for object_id in object_ids]
+        # The same object twice, the second time it is found unchanged
+        objects.append(objects[0])
+
+        assert_equal(harvester.import_batch(objects), 3)
+
+        pkgs = Session.query(Package).all()
+        assert len(pkgs) == 2
+
+        pkg_ids = [pkg.id for pkg in pkgs]
+        for obj in objects:
+            Session.refresh(obj)
+            assert obj.current == True
+            assert obj.package_id in pkg_ids
+            assert len(obj.errors) == 0
+
+    def test_harvest_import_batch_rolled_back(self):
+
+        source, job = self._create_source_and_job({
+            'url': u'http://127.0.0.1:8999/waf/index.html',
+            'type': u'gemini-waf'
+        })
+        harvester = GeminiWafHarvester()
+        object_ids = harvester.gather_stage(job)
+        assert len(object_ids) == 2
+
+        doc_source, doc_job = self._create_source_and_job({
+            'url': u'http://127.0.0.1:8999/single/dataset1.xml',
+            'type': u'gemini-single'
+        })
+        invalid_ids = GeminiDocHarvester().gather_stage(doc_job)
+        assert len(invalid_ids) == 1
+
+        # The invalid record is in the middle of the batch
+        objects = [HarvestObject.get(id) for id in
+                   (object_ids[0], invalid_ids[0], object_ids[1])]
+
+        def write_package(harvest_context, content, **kw):
+            if harvest_context.harvest_object.id == invalid_ids[0]:
+                # What the CKAN package actions do on validation errors
+                Session.rollback()
+                raise ValidationError({'name': [u'Invalid']})
+            return GeminiWafHarvester.write_package_from_gemini_string(
+                harvester, harvest_context, content, **kw)
+        harvester.write_package_from_gemini_string = write_package
+
+        # The harvester is a singleton, so the other tests would get it
+        try:
+            assert_equal(harvester.import_batch(objects), 2)
+        finally:
+            del harvester.write_package_from_gemini_string
+
+        # The records around the invalid one were committed
+        Session.remove()
+        assert_equal(Session.query(Package).count(), 2)
+        for object_id in object_ids:
+            obj = HarvestObject.get(object_id)
+            assert obj.current == True
+            assert obj.package
+            assert_equal(len(obj.errors), 0)
+
+        invalid_obj = HarvestObject.get(invalid_ids[0])
+        assert not invalid_obj.current
+        assert_equal(len(invalid_obj.errors), 1)
+
+    def test_harvest_import_batch_errors_kept(self):
+
+        source, job = self._create_source_and_job({
+            'url': u'http://127.0.0.1:8999/waf/index.html',
+            'type': u'gemini-waf'
+        })
+        harvester = GeminiWafHarvester()
+        object_ids = harvester.gather_stage(job)
+        assert len(object_ids) == 2
+
+        objects = [HarvestObject.get(object_id) for object_id in object_ids]
+
+        def write_package(harvest_context, content, **kw):
+            if harvest_context.harvest_object.id == object_ids[0]:
+                # Like the validation errors saved before writing the package
+                harvester._save_object_error('Validation error',
+                    harvest_context.harvest_object, 'Import', harvest_context)
+                raise Exception('Could not write package')
+            return GeminiWafHarvester.write_package_from_gemini_string(
+                harvester, harvest_context, content, **kw)
+        harvester.write_package_from_gemini_string = write_package
+
+        # The harvester is a singleton, so the other tests would get it
+        try:
+            assert_equal(harvester.import_batch(objects), 1)
+        finally:
+            del harvester.write_package_from_gemini_string
+
+        Session.remove()
+        failed_obj = HarvestObject.get(object_ids[0])
+        assert not failed_obj.current
+        messages = sorted(error.message for error in failed_obj.errors)
+        assert_equal(messages, ['Error importing Gemini document: Could not write package',
+                                'Validation error'])
+        assert_equal(len(HarvestObject.get(object_ids[1]).errors), 0)
+
+    def test_harvest_import_batch_locked_guid(self):
+
+        source, job = self._create_source_and_job({
+            'url': u'http://127.0.0.1:8999/waf/index.html',
+            'type': u'gemini-waf'
+        })
+        harvester = GeminiWafHarvester()
+        object_ids = harvester.gather_stage(job)
+        assert len(object_ids) == 2
+
+        objects = [HarvestObject.get(object_id) for object_id in object_ids]
+        locked_guid = objects[0].guid
+
+        calls = []
+        def lock_guid(guid, wait=True):
+            calls.append((guid, wait))
+            # Held by another importer while the batch runs
+            return wait or guid != locked_guid
+        harvester._lock_guid = lock_guid
+
+        # The harvester is a singleton, so the other tests would get it
+        try:
+            assert_equal(harvester.import_batch(objects), 2)
+        finally:
+            del harvester._lock_guid
+
+        # Imported after the batch, waiting for the lock
+        assert_equal(calls[-1], (locked_guid, True))
+
+        Session.remove()
+        assert_equal(Session.query(Package).count(), 2)
+        for object_id in object_ids:
+            obj = HarvestObject.get(object_id)
+            assert obj.current == True
+            assert obj.package
+            assert_equal(len(obj.errors), 0)
+
+    def test_harvest_import_batch_with_pool(self):
+
+        # Create source
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/waf/index.html',
+            'type': u'gemini-waf'
+        }
+
+        source, job = self._create_source_and_job(source_fixture)
+
+        harvester = GeminiWafHarvester()
+
+        object_ids = harvester.gather_stage(job)
+        assert len(object_ids) == 2
+
+        objects = [HarvestObject.get(object_id) for object_id in object_ids]
+
+        pool = harvester.get_import_pool(2)
+        try:
+            assert_equal(harvester.import_batch(objects, pool=pool), 2)
+        finally:
+            pool.close()
+            pool.join()
+
+        pkgs = Session.query(Package).all()
+        assert len(pkgs) == 2
+
+        pkg_ids = [pkg.id for pkg in pkgs]
+        for obj in objects:
+            Session.refresh(obj)
+            assert obj.current == True
+            assert obj.package_id in pkg_ids
+            assert HarvestObjectInfo.get(obj.id).content_hash
+
+    def test_harvest_bulk_import(self):
+
+        # Create source
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/waf/index.html',
+            'type': u'gemini-waf'
+        }
+
+        source, job = self._create_source_and_job(source_fixture)
+
+        harvester = GeminiWafHarvester()
+        harvester.bulk_import = True
+        try:
+            object_ids = harvester.gather_stage(job)
+            assert len(object_ids) == 2
+
+            for object_id in object_ids:
+                harvester.import_stage(HarvestObject.get(object_id))
+
+            # Packages were created but not indexed yet
+            pkgs = Session.query(Package).all()
+            assert len(pkgs) == 2
+            assert_equal(indexing.pending_count(), 2)
+
+            assert_equal(indexing.index_pending(), 2)
+            assert_equal(indexing.pending_count(), 0)
+            # The synchronous search plugin indexes them again from now on
+            assert not indexing._deferred
+        finally:
+            harvester.bulk_import = False
+            indexing._deferred.clear()
+
+    def test_index_pending_written_while_indexing(self):
+        from ckan.lib import search
+
+        indexing.add_pending(u'package-1')
+        Session.commit()
+
+        # The package is written again while it is being indexed
+        rebuilt = []
+        original_rebuild = search.rebuild
+        def rebuild(package_id, **kw):
+            if not rebuilt:
+                time.sleep(0.01)
+                indexing.add_pending(package_id)
+                Session.commit()
+            rebuilt.append(package_id)
+        search.rebuild = rebuild
+        try:
+            indexing.index_pending()
+        finally:
+            search.rebuild = original_rebuild
+            indexing._deferred.clear()
+
+        # So it was indexed again
+        assert_equal(rebuilt, [u'package-1', u'package-1'])
+        assert_equal(indexing.pending_count(), 0)
+
     def test_harvest_fields_service(self):
 
         # Create source
@@ -427,6 +1145,25 @@ class TestHarvest(HarvestFixtureBase):
         assert job.gather_errors[0].harvest_job_id == job.id
         assert 'Unable to get content for URL' in job.gather_errors[0].message
 
+    def test_harvest_error_document_too_large(self):
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/single/dataset1.xml',
+            'type': u'gemini-single'
+        }
+
+        source, job = self._create_source_and_job(source_fixture)
+
+        config['ckan.inspire.max_document_size'] = '1000'
+        try:
+            object_ids = GeminiDocHarvester().gather_stage(job)
+        finally:
+            del config['ckan.inspire.max_document_size']
+        assert object_ids is None
+
+        assert len(job.gather_errors) == 1
+        assert 'Unable to get content for URL' in job.gather_errors[0].message
+        assert 'more than the maximum of 1000' in job.gather_errors[0].message
+
     def test_harvest_error_validation(self):
 
         # Create source
@@ -526,14 +1263,123 @@ class TestHarvest(HarvestFixtureBase):
 
         third_package_dict = get_action('package_show_rest')(self.context,{'id':third_obj.package_id})
 
-        # Package was updated
+        # The document did not change, so neither did the package dict and the
+        # package was not updated, but the forced object is now the current one
         assert third_package_dict, first_package_dict['id'] == third_package_dict['id']
-        assert third_package_dict['metadata_modified'] > second_package_dict['metadata_modified']
+        assert third_package_dict['metadata_modified'] == second_package_dict['metadata_modified']
         assert third_obj.package, third_obj.package_id == first_package_dict['id']
         assert third_obj.current == True
         assert second_obj.current == False
         assert first_obj.current == False
 
+    def test_harvest_forced_import_unchanged_package(self):
+
+        # Create source
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/single/dataset1.xml',
+            'type': u'gemini-single'
+        }
+
+        source, first_job = self._create_source_and_job(source_fixture)
+
+        first_obj = self._run_job_for_single_document(first_job)
+
+        first_package_dict = get_action('package_show_rest')(self.context,{'id':first_obj.package_id})
+
+        # With the check disabled, forcing the import always updates the package
+        config['ckan.inspire.skip_unchanged_packages'] = 'false'
+        try:
+            second_job = self._create_job(source.id)
+            second_obj = self._run_job_for_single_document(second_job,force_import=True)
+        finally:
+            del config['ckan.inspire.skip_unchanged_packages']
+
+        Session.remove()
+        Session.add(first_obj)
+        Session.add(second_obj)
+
+        Session.refresh(first_obj)
+        Session.refresh(second_obj)
+
+        second_package_dict = get_action('package_show_rest')(self.context,{'id':second_obj.package_id})
+
+        # Package was updated
+        assert second_package_dict['id'] == first_package_dict['id']
+        assert second_package_dict['metadata_modified'] > first_package_dict['metadata_modified']
+        assert second_obj.current == True
+        assert first_obj.current == False
+
+        # Same fingerprint for both versions
+        assert_equal(HarvestObjectInfo.get(first_obj.id).package_fingerprint,
+                     HarvestObjectInfo.get(second_obj.id).package_fingerprint)
+
+    def test_harvest_newer_metadata_date_unchanged_package(self):
+
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/single/dataset1.xml',
+            'type': u'gemini-single'
+        }
+
+        source, first_job = self._create_source_and_job(source_fixture)
+        first_obj = self._run_job_for_single_document(first_job)
+        first_package_dict = get_action('package_show_rest')(self.context,{'id':first_obj.package_id})
+
+        # Only the metadata date of the document moved forward
+        source.url = u'http://127.0.0.1:8999/single/dataset1_newer_date.xml'
+        source.save()
+        second_job = self._create_job(source.id)
+        second_obj = self._run_job_for_single_document(second_job)
+
+        Session.remove()
+        Session.add(first_obj)
+        Session.add(second_obj)
+        Session.refresh(first_obj)
+        Session.refresh(second_obj)
+
+        second_package_dict = get_action('package_show_rest')(self.context,{'id':first_obj.package_id})
+
+        # The package was not updated through package_update, but a new
+        # revision points to the new current object and has its metadata date
+        assert_equal(second_package_dict['metadata_modified'],
+                     first_package_dict['metadata_modified'])
+        assert_equal(second_package_dict['extras']['harvest_object_id'], second_obj.id)
+        assert_equal(second_package_dict['extras']['metadata-date'], u'2011-09-24T10:06:08')
+        assert second_obj.current == True
+        assert first_obj.current == False
+        assert_equal(second_obj.package_id, first_obj.package_id)
+
+    def test_harvest_unchanged_document_different_formatting(self):
+
+        # Create source
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/single/dataset1.xml',
+            'type': u'gemini-single'
+        }
+
+        source, first_job = self._create_source_and_job(source_fixture)
+
+        first_obj = self._run_job_for_single_document(first_job)
+
+        # Same document, with no whitespace between elements
+        parser = lxml.etree.XMLParser(remove_blank_text=True)
+        compact_content = lxml.etree.tostring(lxml.etree.fromstring(first_obj.content, parser=parser))
+        assert compact_content != first_obj.content
+
+        second_job = self._create_job(source.id)
+        second_obj = HarvestObject(guid=first_obj.guid, job=second_job, content=compact_content)
+        second_obj.save()
+
+        harvester = GeminiDocHarvester()
+        harvester.import_stage(second_obj)
+        Session.refresh(second_obj)
+
+        # Not considered a change, and the package was not updated
+        assert len(second_obj.errors) == 0
+        assert not second_obj.package_id
+        assert second_obj.current == False
+        assert_equal(HarvestObjectInfo.get(first_obj.id).content_hash,
+                     HarvestObjectInfo.get(second_obj.id).content_hash)
+
     def test_harvest_deleted_record(self):
 
         # Create source
@@ -661,9 +1507,10 @@ class TestHarvest(HarvestFixtureBase):
 
         third_package_dict = get_action('package_show_rest')(self.context,{'id':first_obj.package_id})
 
-        # Package was updated
+        # The document did not change, so neither did the package dict and the
+        # package was not updated, but the forced object is now the current one
         assert third_package_dict, first_package_dict['id'] == third_package_dict['id']
-        assert third_package_dict['metadata_modified'] > second_package_dict['metadata_modified']
+        assert third_package_dict['metadata_modified'] == second_package_dict['metadata_modified']
         assert third_obj.package, third_obj.package_id == first_package_dict['id']
         assert third_obj.current == True
         assert second_obj.current == False
@@ -793,9 +1640,10 @@ class TestHarvest(HarvestFixtureBase):
 
         after_package_dict = get_action('package_show_rest')(self.context,{'id':imported_objects[0]['package_id']})
 
-        # Package was updated, and the current object remains the same
+        # Package was not updated as nothing changed, and the current object
+        # remains the same
         assert after_package_dict, before_package_dict['id'] == after_package_dict['id']
-        assert after_package_dict['metadata_modified'] > before_package_dict['metadata_modified']
+        assert after_package_dict['metadata_modified'] == before_package_dict['metadata_modified']
         assert third_obj.current == False
         assert second_obj.current == False
         assert first_obj.current == True
@@ -0,0 +1,89 @@
+import time
+import socket
+import threading
+import urllib2
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.inspire.harvesters import GeminiWafHarvester
+
+from ckanext.inspire.benchmarks.http_server import serve
+
+PORT = 8996
+BASE_URL = 'http://127.0.0.1:%i/' % PORT
+
+class TestNetworkConditions:
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = serve(PORT, seed=1)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+
+    def teardown(self):
+        self.server.set_conditions(latency=0, first_byte_delay=0, bandwidth=None,
+                                   error_rate=0, reset_rate=0)
+
+    def _get(self, path, timeout=10):
+        return urllib2.urlopen(BASE_URL + path, None, timeout).read()
+
+    def test_files(self):
+        content = self._get('single/dataset1.xml')
+        assert 'MD_Metadata' in content
+
+    def test_latency(self):
+        self.server.set_conditions(latency=0.3)
+        start = time.time()
+        self._get('single/dataset1.xml')
+        assert time.time() - start >= 0.3
+
+    def test_first_byte_delay_timeout(self):
+        self.server.set_conditions(first_byte_delay=1)
+        assert_raises(socket.timeout, self._get, 'wms/slow', timeout=0.2)
+
+    def test_bandwidth(self):
+        self.server.set_conditions(bandwidth=50000)
+        start = time.time()
+        content = self._get('single/dataset1.xml')
+        assert time.time() - start >= 0.8 * len(content) / 50000
+
+    def test_errors(self):
+        self.server.set_conditions(error_rate=1)
+        try:
+            self._get('single/dataset1.xml')
+            assert False, 'No error raised'
+        except urllib2.HTTPError, e:
+            assert_equal(e.code, 503)
+
+    def test_reset(self):
+        self.server.set_conditions(reset_rate=1)
+        assert_raises((socket.error, urllib2.URLError),
+                      self._get, 'single/dataset1.xml')
+
+    def test_is_wms(self):
+        harvester = GeminiWafHarvester()
+        assert harvester._is_wms(BASE_URL + 'wms/roads')
+        assert not harvester._is_wms(BASE_URL + 'single/dataset1.xml')
+
+    def test_generated_waf(self):
+        harvester = GeminiWafHarvester()
+        url = BASE_URL + 'waf/1000/index.html'
+        urls = harvester._extract_urls(self._get('waf/1000/index.html'), url)
+        assert_equal(len(urls), 1000)
+
+        content = harvester._get_content(urls[10])
+        assert 'benchmark-dataset-000009' not in content
+        assert 'benchmark-series-000010' in content
+
+    def test_concurrent_requests(self):
+        self.server.set_conditions(latency=0.3)
+        self.server.max_active = 0
+        threads = [threading.Thread(target=self._get, args=('wms/layer',))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(self.server.max_active, 4)
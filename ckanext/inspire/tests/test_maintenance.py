@@ -0,0 +1,147 @@
+from datetime import datetime, timedelta
+
+from nose.tools import assert_equal
+from nose.plugins.skip import SkipTest
+
+from ckan import model
+from ckan.model import Session
+from ckanext.harvest.model import HarvestObject
+
+from ckanext.inspire.codec import is_delta, decode_content
+from ckanext.inspire.model.harvest import ContentBlob
+
+from ckanext.inspire.maintenance import (create_indexes, check_query_plans,
+                                         compact_harvest_objects,
+                                         delta_encode_versions,
+                                         _delete_unreferenced_blobs,
+                                         INDEXES, HOT_QUERIES)
+
+from test_harvest import HarvestFixtureBase
+
+class TestIndexes(HarvestFixtureBase):
+
+    def setup(self):
+        if Session.bind.dialect.name != 'postgresql':
+            raise SkipTest('Indexes are only created on PostgreSQL')
+        HarvestFixtureBase.setup(self)
+
+    def test_create_indexes(self):
+        create_indexes()
+
+        # Already there
+        assert_equal(create_indexes(), [])
+        for name, ddl in INDEXES:
+            assert Session.execute('SELECT 1 FROM pg_indexes WHERE indexname = :name',
+                                   {'name': name}).first()
+
+    def test_check_query_plans(self):
+        create_indexes()
+
+        results = check_query_plans()
+        assert_equal(len(results), len(HOT_QUERIES))
+        for description, plan, ok in results:
+            assert plan
+            assert ok, plan
+
+class VersionsFixtureBase(HarvestFixtureBase):
+
+    def _harvest_versions(self, number):
+        source_fixture = {
+            'url': u'http://127.0.0.1:8999/single/dataset1.xml',
+            'type': u'gemini-single'
+        }
+        source, job = self._create_source_and_job(source_fixture)
+
+        objects = [self._run_job_for_single_document(job)]
+        for i in range(number - 1):
+            job = self._create_job(source.id)
+            objects.append(self._run_job_for_single_document(job))
+        return [obj.id for obj in objects]
+
+class TestCompaction(VersionsFixtureBase):
+
+    def test_compact(self):
+        object_ids = self._harvest_versions(4)
+
+        # The first object is the current one, the last is the latest
+        # superseded version
+        assert_equal(compact_harvest_objects(keep=1), 2)
+
+        remaining = [obj.id for obj in Session.query(HarvestObject)]
+        assert_equal(sorted(remaining), sorted([object_ids[0], object_ids[3]]))
+
+        # Nothing else to do
+        assert_equal(compact_harvest_objects(keep=1), 0)
+
+    def test_compact_null_package_extra(self):
+        object_ids = self._harvest_versions(3)
+
+        # A package extra without a value must not stop everything from
+        # being compacted
+        rev = model.repo.new_revision()
+        package = model.Package(name=u'no-harvest-object')
+        Session.add(package)
+        Session.add(model.PackageExtra(package=package,
+                                       key=u'harvest_object_id', value=None))
+        model.repo.commit_and_remove()
+
+        assert_equal(compact_harvest_objects(keep=0), 2)
+
+        remaining = [obj.id for obj in Session.query(HarvestObject)]
+        assert_equal(remaining, [object_ids[0]])
+
+    def test_compact_archive(self):
+        object_ids = self._harvest_versions(3)
+
+        assert_equal(compact_harvest_objects(keep=0, archive=True), 2)
+
+        Session.remove()
+        assert HarvestObject.get(object_ids[0]).content
+        for object_id in object_ids[1:]:
+            obj = HarvestObject.get(object_id)
+            assert obj
+            assert obj.content is None
+
+    def test_delete_unreferenced_blobs(self):
+        for content_hash, age in ((u'recent', timedelta(hours=1)),
+                                  (u'old', timedelta(days=2))):
+            blob = ContentBlob(content_hash=content_hash, content=u'<xml/>',
+                               created=datetime.now() - age)
+            Session.add(blob)
+        Session.commit()
+
+        # Only the old one, the recent one may be about to be referenced
+        assert_equal(_delete_unreferenced_blobs(), 1)
+
+        Session.remove()
+        assert ContentBlob.get(u'recent')
+        assert not ContentBlob.get(u'old')
+
+class TestDeltas(VersionsFixtureBase):
+
+    def test_delta_encode_versions(self):
+        object_ids = self._harvest_versions(4)
+        contents = dict((object_id, HarvestObject.get(object_id).content)
+                        for object_id in object_ids)
+
+        # The current object and the latest version are kept in full
+        assert_equal(delta_encode_versions(), 2)
+
+        Session.remove()
+        for object_id in object_ids:
+            obj = HarvestObject.get(object_id)
+            assert_equal(is_delta(obj.content), object_id in object_ids[1:3])
+            assert_equal(decode_content(obj.content), contents[object_id])
+
+        # Nothing else to do
+        assert_equal(delta_encode_versions(), 0)
+
+    def test_compact_deltas(self):
+        object_ids = self._harvest_versions(4)
+        delta_encode_versions()
+
+        assert_equal(compact_harvest_objects(keep=1), 2)
+
+        Session.remove()
+        assert_equal(decode_content(HarvestObject.get(object_ids[3]).content),
+                     decode_content(HarvestObject.get(object_ids[0]).content))
@@ -0,0 +1,88 @@
+'''
+Memory regression tests for the gather stage.
+
+They gather a generated WAF (served by ckanext.inspire.benchmarks.http_server)
+of 1000 documents, and check that the peak memory of the process grows by
+less than 20 MB. A big WAF takes a while, so it is only gathered when
+INSPIRE_MEMORY_TESTS is set::
+
+    INSPIRE_MEMORY_TESTS=1 nosetests --ckan ckanext/inspire/tests/test_memory.py
+
+The size of that WAF (20000 documents by default) and the ceiling of the
+growth of the peak memory while gathering it (in MB, 100 by default) can be
+changed with INSPIRE_MEMORY_TEST_SIZE and INSPIRE_MEMORY_TEST_CEILING.
+'''
+import os
+import gc
+import resource
+
+from nose.tools import assert_equal
+
+from ckan.model import Session
+from ckanext.harvest.model import HarvestObject
+
+from ckanext.inspire.harvesters import GeminiWafHarvester
+
+from test_harvest import HarvestFixtureBase
+
+if os.environ.get('INSPIRE_MEMORY_TESTS'):
+    SIZE = int(os.environ.get('INSPIRE_MEMORY_TEST_SIZE', 20000))
+    CEILING = int(os.environ.get('INSPIRE_MEMORY_TEST_CEILING', 100))
+else:
+    SIZE = 1000
+    CEILING = 20
+
+class AlwaysValid(object):
+    '''The validation is not what is being measured'''
+
+    def is_valid(self, xml):
+        return True, []
+
+def _peak_memory():
+    '''Peak resident memory of the process so far, in MB'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on Mac OS X, KB elsewhere
+    return peak / (1024.0 * 1024 if os.uname()[0] == 'Darwin' else 1024.0)
+
+def _live_harvest_objects():
+    gc.collect()
+    return len([obj for obj in gc.get_objects() if isinstance(obj, HarvestObject)])
+
+class TestGatherMemory(HarvestFixtureBase):
+
+    def test_waf_gather_memory(self):
+        source, job = self._create_source_and_job({
+            'url': u'http://127.0.0.1:8999/waf/%i/index.html' % SIZE,
+            'type': u'gemini-waf'
+        })
+
+        harvester = GeminiWafHarvester()
+        harvester._validator = AlwaysValid()
+
+        # Count the harvest objects alive every tenth of the documents
+        samples = []
+        fetched = [0]
+        def open_content(url):
+            fetched[0] += 1
+            if fetched[0] % max(SIZE / 10, 1) == 0:
+                samples.append(_live_harvest_objects())
+            return GeminiWafHarvester._open_content(harvester, url)
+        harvester._open_content = open_content
+
+        # The harvester is a singleton, so the other tests would get them
+        try:
+            gc.collect()
+            start_peak = _peak_memory()
+            object_ids = harvester.gather_stage(job)
+            growth = _peak_memory() - start_peak
+        finally:
+            del harvester._validator
+            del harvester._open_content
+
+        assert_equal(len(object_ids), SIZE)
+        assert_equal(Session.query(HarvestObject)
+                     .filter(HarvestObject.harvest_job_id==job.id).count(), SIZE)
+        # The objects gathered are not kept in memory
+        assert samples
+        assert max(samples) < 10, samples
+        assert growth < CEILING, 'Peak memory grew by %.1f MB' % growth
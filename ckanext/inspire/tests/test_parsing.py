@@ -0,0 +1,91 @@
+from StringIO import StringIO
+
+from lxml import etree
+from nose.tools import assert_equal, assert_raises
+
+from ckan.lib.base import config
+
+from ckanext.inspire import parsing
+from ckanext.inspire.parsing import DocumentTooLarge
+
+BILLION_LAUGHS = '''<?xml version="1.0"?>
+<!DOCTYPE lolz [
+  <!ENTITY lol "lol">
+  <!ENTITY lol1 "&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;">
+  <!ENTITY lol2 "&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;">
+  <!ENTITY lol3 "&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;">
+  <!ENTITY lol4 "&lol3;&lol3;&lol3;&lol3;&lol3;&lol3;&lol3;&lol3;&lol3;&lol3;">
+  <!ENTITY lol5 "&lol4;&lol4;&lol4;&lol4;&lol4;&lol4;&lol4;&lol4;&lol4;&lol4;">
+  <!ENTITY lol6 "&lol5;&lol5;&lol5;&lol5;&lol5;&lol5;&lol5;&lol5;&lol5;&lol5;">
+  <!ENTITY lol7 "&lol6;&lol6;&lol6;&lol6;&lol6;&lol6;&lol6;&lol6;&lol6;&lol6;">
+  <!ENTITY lol8 "&lol7;&lol7;&lol7;&lol7;&lol7;&lol7;&lol7;&lol7;&lol7;&lol7;">
+  <!ENTITY lol9 "&lol8;&lol8;&lol8;&lol8;&lol8;&lol8;&lol8;&lol8;&lol8;&lol8;">
+]>
+<lolz>&lol9;</lolz>
+'''
+
+EXTERNAL_ENTITY = '''<?xml version="1.0"?>
+<!DOCTYPE test [
+  <!ENTITY passwd SYSTEM "file:///etc/passwd">
+]>
+<test>&passwd;</test>
+'''
+
+class FakeHeaders(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+class FakeResponse(StringIO):
+    url = 'http://fake/document.xml'
+
+    def __init__(self, content, headers=None):
+        StringIO.__init__(self, content)
+        self.headers = FakeHeaders(headers or {})
+
+    def info(self):
+        return self.headers
+
+class TestParsing:
+
+    def test_parse_string_and_file(self):
+        content = '<?xml version="1.0" encoding="utf-8"?><a><b>1</b></a>'
+        assert_equal(parsing.parse(content).find('b').text, '1')
+        assert_equal(parsing.parse(StringIO(content)).find('b').text, '1')
+
+    def test_entities_not_expanded(self):
+        xml = parsing.parse(BILLION_LAUGHS)
+        assert len(etree.tostring(xml)) < 1000
+
+    def test_external_entities_not_resolved(self):
+        xml = parsing.parse(EXTERNAL_ENTITY)
+        assert not 'root:' in etree.tostring(xml)
+
+    def test_spool_response(self):
+        content = 'x' * 5000
+        config['ckan.inspire.spool_size'] = '1000'
+        try:
+            spooled = parsing.spool_response(FakeResponse(content))
+        finally:
+            del config['ckan.inspire.spool_size']
+        # Bigger than the spool size, so written to disk
+        assert spooled._rolled
+        assert_equal(spooled.read(), content)
+
+    def test_spool_response_too_large(self):
+        response = FakeResponse('x' * 500000)
+        assert_raises(DocumentTooLarge, parsing.spool_response, response, max_size=1000)
+        # It gave up after the first chunk
+        assert_equal(response.tell(), parsing.CHUNK_SIZE)
+
+    def test_spool_response_content_length_too_large(self):
+        response = FakeResponse('x' * 10, {'Content-Length': '5000'})
+        assert_raises(DocumentTooLarge, parsing.spool_response, response, max_size=1000)
+        # Nothing was read
+        assert_equal(response.tell(), 0)
+
+    def test_spool_response_no_limit(self):
+        spooled = parsing.spool_response(FakeResponse('x' * 5000), max_size=0)
+        assert_equal(len(spooled.read()), 5000)
@@ -0,0 +1,118 @@
+from nose.tools import assert_equal
+
+from ckan.lib.base import config
+
+from ckanext.inspire import timing
+from ckanext.inspire.timing import StepTimings, timed, stage
+
+class FakeJob(object):
+    id = u'fake-job'
+
+class FakeObject(object):
+    id = u'fake-object'
+    guid = u'fake-guid'
+    harvest_job_id = u'fake-job'
+
+class FakeHarvester(object):
+
+    @stage('gather')
+    def gather_stage(self, harvest_job):
+        with timed('http'):
+            pass
+        with timed('http'):
+            pass
+        # Nested stages count for the outer one
+        self.other_stage(harvest_job)
+
+    @stage('other')
+    def other_stage(self, harvest_job):
+        with timed('validation'):
+            pass
+
+    @stage('import')
+    def import_stage(self, harvest_object):
+        with timed('package_write', action='package_create'):
+            with timed('commit'):
+                pass
+
+class TestStepTimings:
+
+    def test_percentiles(self):
+        step_timings = StepTimings()
+        for i in range(90):
+            step_timings.add(0.004)
+        for i in range(10):
+            step_timings.add(1.5)
+
+        assert_equal(step_timings.count, 100)
+        assert_equal(step_timings.max, 1.5)
+        summary = step_timings.as_dict()
+        assert_equal(summary['p50'], 0.005)
+        assert_equal(summary['p95'], 1.5)
+        assert_equal(summary['mean'], round((90 * 0.004 + 15) / 100, 4))
+
+    def test_merge(self):
+        first = StepTimings()
+        first.add(0.1)
+        second = StepTimings()
+        second.add(100)
+        first.merge(second)
+
+        assert_equal(first.count, 2)
+        assert_equal(first.max, 100)
+        assert_equal(sum(first.histogram), 2)
+
+class TestStages:
+
+    def setup(self):
+        timing._timings = {}
+        timing._spans = {}
+        # Don't flush to the database
+        config['ckan.inspire.timing.flush_interval'] = '100000'
+
+    def teardown(self):
+        timing._timings = {}
+        timing._spans = {}
+        del config['ckan.inspire.timing.flush_interval']
+
+    def test_stage(self):
+        FakeHarvester().gather_stage(FakeJob())
+
+        steps = timing._timings[u'fake-job']
+        assert_equal(sorted(steps.keys()), ['gather', 'http', 'validation'])
+        assert_equal(steps['http'].count, 2)
+        assert_equal(steps['gather'].count, 1)
+
+    def test_trace(self):
+        FakeHarvester().import_stage(FakeObject())
+        assert_equal(timing._spans, {})
+
+        config['ckan.inspire.trace'] = 'fake-job'
+        try:
+            FakeHarvester().import_stage(FakeObject())
+        finally:
+            del config['ckan.inspire.trace']
+
+        spans = dict((span['name'], span) for span in timing._spans[u'fake-job'])
+        assert_equal(sorted(spans.keys()), ['commit', 'import', 'package_write'])
+        for span in spans.values():
+            assert_equal(span['ph'], 'X')
+            assert_equal(span['args']['guid'], u'fake-guid')
+        assert_equal(spans['package_write']['args']['action'], 'package_create')
+        # The spans are nested
+        assert spans['import']['ts'] <= spans['package_write']['ts'] <= spans['commit']['ts']
+        assert spans['commit']['ts'] + spans['commit']['dur'] <= \
+               spans['import']['ts'] + spans['import']['dur'] + 1
+
+    def test_outside_stage(self):
+        with timed('http'):
+            pass
+        assert_equal(timing._timings, {})
+
+    def test_disabled(self):
+        config['ckan.inspire.timing'] = 'false'
+        try:
+            FakeHarvester().gather_stage(FakeJob())
+        finally:
+            del config['ckan.inspire.timing']
+        assert_equal(timing._timings, {})
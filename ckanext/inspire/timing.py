@@ -0,0 +1,382 @@
+'''
+Timing of the steps of the harvesting (HTTP requests, XML parsing,
+validation, mapping, package writes, commits...) per harvest job.
+
+The harvester stages are decorated with `stage`, which sets the job the
+steps timed with `timed` while it runs belong to::
+
+    with timed('validation'):
+        valid, messages = validator.is_valid(xml)
+
+Counters of other things happening during a stage (e.g. bytes fetched) are
+kept with `increment`::
+
+    increment('bytes_fetched', len(content))
+
+Each process keeps the count, total, maximum and a histogram of the
+durations of each step of each job (and its counters) in memory, and adds
+them to the inspire_job_timing table every ckan.inspire.timing.flush_interval
+seconds (60 by default) and at the end of each gather stage. Steps timed
+outside a stage (e.g. in the processes of the import pool) are not recorded.
+Timing can be disabled with ckan.inspire.timing = false.
+
+The timings of a job or source are read with get_job_timings and
+get_source_timings (and the counters with get_job_counters and
+get_source_counters), or with::
+
+    paster inspire timings {job-or-source-id} --config=<config file>
+
+The jobs listed in ckan.inspire.trace (or the jobs of the sources listed)
+are also traced: every stage and step is recorded as a span, with the
+GUID of the object being processed, and stored in the inspire_trace_event
+table when the timings are flushed. get_job_trace returns them as Chrome
+trace events, which can be opened with chrome://tracing or Perfetto::
+
+    paster inspire trace {job-id} --output=trace.json --config=<config file>
+'''
+import os
+import time
+import atexit
+import logging
+import threading
+from datetime import datetime, timedelta
+from functools import wraps
+
+from sqlalchemy import select, func
+
+from pylons import config
+from paste.deploy.converters import asbool
+
+from ckan.model import Session
+from ckan.lib.helpers import json
+
+from ckanext.inspire.model.harvest import job_timing_table, trace_event_table
+
+log = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the buckets of the duration histograms. The
+# last bucket has the durations over the last bound.
+BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+           1, 2, 5, 10, 30, 60, 300]
+
+PERCENTILES = [50, 95, 99]
+
+# Protects the module state below, stages can run in several threads
+_lock = threading.Lock()
+# Job of the stage running in each thread
+_current = threading.local()
+# {job id: {step: StepTimings}} recorded since the last flush
+_timings = {}
+# {job id: {counter: total}} since the last flush
+_counters = {}
+# {job id: [trace event]} of the traced jobs since the last flush
+_spans = {}
+# {job id: whether it is traced}
+_traced_jobs = {}
+_last_flush = datetime.now()
+_atexit_registered = False
+
+def timing_enabled():
+    return asbool(config.get('ckan.inspire.timing', True))
+
+class StepTimings(object):
+    '''Count, total and maximum duration of a step, and a histogram of
+    the durations to estimate percentiles'''
+
+    def __init__(self, count=0, total=0.0, max=0.0, histogram=None):
+        self.count = count
+        self.total = total
+        self.max = max
+        self.histogram = histogram or [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    def percentile(self, percent):
+        '''Upper bound of the bucket of the given percentile (or the
+        maximum, if lower)'''
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, bucket_count in enumerate(self.histogram):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                bound = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        summary = {
+            'count': self.count,
+            'total': round(self.total, 4),
+            'mean': round(self.total / self.count, 4) if self.count else None,
+            'max': round(self.max, 4),
+        }
+        for percent in PERCENTILES:
+            summary['p%i' % percent] = self.percentile(percent)
+        return summary
+
+def _trace_ids():
+    return set(config.get('ckan.inspire.trace', '').split())
+
+def _is_traced(job_id):
+    '''Whether the job, or its source, is listed in ckan.inspire.trace'''
+    trace_ids = _trace_ids()
+    if not trace_ids or job_id is None:
+        return False
+    if job_id in trace_ids:
+        return True
+    if not job_id in _traced_jobs:
+        from ckanext.harvest.model import harvest_job_table
+        source_id = Session.execute(select([harvest_job_table.c.source_id])
+            .where(harvest_job_table.c.id==job_id)).scalar()
+        _traced_jobs[job_id] = source_id in trace_ids
+    return _traced_jobs[job_id]
+
+def record(step, seconds, start=None, args=None):
+    '''Adds a duration of `step` to the job of the current stage (and a
+    span starting at `start`, with the given `args`, if it is traced)'''
+    job_id = getattr(_current, 'job_id', None)
+    if job_id is None:
+        return
+    with _lock:
+        steps = _timings.setdefault(job_id, {})
+        if not step in steps:
+            steps[step] = StepTimings()
+        steps[step].add(seconds)
+
+        if getattr(_current, 'traced', False) and start is not None:
+            spans = _spans.setdefault(job_id, [])
+            if len(spans) < int(config.get('ckan.inspire.trace.max_spans', 100000)):
+                span_args = dict(getattr(_current, 'args', {}))
+                if args:
+                    span_args.update(args)
+                spans.append({
+                    'name': step,
+                    'cat': 'harvest',
+                    'ph': 'X',
+                    'ts': int(start * 1000000),
+                    'dur': int(seconds * 1000000),
+                    'pid': os.getpid(),
+                    'tid': threading.current_thread().ident,
+                    'args': span_args,
+                })
+
+def increment(counter, amount=1):
+    '''Adds `amount` to a counter of the job of the current stage'''
+    job_id = getattr(_current, 'job_id', None)
+    if job_id is None:
+        return
+    with _lock:
+        counters = _counters.setdefault(job_id, {})
+        counters[counter] = counters.get(counter, 0) + amount
+
+class timed(object):
+    '''Context manager timing a step of the current stage. The keyword
+    arguments are added to its span if the job is traced.'''
+
+    def __init__(self, step, **args):
+        self.step = step
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.step, time.time() - self.start, self.start, self.args)
+        return False
+
+def _get_job_id(obj):
+    '''Job id of a HarvestJob, HarvestObject, GatherShard or HarvestContext'''
+    harvest_object = getattr(obj, 'harvest_object', None)
+    if harvest_object is not None:
+        return harvest_object.harvest_job_id
+    return getattr(obj, 'harvest_job_id', None) or getattr(obj, 'id', None)
+
+def _get_span_args(obj):
+    '''Arguments of the spans of a stage run on a HarvestObject or
+    HarvestContext'''
+    harvest_object = getattr(obj, 'harvest_object', None) or obj
+    if isinstance(getattr(harvest_object, 'guid', None), basestring):
+        return {'guid': harvest_object.guid,
+                'harvest_object_id': harvest_object.id}
+    return {}
+
+def stage(name, flush=False):
+    '''Decorator for the harvester methods running a stage (`name`) of the
+    job of their first argument. Times the whole call, and makes the steps
+    timed while it runs count for the job. The timings are then flushed if
+    `flush` is True or the flush interval is over.'''
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, obj, *args, **kwargs):
+            if getattr(_current, 'job_id', None) is not None or \
+               not timing_enabled():
+                # Nested stage (or disabled), the outer one does the work
+                return method(self, obj, *args, **kwargs)
+
+            job_id = _get_job_id(obj)
+            _current.traced = _is_traced(job_id)
+            _current.args = _get_span_args(obj) if _current.traced else {}
+            _current.job_id = job_id
+            start = time.time()
+            try:
+                return method(self, obj, *args, **kwargs)
+            finally:
+                record(name, time.time() - start, start)
+                _current.job_id = None
+                flush_if_needed(force=flush)
+        return wrapper
+    return decorator
+
+def flush_if_needed(force=False):
+    interval = int(config.get('ckan.inspire.timing.flush_interval', 60))
+    with _lock:
+        due = force or datetime.now() - _last_flush >= timedelta(seconds=interval)
+    if due:
+        flush()
+
+def flush():
+    '''Adds the timings recorded since the last flush to the database.
+
+    They are written on a connection of their own, so it can be done at
+    any point of a stage without committing its transaction.'''
+    global _timings, _counters, _spans, _last_flush, _atexit_registered
+    with _lock:
+        timings, _timings = _timings, {}
+        counters, _counters = _counters, {}
+        spans, _spans = _spans, {}
+        _last_flush = datetime.now()
+        if not _atexit_registered:
+            atexit.register(_flush_at_exit)
+            _atexit_registered = True
+
+    saved = 0
+    for job_id in set(timings.keys() + counters.keys()):
+        rows = [{
+            'harvest_job_id': job_id,
+            'step': step,
+            'count': step_timings.count,
+            'total': step_timings.total,
+            'max': step_timings.max,
+            'histogram': json.dumps(step_timings.histogram),
+            'created': datetime.now(),
+        } for step, step_timings in timings.get(job_id, {}).iteritems()]
+        # Counters are stored without a histogram
+        rows.extend({
+            'harvest_job_id': job_id,
+            'step': counter,
+            'count': total,
+            'histogram': None,
+            'created': datetime.now(),
+        } for counter, total in counters.get(job_id, {}).iteritems())
+        try:
+            Session.bind.execute(job_timing_table.insert(), rows)
+            saved += len(rows)
+        except Exception, e:
+            # Losing some timings (e.g. of a job deleted meanwhile) is
+            # better than failing the harvest
+            log.error('Could not save the timings of job %s: %s' % (job_id, e))
+
+    for job_id, events in spans.iteritems():
+        try:
+            Session.bind.execute(trace_event_table.insert(), {
+                'harvest_job_id': job_id,
+                'events': json.dumps(events),
+                'created': datetime.now(),
+            })
+        except Exception, e:
+            log.error('Could not save the trace of job %s: %s' % (job_id, e))
+    return saved
+
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception, e:
+        log.error('Could not save the timings on exit: %s' % e)
+
+def _summarize(query):
+    steps = {}
+    for step, count, total, max_seconds, histogram in Session.execute(query):
+        step_timings = StepTimings(count, total, max_seconds, json.loads(histogram))
+        if step in steps:
+            steps[step].merge(step_timings)
+        else:
+            steps[step] = step_timings
+    return dict((step, step_timings.as_dict())
+                for step, step_timings in steps.iteritems())
+
+def _timings_query():
+    t = job_timing_table
+    return select([t.c.step, t.c.count, t.c.total, t.c.max, t.c.histogram]) \
+           .where(t.c.histogram!=None)
+
+def _counters_query():
+    t = job_timing_table
+    return select([t.c.step, func.sum(t.c.count)]) \
+           .where(t.c.histogram==None) \
+           .group_by(t.c.step)
+
+def _source_jobs(harvest_source_id):
+    from ckanext.harvest.model import harvest_job_table
+
+    return job_timing_table.c.harvest_job_id.in_(
+        select([harvest_job_table.c.id])
+        .where(harvest_job_table.c.source_id==harvest_source_id))
+
+def get_job_timings(harvest_job_id):
+    '''Returns a dict with the count, total, mean, max and percentiles (in
+    seconds) of the durations of each step of a job'''
+    return _summarize(_timings_query()
+                      .where(job_timing_table.c.harvest_job_id==harvest_job_id))
+
+def get_source_timings(harvest_source_id):
+    '''Same as get_job_timings, for all the jobs of a source'''
+    return _summarize(_timings_query().where(_source_jobs(harvest_source_id)))
+
+def get_job_counters(harvest_job_id):
+    '''Returns a dict with the totals of the counters of a job'''
+    return dict((counter, int(total)) for counter, total in Session.execute(
+        _counters_query().where(job_timing_table.c.harvest_job_id==harvest_job_id)))
+
+def get_source_counters(harvest_source_id):
+    '''Same as get_job_counters, for all the jobs of a source'''
+    return dict((counter, int(total)) for counter, total in Session.execute(
+        _counters_query().where(_source_jobs(harvest_source_id))))
+
+def get_job_trace(harvest_job_id):
+    '''Returns the spans recorded for a traced job as a dict in the Chrome
+    trace event format'''
+    events = []
+    for events_json, in Session.execute(select([trace_event_table.c.events])
+            .where(trace_event_table.c.harvest_job_id==harvest_job_id)
+            .order_by(trace_event_table.c.created)):
+        events.extend(json.loads(events_json))
+    events.sort(key=lambda event: event['ts'])
+
+    # Name the processes, there is one per harvester process
+    for pid in sorted(set(event['pid'] for event in events)):
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                       'args': {'name': 'harvester %s' % pid}})
+    return {
+        'traceEvents': events,
+        'displayTimeUnit': 'ms',
+        'otherData': {'harvest_job_id': harvest_job_id},
+    }
@@ -29,5 +29,8 @@ setup(
     gemini_csw_harvester=ckanext.inspire.harvesters:GeminiCswHarvester
     gemini_doc_harvester=ckanext.inspire.harvesters:GeminiDocHarvester
     gemini_waf_harvester=ckanext.inspire.harvesters:GeminiWafHarvester
+
+    [paste.paster_command]
+    inspire=ckanext.inspire.commands:InspireCommand
     """,
 )